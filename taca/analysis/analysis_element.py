@@ -5,6 +5,7 @@ import logging
 import os
 
 from taca.element.Aviti_Runs import Aviti_Run
+from taca.element.Element_Runs import prefetch_run_statuses
 from taca.utils.config import CONFIG
 from taca.utils.misc import send_mail
 
@@ -59,8 +60,9 @@ def run_preprocessing(given_run):
                         run.run_dir, f"Demultiplexing_{sub_demux_count}"
                     )
                     os.mkdir(sub_demux_dir)
-                    run.start_demux(demux_manifest, sub_demux_dir)
+                    run.queue_demux(demux_manifest, sub_demux_dir)
                     sub_demux_count += 1
+                run.start_queued_demux()
                 run.status = "demultiplexing"
                 if run.status_changed():
                     run.update_statusdb()
@@ -76,11 +78,29 @@ def run_preprocessing(given_run):
                 send_mail(email_subject, email_message, CONFIG["mail"]["recipients"])
                 return
         elif demultiplexing_status == "ongoing":
+            # Start any demultiplexing jobs still waiting for cores
+            run.start_queued_demux()
             run.status = "demultiplexing"
             if run.status_changed():
                 run.update_statusdb()
             return
 
+        elif demultiplexing_status == "failed":
+            # Only report the failure once, when the status is first set
+            run.status = "demultiplexing failed"
+            if run.status_changed():
+                failures = "\n".join(
+                    f"{demux_dir} exited with code {exit_code}, see "
+                    f"{os.path.join(demux_dir, 'bases2fastq_stderr.txt')}"
+                    for demux_dir, exit_code in run.get_failed_demux().items()
+                )
+                logger.warning(f"Demultiplexing failed for {run}:\n{failures}")
+                email_subject = f"Demultiplexing failed for {run}"
+                email_message = f"Demultiplexing failed for {run}:\n{failures}"
+                send_mail(email_subject, email_message, CONFIG["mail"]["recipients"])
+                run.update_statusdb()
+            return
+
         elif demultiplexing_status != "finished":
             logger.warning(
                 f"Unknown demultiplexing status {demultiplexing_status} of run {run}. Please investigate."
@@ -153,6 +173,7 @@ def run_preprocessing(given_run):
         for data_dir in data_dirs:
             # Run folder looks like DATE_*_*, the last section is the FC side (A/B) and name
             runs = glob.glob(os.path.join(data_dir, "[1-9]*_*_*"))
+            prefetch_run_statuses(runs, CONFIG)
             for run in runs:
                 runObj = Aviti_Run(run, CONFIG)
                 try:
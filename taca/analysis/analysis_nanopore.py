@@ -10,6 +10,7 @@ from taca.nanopore.ONT_run_classes import (
     ONT_qc_run,
     ONT_run,
     ONT_user_run,
+    prefetch_run_statuses,
 )
 from taca.utils.config import CONFIG
 from taca.utils.misc import send_mail
@@ -60,8 +61,11 @@ def process_user_run(ont_user_run: ONT_user_run):
         If fully synced:
             - Ensure all necessary files to proceed with processing are present
             - Update the StatusDB entry
-            - Copy metadata
             - Copy HTML report to GenStat
+            - Start ToulligQC, or publish its report to GenStat once finished
+            - If ToulligQC is not finished
+                - Skip
+            - Copy metadata
             - Transfer run to cluster
             - Update transfer log
             - Archive run
@@ -101,7 +105,10 @@ def process_user_run(ont_user_run: ONT_user_run):
             logger.info(
                 f"{ont_user_run.run_name}: Generating and publishing ToulligQC report..."
             )
-            ont_user_run.toulligqc_report()
+            if not ont_user_run.toulligqc_report():
+                raise WaitForRun(
+                    f"{ont_user_run.run_name}: ToulligQC report is not finished, skipping."
+                )
 
             # Copy metadata
             logger.info(f"{ont_user_run.run_name}: Copying metadata...")
@@ -131,6 +138,7 @@ def process_qc_run(ont_qc_run: ONT_qc_run):
         ├── Ensure all necessary files to proceed with processing are present
         ├── Update the StatusDB entry
         ├── Copy HTML report to GenStat
+        ├── Start ToulligQC, or publish its report to GenStat once finished
         ├── If there is sequencing raw data
         │   ├── If no fastq output
         │   │   └── Skip run
@@ -139,10 +147,14 @@ def process_qc_run(ont_qc_run: ONT_qc_run):
         │   │   │   └── Skip run
         │   │   ├── If Anglerfish samplesheet could not be found  
         │   │   │   └── Skip run
+        │   │   ├── If the Anglerfish thread budget is used up
+        │   │   │   └── Skip run
         │   │   ├── Run Anglerfish as subprocess
         │   │   └── Skip run
         │   └── If Anglerfish has failed
         │       └── Throw error
+        ├── If ToulligQC is not finished
+        │   └── Skip run
         ├── If run has already been transferred
         │   └── Skip run
         ├── Copy metadata
@@ -174,7 +186,7 @@ def process_qc_run(ont_qc_run: ONT_qc_run):
 
     # Generate and publish TouliggQC report
     logger.info(f"{ont_qc_run.run_name}: Generating and publishing ToulligQC report...")
-    ont_qc_run.toulligqc_report()
+    toulligqc_finished = ont_qc_run.toulligqc_report()
 
     # Look at seq data
     if not ont_qc_run.has_raw_seq_output():
@@ -221,8 +233,13 @@ def process_qc_run(ont_qc_run: ONT_qc_run):
             if not ont_qc_run.fetch_anglerfish_samplesheet():
                 raise WaitForRun("Could not find Anglerfish sample sheet, skipping.")
 
+            logger.info(f"{ont_qc_run.run_name}: Allocating Anglerfish threads...")
+            anglerfish_threads = ont_qc_run.allocate_anglerfish_threads()
+            if anglerfish_threads is None:
+                raise WaitForRun("Anglerfish is queued, skipping.")
+
             logger.info(f"{ont_qc_run.run_name}: Starting Anglerfish...")
-            ont_qc_run.run_anglerfish()
+            ont_qc_run.run_anglerfish(anglerfish_threads)
             raise WaitForRun("Anglerfish has been started, skipping.")
 
         # Anglerfish run
@@ -239,6 +256,12 @@ def process_qc_run(ont_qc_run: ONT_qc_run):
         else:
             raise AssertionError("Unexpected Anglerfish exit code.")
 
+    # Wait for ToulligQC
+    if not toulligqc_finished:
+        raise WaitForRun(
+            f"{ont_qc_run.run_name}: ToulligQC report is not finished, skipping."
+        )
+
     # Check transfer status
     if ont_qc_run.is_transferred():
         logger.warning(
@@ -289,6 +312,7 @@ def ont_transfer(run_abspath: str | None, qc: bool = False):
 
             for data_dir in data_dirs:
                 run_dirs = find_run_dirs(data_dir, ignore_dirs)
+                prefetch_run_statuses(run_dirs)
 
                 for run_dir in run_dirs:
                     # Send error mails at run-level
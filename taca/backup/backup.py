@@ -1,19 +1,41 @@
 """Backup methods and utilities."""
 
 import csv
+import hashlib
+import json
 import logging
 import os
 import re
 import shutil
 import subprocess as sp
+import tarfile
+import tempfile
+import threading
 import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime
 
+from taca.backup.chunked_archive import DEFAULT_CHUNK_SIZE, ChunkedArchive, call_dsmc
 from taca.utils import filesystem, misc, statusdb
 from taca.utils.config import CONFIG
 
 logger = logging.getLogger(__name__)
 
+# Run sizes in GB per run type, used until runs of the type have been measured
+RUN_SIZES = {
+    "novaseq": 1800,
+    "miseq": 20,
+    "nextseq": 250,
+    "NovaSeqXPlus": 3600,
+    "promethion": 3000,
+    "minion": 1000,
+    "aviti": 350,
+}
+# not able to fetch runtype use the max size as precaution
+DEFAULT_RUN_SIZE = 900
+GB = 1024**3
+RESTORE_BUFFER_SIZE = 1024 * 1024
+
 
 class run_vars:
     """A simple variable storage class."""
@@ -25,7 +47,81 @@ class run_vars:
         self.tar = os.path.join(archive_path, f"{self.name}.tar")
         self.key = f"{self.name}.key"
         self.key_encrypted = f"{self.name}.key.gpg"
+        self.md5 = f"{self.name}.tar.md5"
         self.tar_encrypted = os.path.join(archive_path, f"{self.name}.tar.gpg")
+        self.chunked_archive = ChunkedArchive(archive_path, self.name)
+
+
+class run_size_cache:
+    """Measured sizes of run directories, kept in a json file between sweeps.
+
+    The size of the files of each directory is stored with its modification
+    time, so that measuring a run again only reads the directories that
+    changed. This is meant for finished runs, whose files do not grow anymore.
+    """
+
+    def __init__(self, cache_file=None):
+        self.cache_file = cache_file
+        # dir path -> [mtime_ns, size of the files in it, subdirectory names]
+        self.dirs = {}
+        # run name -> [run type, size]
+        self.runs = {}
+        self.measured_dirs = set()
+        if cache_file and os.path.exists(cache_file):
+            try:
+                with open(cache_file) as cache:
+                    cached = json.load(cache)
+                self.dirs = cached.get("dirs", {})
+                self.runs = cached.get("runs", {})
+            except (OSError, ValueError) as e:
+                logger.warning(f"Could not read run sizes from {cache_file}: {e}")
+
+    def measure(self, run_path):
+        """Return the total size of the files in the given run directory."""
+        total_size = 0
+        dirs_to_scan = [run_path]
+        while dirs_to_scan:
+            dir_path = dirs_to_scan.pop()
+            try:
+                mtime_ns = os.stat(dir_path).st_mtime_ns
+            except OSError:
+                continue
+            cached_dir = self.dirs.get(dir_path)
+            if cached_dir is None or cached_dir[0] != mtime_ns:
+                files_size, subdirs = 0, []
+                with os.scandir(dir_path) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry.name)
+                        else:
+                            files_size += entry.stat(follow_symlinks=False).st_size
+                cached_dir = self.dirs[dir_path] = [mtime_ns, files_size, subdirs]
+            self.measured_dirs.add(dir_path)
+            total_size += cached_dir[1]
+            dirs_to_scan.extend(os.path.join(dir_path, d) for d in cached_dir[2])
+        return total_size
+
+    def record(self, run, run_type, size):
+        """Record the measured size of a finished run."""
+        self.runs[run] = [run_type, size]
+
+    def estimate(self, run_type):
+        """Estimate the size of a run of the given type from the largest
+        measured run of that type."""
+        sizes = [size for rtype, size in self.runs.values() if rtype == run_type]
+        if sizes:
+            return max(sizes)
+        return RUN_SIZES.get(run_type, DEFAULT_RUN_SIZE) * GB
+
+    def save(self):
+        """Write the cache, keeping only the directories measured in this sweep."""
+        if not self.cache_file:
+            return
+        dirs = {d: v for d, v in self.dirs.items() if d in self.measured_dirs}
+        tmp_file = f"{self.cache_file}.tmp"
+        with open(tmp_file, "w") as cache:
+            json.dump({"dirs": dirs, "runs": self.runs}, cache)
+        os.replace(tmp_file, self.cache_file)
 
 
 class backup_utils:
@@ -35,6 +131,14 @@ class backup_utils:
         self.run = run
         self.fetch_config_info()
         self.host_name = os.getenv("HOSTNAME", os.uname()[1]).split(".", 1)[0]
+        self.run_sizes = run_size_cache(self.run_sizes_cache)
+        # free space left per file system in this sweep, read once with statvfs
+        self.disk_space = {}
+        # space reserved by each run admitted for encryption
+        self.reserved_space = {}
+        self._disk_space_lock = threading.Lock()
+        # StatusDB connections by database, reused for all runs of the sweep
+        self.statusdb_connections = {}
 
     def fetch_config_info(self):
         """Try to fecth required info from the config file. Log and exit if any neccesary info is missing."""
@@ -55,6 +159,18 @@ class backup_utils:
                 "copy_complete_indicator", "CopyComplete.txt"
             )
             self.archive_log_location = CONFIG["backup"]["archive_log"]
+            self.run_sizes_cache = CONFIG["backup"].get("run_sizes_cache")
+            # a job runs tar and gpg, so it keeps about two cores busy
+            self.max_encryption_jobs = CONFIG["backup"].get(
+                "max_encryption_jobs", max(1, (os.cpu_count() or 2) // 2)
+            )
+            self.max_encryption_jobs_per_disk = CONFIG["backup"].get(
+                "max_encryption_jobs_per_disk", 2
+            )
+            # "tar" for one encrypted tarball per run, "chunked" for a ChunkedArchive
+            self.archive_format = CONFIG["backup"].get("archive_format", "tar")
+            self.chunk_size = CONFIG["backup"].get("chunk_size", DEFAULT_CHUNK_SIZE)
+            self.pdc_workers = CONFIG["backup"].get("pdc_workers", 4)
         except KeyError as e:
             logger.error(
                 f"Config file is missing the key {str(e)}, make sure it have all required information"
@@ -95,7 +211,7 @@ class backup_utils:
                         re.match(filesystem.RUN_RE_ILLUMINA, item)
                         or re.match(filesystem.RUN_RE_ONT, item)
                         or re.match(filesystem.RUN_RE_ELEMENT, item)
-                    ) and item not in self.runs:
+                    ) and item not in [r.name for r in self.runs]:
                         run_type = self._get_run_type(item)
                         archive_path = self.archive_dirs[run_type]
                         run = run_vars(os.path.join(archive_dir, item), archive_path)
@@ -103,21 +219,101 @@ class backup_utils:
                             self.runs.append(run)
 
     def avail_disk_space(self, path, run):
-        """Check the space on file system based on parent directory of the run."""
-        # not able to fetch runtype use the max size as precaution, size units in GB
-        run_sizes = {
-            "novaseq": 1800,
-            "miseq": 20,
-            "nextseq": 250,
-            "NovaSeqXPlus": 3600,
-            "promethion": 3000,
-            "minion": 1000,
-            "aviti": 350,
-        }
-        required_size = run_sizes.get(self._get_run_type(run), 900) * 2
-        # check for any ongoing runs and add up the required size accordingly
+        """Check the space on file system based on parent directory of the run,
+        and reserve it for the encryption of the run. Exit if there is not enough.
+        """
+        required_size, available_size = self._reserve_disk_space(path, run)
+        self.run_sizes.save()
+        if available_size < required_size:
+            self._low_disk_space(required_size, available_size)
+
+    def _low_disk_space(self, required_size, available_size):
+        """Report that there is not enough space for encryption and exit."""
+        e_msg = f"Required space for encryption is {required_size / GB:.0f}GB, but only {available_size / GB:.0f}GB available"
+        subjt = f"Low space for encryption - {self.host_name}"
+        logger.error(e_msg)
+        misc.send_mail(subjt, e_msg, self.mail_recipients)
+        raise SystemExit
+
+    def _reserve_disk_space(self, path, run, required_size=None):
+        """Reserve the space needed to encrypt a run if it is available.
+
+        The free space is read once per sweep, minus the space still needed by
+        ongoing sequencing and encryption, and the space needed by each run
+        admitted for encryption is reserved from it. Return the required and
+        available space.
+
+        :param int required_size: Space needed by the run, if already known
+        """
+        if required_size is None:
+            required_size = self._encryption_space(path, run)
+        device = os.stat(path).st_dev
+        if device not in self.disk_space:
+            # read outside of the lock, it lists and measures other runs
+            free_space = self._free_disk_space(path)
+            with self._disk_space_lock:
+                self.disk_space.setdefault(device, free_space)
+        with self._disk_space_lock:
+            available_size = self.disk_space[device]
+            if required_size <= available_size:
+                self.disk_space[device] -= required_size
+                self.reserved_space[run] = required_size
+        return required_size, available_size
+
+    def release_disk_space(self, path, run, encrypted=True):
+        """Give back the space reserved for a run, but for the encrypted file
+        if the run was encrypted."""
+        device = os.stat(path).st_dev
+        with self._disk_space_lock:
+            released_size = self.reserved_space.pop(run, 0)
+            if encrypted and run in self.run_sizes.runs:
+                # the encrypted run stays on disk
+                released_size = max(released_size - self.run_sizes.runs[run][1], 0)
+            if device in self.disk_space:
+                self.disk_space[device] += released_size
+
+    def _encryption_space(self, path, run):
+        """Space still needed to make the tarball of a run and encrypt it."""
+        run_path = os.path.join(path, run)
+        tar, tar_encrypted = f"{run_path}.tar", f"{run_path}.tar.gpg"
+        if os.path.isdir(run_path) and self.archive_format == "chunked":
+            size = self.run_sizes.measure(run_path)
+            self.run_sizes.record(run, self._get_run_type(run), size)
+            # the chunks are encrypted on the fly, without a tarball
+            chunks_dir = os.path.join(path, f"{run}.chunks")
+            if os.path.isdir(chunks_dir):
+                size -= self.run_sizes.measure(chunks_dir)
+            return max(size, 0)
+        elif os.path.isdir(run_path):
+            size = self.run_sizes.measure(run_path)
+            self.run_sizes.record(run, self._get_run_type(run), size)
+            # the tarball and the encrypted file are both on disk before
+            # the tarball is removed
+            required_size = 2 * size
+            if os.path.exists(tar):
+                required_size -= os.path.getsize(tar)
+        elif os.path.exists(tar):
+            required_size = os.path.getsize(tar)
+        else:
+            return 0
+        # an ongoing encryption has already written part of the files
+        if os.path.exists(tar_encrypted):
+            required_size -= os.path.getsize(tar_encrypted)
+        return max(required_size, 0)
+
+    def _free_disk_space(self, path):
+        """Free space on the file system of the path, minus the space needed by
+        sequencing and encryption that are ongoing on it."""
+        try:
+            fs_stat = os.statvfs(path)
+        except OSError as e:
+            logger.error(f"Evaluation of disk space failed with error {e}")
+            raise SystemExit
+        free_space = fs_stat.f_bavail * fs_stat.f_frsize
+        device = os.stat(path).st_dev
+        # runs still being sequenced will grow to the size of their type
         for data_dir in self.data_dirs.values():
-            if not os.path.isdir(data_dir):
+            if not os.path.isdir(data_dir) or os.stat(data_dir).st_dev != device:
                 continue
             for run_dir in os.listdir(data_dir):
                 if not (
@@ -137,25 +333,16 @@ class backup_utils:
                         os.path.join(data_dir, run_dir, "RunUploaded.json")  # Element
                     )
                 ):
-                    required_size += run_sizes.get(self._get_run_type(run), 900)
-        # get available free space from the file system
-        try:
-            df_proc = sp.Popen(["df", path], stdout=sp.PIPE, stderr=sp.PIPE)
-            df_out, df_err = df_proc.communicate()
-            available_size = (
-                int(df_out.strip().decode("utf-8").split("\n")[-1].strip().split()[3])
-                / 1024
-                / 1024
-            )
-        except Exception as e:
-            logger.error(f"Evaluation of disk space failed with error {e}")
-            raise SystemExit
-        if available_size < required_size:
-            e_msg = f"Required space for encryption is {required_size}GB, but only {available_size}GB available"
-            subjt = f"Low space for encryption - {self.host_name}"
-            logger.error(e_msg)
-            misc.send_mail(subjt, e_msg, self.mail_recipients)
-            raise SystemExit
+                    free_space -= self.run_sizes.estimate(self._get_run_type(run_dir))
+        # runs being encrypted by other processes
+        for archive_dir in set(self.archive_dirs.values()):
+            if not os.path.isdir(archive_dir) or os.stat(archive_dir).st_dev != device:
+                continue
+            for item in os.listdir(archive_dir):
+                if item.endswith(".encrypting"):
+                    run = item[: -len(".encrypting")]
+                    free_space -= self._encryption_space(archive_dir, run)
+        return free_space
 
     def file_in_pdc(self, src_file, silent=True):
         """Check if the given files exist in PDC."""
@@ -292,16 +479,9 @@ class backup_utils:
                 )
         else:
             try:
-                run_vals = run.split("_")
-                if len(run_vals[0]) == 8:
-                    run_date = run_vals[0][2:]
-                else:
-                    run_date = run_vals[0]
-                run_fc = f"{run_date}_{run_vals[-1]}"
-                couch_connection = statusdb.StatusdbSession(self.couch_info).connection
-                db = couch_connection[self.couch_info["db"]]
-                fc_names = {e.key: e.id for e in db.view("names/name", reduce=False)}
-                d_id = fc_names[run_fc]
+                fc_connection = self._flowcell_connection(self.couch_info["db"])
+                d_id, _ = fc_connection.get_flowcell_entry(misc.statusdb_fc_name(run))
+                db = fc_connection.db
                 doc = db.get(d_id)
                 doc["pdc_archived"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
                 db.save(doc)
@@ -313,6 +493,34 @@ class backup_utils:
                     f'Not able to log "pdc_archived" timestamp for run {run}'
                 )
 
+    def _flowcell_connection(self, dbname):
+        """Return the connection to a flowcell database of StatusDB, made once
+        per sweep."""
+        if dbname not in self.statusdb_connections:
+            self.statusdb_connections[dbname] = statusdb.FlowcellNamesConnection(
+                self.couch_info, dbname=dbname
+            )
+        return self.statusdb_connections[dbname]
+
+    def _prefetch_flowcells(self, runs, dbname, include_docs=False):
+        """Look up the flowcells of all the Illumina runs of the sweep with one
+        keyed query, instead of one query per run."""
+        fc_names = [
+            misc.statusdb_fc_name(run.name)
+            for run in runs
+            if re.match(filesystem.RUN_RE_ILLUMINA, run.name)
+        ]
+        if not fc_names:
+            return
+        try:
+            self._flowcell_connection(dbname).prefetch_flowcells(
+                fc_names, include_docs=include_docs
+            )
+        except Exception as e:
+            logger.warning(
+                f'Could not prefetch the flowcells of the runs from StatusDB due to "{e}"'
+            )
+
     def _is_ready_to_archive(self, run, ext):
         """Check if the run to be encrypted has finished sequencing and has been copied completely to ngi_data"""
         archive_ready = False
@@ -335,15 +543,21 @@ class backup_utils:
             )
         ):
             # Case for encrypting
-            # Run has NOT been encrypted (run.tar.gpg not exists)
-            if ext == ".tar" and (not os.path.exists(run.tar_encrypted)):
+            # Run has NOT been encrypted (run.tar.gpg or chunked archive not exists)
+            if (
+                ext == ".tar"
+                and (not os.path.exists(run.tar_encrypted))
+                and (not run.chunked_archive.exists())
+            ):
                 logger.info(
                     f"Sequencing has finished and copying completed for run {os.path.basename(run_path)} and is ready for archiving"
                 )
                 archive_ready = True
             # Case for putting data to PDC
             # Run has already been encrypted (run.tar.gpg exists)
-            elif ext == ".tar.gpg" and os.path.exists(run.tar_encrypted):
+            elif (ext == ".tar.gpg" and os.path.exists(run.tar_encrypted)) or (
+                ext == ".chunks" and run.chunked_archive.exists()
+            ):
                 logger.info(
                     f"Sequencing has finished and copying completed for run {os.path.basename(run_path)} and is ready for sending to PDC"
                 )
@@ -369,21 +583,25 @@ class backup_utils:
 
     @classmethod
     def encrypt_runs(cls, run, force):
-        """Encrypt the runs that have been collected."""
+        """Encrypt the runs that have been collected.
+
+        Several runs are encrypted at once, the smallest first. A run is
+        started when its space can be reserved on the disk, there are spare
+        cores and the disk of the run is not busy with other encryptions.
+        """
         bk = cls(run)
         bk.collect_runs(ext=".tar")
         logger.info(f"In total, found {len(bk.runs)} run(s) to be encrypted")
+        fc_connection = None
+        if not force and bk.check_demux and bk.couch_info:
+            bk._prefetch_flowcells(bk.runs, bk.couch_info["xten_db"], include_docs=True)
+            fc_connection = bk._flowcell_connection(bk.couch_info["xten_db"])
+        queued_runs = []
         for run in bk.runs:
-            run.flag = f"{run.name}.encrypting"
-            run.dst_key_encrypted = os.path.join(bk.keys_path, run.key_encrypted)
-            tmp_files = [run.tar_encrypted, run.key_encrypted, run.key, run.flag]
-            logger.info(f"Encryption of run {run.name} is now started")
-            # Check if there is enough space and exit if not
-            bk.avail_disk_space(run.path, run.name)
             # Check if the run in demultiplexed
             if not force and bk.check_demux:
                 if not misc.run_is_demuxed(
-                    run, bk.couch_info, bk._get_run_type(run.name)
+                    run, bk.couch_info, bk._get_run_type(run.name), fc_connection
                 ):
                     logger.warning(
                         f"Run {run.name} is not demultiplexed yet, so skipping it"
@@ -392,127 +610,273 @@ class backup_utils:
                 logger.info(
                     f"Run {run.name} is demultiplexed and proceeding with encryption"
                 )
-            with filesystem.chdir(run.path):
-                # skip run if already ongoing
-                if os.path.exists(run.flag):
-                    logger.warning(
-                        f"Run {run.name} is already being encrypted, so skipping now"
-                    )
-                    continue
-                open(run.flag, "w").close()
-                # Make run directory tarball
-                if os.path.exists(run.tar):
-                    if os.path.isdir(run.name):
-                        logger.warning(
-                            f"Both run source and archive tarball exist for run {run.name}, skipping run as precaution"
-                        )
-                        bk._clean_tmp_files([run.flag])
-                        continue
-                    logger.info(
-                        f"Archive tarball already exist for run {run.name}, so using it for encryption"
-                    )
-                else:
-                    exclude_files = " ".join(
-                        [f"--exclude {x}" for x in bk.exclude_list]
-                    )
-                    logger.info(f"Creating archive tarball for run {run.name}")
-                    if bk._call_commands(
-                        cmd1=f"tar {exclude_files} -cf - {run.name}",
-                        out_file=run.tar,
-                        mail_failed=True,
-                        tmp_files=[run.tar, run.flag],
-                    ):
-                        logger.info(
-                            f"Run {run.name} was successfully tarballed and transferred to {run.tar}"
-                        )
-                    else:
-                        logger.warning(f"Skipping run {run.name} and moving on")
-                        continue
-                # Remove encrypted file if already exists
-                if os.path.exists(run.tar_encrypted):
-                    logger.warning(
-                        f"Removing already existing encrypted file for run {run.name}, this is a precaution "
-                        "to make sure the file was encrypted with correct key file"
-                    )
-                    bk._clean_tmp_files(
-                        [
-                            run.tar_encrypted,
-                            run.key,
-                            run.key_encrypted,
-                            run.dst_key_encrypted,
-                        ]
-                    )
-                # Generate random key to use as pasphrase
-                if not bk._call_commands(
-                    cmd1="gpg --gen-random 1 256", out_file=run.key, tmp_files=tmp_files
-                ):
-                    logger.warning(f"Skipping run {run.name} and moving on")
-                    continue
-                logger.info(f"Generated random phrase key for run {run.name}")
-                # Calculate md5 sum pre encryption
-                if not force:
-                    logger.info("Calculating md5sum before encryption")
-                    md5_call, md5_out = bk._call_commands(
-                        cmd1=f"md5sum {run.tar}", return_out=True, tmp_files=tmp_files
-                    )
-                    if not md5_call:
-                        logger.warning(f"Skipping run {run.name} and moving on")
-                        continue
-                    md5_pre_encrypt = md5_out.split()[0]
-                # Encrypt the tar run file
-                logger.info("Encrypting the tar run file")
-                if not bk._call_commands(
-                    cmd1=(
-                        f"gpg --symmetric --cipher-algo aes256 --passphrase-file {run.key} --batch --compress-algo "
-                        f"none -o {run.tar_encrypted} {run.tar}"
-                    ),
-                    tmp_files=tmp_files,
-                ):
-                    logger.warning(f"Skipping run {run.name} and moving on")
-                    continue
-                # Decrypt and check for md5
-                if not force:
-                    logger.info("Calculating md5sum after encryption")
-                    md5_call, md5_out = bk._call_commands(
-                        cmd1=f"gpg --decrypt --cipher-algo aes256 --passphrase-file {run.key} --batch {run.tar_encrypted}",
-                        cmd2="md5sum",
-                        return_out=True,
-                        tmp_files=tmp_files,
-                    )
-                    if not md5_call:
-                        logger.warning(f"Skipping run {run.name} and moving on")
-                        continue
-                    md5_post_encrypt = md5_out.split()[0]
-                    if md5_pre_encrypt != md5_post_encrypt:
-                        logger.error(
-                            f"md5sum did not match before {md5_pre_encrypt} and after {md5_post_encrypt} encryption. Will remove temp files and move on"
+            # skip run if already ongoing
+            if os.path.exists(os.path.join(run.path, f"{run.name}.encrypting")):
+                logger.warning(
+                    f"Run {run.name} is already being encrypted, so skipping now"
+                )
+                continue
+            run.size = bk._run_size(run)
+            run.required_size = bk._encryption_space(run.path, run.name)
+            run.device = os.stat(run.path).st_dev
+            queued_runs.append(run)
+        # smaller runs first, to clear the backlog sooner
+        queued_runs.sort(key=lambda r: r.size)
+
+        running = {}
+        try:
+            with ThreadPoolExecutor(max_workers=bk.max_encryption_jobs) as pool:
+                while queued_runs or running:
+                    low_space = None
+                    for run in list(queued_runs):
+                        if not bk._can_start_encryption(run, running.values()):
+                            continue
+                        required_size, available_size = bk._reserve_disk_space(
+                            run.path, run.name, run.required_size
                         )
-                        bk._clean_tmp_files(tmp_files)
-                        continue
-                    logger.info("Md5sum matches before and after encryption")
-                # Encrypt and move the key file
-                if bk._call_commands(
-                    cmd1=f"gpg -e -r {bk.gpg_receiver} -o {run.key_encrypted} {run.key}",
-                    tmp_files=tmp_files,
-                ):
-                    shutil.move(run.key_encrypted, run.dst_key_encrypted)
-                else:
-                    logger.error("Encryption of key file failed, skipping run")
-                    continue
-                bk._clean_tmp_files([run.tar, run.key, run.flag])
+                        if available_size < required_size:
+                            low_space = low_space or (required_size, available_size)
+                            continue
+                        queued_runs.remove(run)
+                        running[pool.submit(bk._encrypt_run, run, force)] = run
+                    if not running:
+                        # nothing could be started, even the smallest run does not fit
+                        bk._low_disk_space(*low_space)
+                    done, _ = wait(running, timeout=60, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        run = running.pop(future)
+                        try:
+                            encrypted = future.result()
+                        except Exception as e:
+                            logger.error(f"Encryption of run {run.name} failed: {e}")
+                            encrypted = False
+                        bk.release_disk_space(run.path, run.name, encrypted)
+        finally:
+            # measured sizes are saved once per sweep
+            bk.run_sizes.save()
+
+    def _run_size(self, run):
+        """Size of the run directory, or of its tarball."""
+        if os.path.isdir(run.abs_path):
+            return self.run_sizes.measure(run.abs_path)
+        elif os.path.exists(run.tar):
+            return os.path.getsize(run.tar)
+        return 0
+
+    def _can_start_encryption(self, run, running_runs):
+        """Check that there are spare cores and that the disk of the run is not
+        busy, to start encrypting a run next to the running ones."""
+        running_runs = list(running_runs)
+        if not running_runs:
+            return True
+        if len(running_runs) >= self.max_encryption_jobs:
+            return False
+        if (
+            len([r for r in running_runs if r.device == run.device])
+            >= self.max_encryption_jobs_per_disk
+        ):
+            return False
+        # a job keeps about two cores busy
+        return (os.cpu_count() or 2) - os.getloadavg()[0] >= 2
+
+    def _encrypt_run(self, run, force):
+        """Make a tarball of a run and encrypt it, return True if it succeeded.
+
+        Absolute paths are used all along, since several runs are encrypted at
+        the same time from different threads.
+        """
+        run_dir = os.path.join(run.path, run.name)
+        run.flag = os.path.join(run.path, f"{run.name}.encrypting")
+        run.dst_key_encrypted = os.path.join(self.keys_path, run.key_encrypted)
+        run.dst_md5 = os.path.join(self.keys_path, run.md5)
+        key = os.path.join(run.path, run.key)
+        key_encrypted = os.path.join(run.path, run.key_encrypted)
+        tmp_files = [run.tar_encrypted, key_encrypted, key, run.flag]
+        logger.info(f"Encryption of run {run.name} is now started")
+        # skip run if already ongoing
+        if os.path.exists(run.flag):
+            logger.warning(
+                f"Run {run.name} is already being encrypted, so skipping now"
+            )
+            return False
+        open(run.flag, "w").close()
+        if self.archive_format == "chunked":
+            return self._encrypt_run_chunked(run, force, key, key_encrypted)
+        # Make run directory tarball
+        if os.path.exists(run.tar):
+            if os.path.isdir(run_dir):
+                logger.warning(
+                    f"Both run source and archive tarball exist for run {run.name}, skipping run as precaution"
+                )
+                self._clean_tmp_files([run.flag])
+                return False
+            logger.info(
+                f"Archive tarball already exist for run {run.name}, so using it for encryption"
+            )
+        else:
+            exclude_files = " ".join([f"--exclude {x}" for x in self.exclude_list])
+            logger.info(f"Creating archive tarball for run {run.name}")
+            if self._call_commands(
+                cmd1=f"tar {exclude_files} -C {run.path} -cf - {run.name}",
+                out_file=run.tar,
+                mail_failed=True,
+                tmp_files=[run.tar, run.flag],
+            ):
                 logger.info(
-                    f"Encryption of run {run.name} is successfully done, removing run folder tarball"
+                    f"Run {run.name} was successfully tarballed and transferred to {run.tar}"
                 )
+            else:
+                logger.warning(f"Skipping run {run.name} and moving on")
+                return False
+        # Remove encrypted file if already exists
+        if os.path.exists(run.tar_encrypted):
+            logger.warning(
+                f"Removing already existing encrypted file for run {run.name}, this is a precaution "
+                "to make sure the file was encrypted with correct key file"
+            )
+            self._clean_tmp_files(
+                [
+                    run.tar_encrypted,
+                    key,
+                    key_encrypted,
+                    run.dst_key_encrypted,
+                    run.dst_md5,
+                ]
+            )
+        # Generate random key to use as pasphrase
+        if not self._call_commands(
+            cmd1="gpg --gen-random 1 256", out_file=key, tmp_files=tmp_files
+        ):
+            logger.warning(f"Skipping run {run.name} and moving on")
+            return False
+        logger.info(f"Generated random phrase key for run {run.name}")
+        # Calculate md5 sum pre encryption
+        if not force:
+            logger.info("Calculating md5sum before encryption")
+            md5_call, md5_out = self._call_commands(
+                cmd1=f"md5sum {run.tar}", return_out=True, tmp_files=tmp_files
+            )
+            if not md5_call:
+                logger.warning(f"Skipping run {run.name} and moving on")
+                return False
+            md5_pre_encrypt = md5_out.split()[0]
+        # Encrypt the tar run file
+        logger.info("Encrypting the tar run file")
+        if not self._call_commands(
+            cmd1=(
+                f"gpg --symmetric --cipher-algo aes256 --passphrase-file {key} --batch --compress-algo "
+                f"none -o {run.tar_encrypted} {run.tar}"
+            ),
+            tmp_files=tmp_files,
+        ):
+            logger.warning(f"Skipping run {run.name} and moving on")
+            return False
+        # Decrypt and check for md5
+        if not force:
+            logger.info("Calculating md5sum after encryption")
+            md5_call, md5_out = self._call_commands(
+                cmd1=f"gpg --decrypt --cipher-algo aes256 --passphrase-file {key} --batch {run.tar_encrypted}",
+                cmd2="md5sum",
+                return_out=True,
+                tmp_files=tmp_files,
+            )
+            if not md5_call:
+                logger.warning(f"Skipping run {run.name} and moving on")
+                return False
+            md5_post_encrypt = md5_out.split()[0]
+            if md5_pre_encrypt != md5_post_encrypt:
+                logger.error(
+                    f"md5sum did not match before {md5_pre_encrypt} and after {md5_post_encrypt} encryption. Will remove temp files and move on"
+                )
+                self._clean_tmp_files(tmp_files)
+                return False
+            logger.info("Md5sum matches before and after encryption")
+        # Encrypt and move the key file
+        if self._call_commands(
+            cmd1=f"gpg -e -r {self.gpg_receiver} -o {key_encrypted} {key}",
+            tmp_files=tmp_files,
+        ):
+            shutil.move(key_encrypted, run.dst_key_encrypted)
+        else:
+            logger.error("Encryption of key file failed, skipping run")
+            return False
+        # Keep the md5sum of the tarball to check restores against
+        if not force:
+            with open(run.dst_md5, "w") as md5_file:
+                md5_file.write(
+                    f"{md5_pre_encrypt.decode()}  {os.path.basename(run.tar)}\n"
+                )
+        self._clean_tmp_files([run.tar, key, run.flag])
+        logger.info(
+            f"Encryption of run {run.name} is successfully done, removing run folder tarball"
+        )
+        return True
+
+    def _encrypt_run_chunked(self, run, force, key, key_encrypted):
+        """Archive a run in encrypted chunks, return True if it succeeded."""
+        run_dir = os.path.join(run.path, run.name)
+        archive = run.chunked_archive
+        tmp_files = [key_encrypted, key, run.flag]
+        if os.path.isdir(archive.path):
+            logger.warning(
+                f"Removing already existing chunked archive for run {run.name}, this is a precaution "
+                "to make sure the files were encrypted with correct key file"
+            )
+            shutil.rmtree(archive.path)
+            self._clean_tmp_files([key, key_encrypted, run.dst_key_encrypted])
+        # Generate random key to use as pasphrase
+        if not self._call_commands(
+            cmd1="gpg --gen-random 1 256", out_file=key, tmp_files=tmp_files
+        ):
+            logger.warning(f"Skipping run {run.name} and moving on")
+            return False
+        logger.info(f"Generated random phrase key for run {run.name}")
+        logger.info(f"Encrypting run {run.name} in chunks to {archive.path}")
+        try:
+            archive.create(run_dir, key, self.chunk_size, self.exclude_list)
+        except (OSError, RuntimeError) as e:
+            logger.error(f"Encryption of run {run.name} in chunks failed: {e}")
+            shutil.rmtree(archive.path, ignore_errors=True)
+            self._clean_tmp_files(tmp_files)
+            return False
+        # Decrypt the chunks and check them against the index
+        if not force:
+            logger.info("Checking the encrypted chunks against the index")
+            if not archive.verify(key, self.pdc_workers):
+                logger.error(
+                    f"Encrypted chunks of run {run.name} do not match the index. Will remove temp files and move on"
+                )
+                shutil.rmtree(archive.path, ignore_errors=True)
+                self._clean_tmp_files(tmp_files)
+                return False
+            logger.info("Encrypted chunks match the index")
+        # Encrypt and move the key file
+        if self._call_commands(
+            cmd1=f"gpg -e -r {self.gpg_receiver} -o {key_encrypted} {key}",
+            tmp_files=tmp_files,
+        ):
+            shutil.move(key_encrypted, run.dst_key_encrypted)
+        else:
+            logger.error("Encryption of key file failed, skipping run")
+            shutil.rmtree(archive.path, ignore_errors=True)
+            return False
+        self._clean_tmp_files([key, run.flag])
+        logger.info(f"Encryption of run {run.name} in chunks is successfully done")
+        return True
 
     @classmethod
     def pdc_put(cls, run):
         """Archive the collected runs to PDC."""
         bk = cls(run)
-        bk.collect_runs(ext=".tar.gpg", filter_by_ext=True)
+        chunked = bk.archive_format == "chunked"
+        bk.collect_runs(ext=".chunks" if chunked else ".tar.gpg", filter_by_ext=True)
         logger.info(f"In total, found {len(bk.runs)} run(s) to send PDC")
+        if bk.couch_info:
+            bk._prefetch_flowcells(bk.runs, bk.couch_info["db"])
         for run in bk.runs:
             run.flag = f"{run.name}.archiving"
             run.dst_key_encrypted = os.path.join(bk.keys_path, run.key_encrypted)
+            run.dst_md5 = os.path.join(bk.keys_path, run.md5)
             if run.path not in bk.archive_dirs.values():
                 logger.error(
                     "Given run is not in one of the archive directories {}. Kindly move the run {} to appropriate "
@@ -539,7 +903,10 @@ class backup_utils:
                         f"Run {run.name} is already being archived, so skipping now"
                     )
                     continue
-                if bk.file_in_pdc(run.tar_encrypted, silent=False) or bk.file_in_pdc(
+                archive_file = (
+                    run.chunked_archive.index_file if chunked else run.tar_encrypted
+                )
+                if bk.file_in_pdc(archive_file, silent=False) or bk.file_in_pdc(
                     run.dst_key_encrypted, silent=False
                 ):
                     logger.warning(
@@ -547,6 +914,9 @@ class backup_utils:
                     )
                     continue
                 open(run.flag, "w").close()
+                if chunked:
+                    bk._put_chunked_run(run)
+                    continue
                 logger.info(f"Sending file {run.tar_encrypted} to PDC")
                 if bk._call_commands(
                     cmd1=f"dsmc archive {run.tar_encrypted}", tmp_files=[run.flag]
@@ -555,6 +925,11 @@ class backup_utils:
                     if bk._call_commands(
                         cmd1=f"dsmc archive {run.dst_key_encrypted}",
                         tmp_files=[run.flag],
+                    ) and (
+                        not os.path.exists(run.dst_md5)
+                        or bk._call_commands(
+                            cmd1=f"dsmc archive {run.dst_md5}", tmp_files=[run.flag]
+                        )
                     ):
                         time.sleep(
                             5
@@ -569,8 +944,210 @@ class backup_utils:
                             if bk.couch_info:
                                 bk._log_pdc_statusdb(run.name)
                             bk._clean_tmp_files(
-                                [run.tar_encrypted, run.dst_key_encrypted, run.flag]
+                                [
+                                    run.tar_encrypted,
+                                    run.dst_key_encrypted,
+                                    run.dst_md5,
+                                    run.flag,
+                                ]
                             )
                             bk._move_run_to_archived(run)
                         continue
                 logger.warning(f"Sending file {run.tar_encrypted} to PDC failed")
+
+    def _put_chunked_run(self, run):
+        """Send the chunks of a run to PDC in parallel, with its key file."""
+        archive = run.chunked_archive
+        logger.info(f"Sending the chunks of {archive.path} to PDC")
+        if archive.upload(self.pdc_workers) and self._call_commands(
+            cmd1=f"dsmc archive {run.dst_key_encrypted}", tmp_files=[run.flag]
+        ):
+            time.sleep(5)  # give some time just in case 'dsmc' needs to settle
+            if self.file_in_pdc(archive.index_file) and self.file_in_pdc(
+                run.dst_key_encrypted
+            ):
+                logger.info(
+                    f"Successfully sent the chunks of run {run.name} to PDC, moving it locally from {run.path} to archived folder"
+                )
+                self.log_archived_run(archive.path)
+                if self.couch_info:
+                    self._log_pdc_statusdb(run.name)
+                shutil.rmtree(archive.path)
+                self._clean_tmp_files([run.dst_key_encrypted, run.flag])
+                self._move_run_to_archived(run)
+                return True
+        logger.warning(f"Sending the chunks of run {run.name} to PDC failed")
+        self._clean_tmp_files([run.flag])
+        return False
+
+    @classmethod
+    def restore_runs(cls, runs, outdir, files=None):
+        """Restore archived runs from PDC to the given directory.
+
+        The files of a run are retrieved from PDC in parallel to a directory
+        next to the restored run, then decrypted, checked and extracted in one
+        pass, so the output directory needs room for the encrypted tarball
+        as well. Runs archived in chunks can be restored partly, by giving
+        the files or directories to restore.
+        """
+        bk = cls()
+        outdir = os.path.abspath(outdir)
+        with ThreadPoolExecutor(max_workers=bk.max_encryption_jobs) as pool:
+            restored = list(
+                pool.map(lambda run: bk._restore_run(run, outdir, files), runs)
+            )
+        failed_runs = [run for run, ok in zip(runs, restored) if not ok]
+        if failed_runs:
+            logger.error(f"Restore failed for run(s) {', '.join(failed_runs)}")
+            raise SystemExit(1)
+
+    def _restore_run(self, run_name, outdir, files=None):
+        """Restore one run from PDC, return True if it succeeded."""
+        run_name = os.path.basename(run_name.rstrip("/")).split(".", 1)[0]
+        run_type = self._get_run_type(run_name)
+        if run_type not in self.archive_dirs:
+            logger.error(f"Could not find the archive directory of run {run_name}")
+            return False
+        archive_path = self.archive_dirs[run_type]
+        run = run_vars(os.path.join(archive_path, run_name), archive_path)
+        run.dst_key_encrypted = os.path.join(self.keys_path, run.key_encrypted)
+        run.dst_md5 = os.path.join(self.keys_path, run.md5)
+        restore_dir = os.path.join(outdir, f".{run.name}.restore")
+        os.makedirs(restore_dir, exist_ok=True)
+        try:
+            if self.file_in_pdc(run.chunked_archive.index_file):
+                return self._restore_chunked_run(run, restore_dir, outdir, files)
+            elif files:
+                logger.error(
+                    f"Run {run.name} is not archived in chunks, so it can only be restored as a whole"
+                )
+                return False
+            return self._restore_tar_run(run, restore_dir, outdir)
+        finally:
+            shutil.rmtree(restore_dir, ignore_errors=True)
+
+    def _restore_tar_run(self, run, restore_dir, outdir):
+        """Retrieve the encrypted tarball of a run, then decrypt, check and
+        extract it in one streaming pass.
+
+        dsmc retrieves to regular files only, so the whole tarball is first
+        written to restore_dir and only the steps after it are streamed.
+        """
+        to_retrieve = [run.tar_encrypted, run.dst_key_encrypted]
+        if self.file_in_pdc(run.dst_md5):
+            to_retrieve.append(run.dst_md5)
+        logger.info(f"Retrieving the files of run {run.name} from PDC")
+        if not call_dsmc("retrieve", to_retrieve, self.pdc_workers, restore_dir):
+            return False
+        key = self._decrypt_key(run, restore_dir)
+        if key is None:
+            return False
+        md5_file = os.path.join(restore_dir, run.md5)
+        expected_md5 = None
+        if os.path.exists(md5_file):
+            with open(md5_file) as md5_file:
+                expected_md5 = md5_file.read().split()[0]
+        else:
+            logger.warning(f"No md5sum was archived for run {run.name}")
+
+        logger.info(f"Decrypting and extracting run {run.name} to {outdir}")
+        gpg = tar = None
+        md5 = hashlib.md5()
+        # the errors go to files, a full stderr pipe would block the processes
+        gpg_err_file = tempfile.TemporaryFile(dir=restore_dir)
+        tar_err_file = tempfile.TemporaryFile(dir=restore_dir)
+        try:
+            gpg = sp.Popen(
+                [
+                    "gpg",
+                    "--decrypt",
+                    "--batch",
+                    "--passphrase-file",
+                    key,
+                    os.path.join(restore_dir, os.path.basename(run.tar_encrypted)),
+                ],
+                stdout=sp.PIPE,
+                stderr=gpg_err_file,
+            )
+            tar = sp.Popen(
+                ["tar", "-x", "-C", outdir], stdin=sp.PIPE, stderr=tar_err_file
+            )
+            try:
+                for block in iter(lambda: gpg.stdout.read(RESTORE_BUFFER_SIZE), b""):
+                    md5.update(block)
+                    tar.stdin.write(block)
+                tar.stdin.close()
+            except BrokenPipeError:
+                gpg.kill()
+            failed = gpg.wait() != 0 or tar.wait() != 0
+            gpg_err_file.seek(0)
+            gpg_err = gpg_err_file.read().decode(errors="replace").strip()
+            tar_err_file.seek(0)
+            tar_err = tar_err_file.read().decode(errors="replace").strip()
+        except OSError as e:
+            for process in (gpg, tar):
+                if process is not None:
+                    process.kill()
+                    process.wait()
+            logger.error(f"Restore of run {run.name} failed: {e}")
+            return False
+        finally:
+            gpg_err_file.close()
+            tar_err_file.close()
+        if failed:
+            logger.error(
+                f'Restore of run {run.name} failed with the errors "{gpg_err}" and "{tar_err}"'
+            )
+            return False
+        if expected_md5 and md5.hexdigest() != expected_md5:
+            logger.error(
+                f"md5sum of the restored tarball {md5.hexdigest()} does not match the archived one {expected_md5}, removing restored run {run.name}"
+            )
+            shutil.rmtree(os.path.join(outdir, run.name), ignore_errors=True)
+            return False
+        logger.info(f"Run {run.name} is successfully restored to {outdir}")
+        return True
+
+    def _restore_chunked_run(self, run, restore_dir, outdir, files=None):
+        """Retrieve the chunks of a run holding the given files, or all of them,
+        and extract them."""
+        logger.info(f"Retrieving the index of run {run.name} from PDC")
+        source_dir = os.path.dirname(run.chunked_archive.path)
+        archive = ChunkedArchive(restore_dir, run.name)
+        if not (
+            call_dsmc("retrieve", [run.dst_key_encrypted], 1, restore_dir)
+            and archive.retrieve(source_dir, [])
+        ):
+            return False
+        key = self._decrypt_key(run, restore_dir)
+        if key is None:
+            return False
+        try:
+            index = archive.load_index(key)
+            entries, chunk_numbers = archive.select(index, files)
+            if not entries:
+                logger.error(
+                    f"None of the given files are in the archive of {run.name}"
+                )
+                return False
+            logger.info(
+                f"Retrieving {len(chunk_numbers)} of the {len(index['chunks'])} chunks of run {run.name} from PDC"
+            )
+            if not archive.retrieve(source_dir, chunk_numbers, self.pdc_workers):
+                return False
+            archive.extract(key, outdir, files)
+        except (ValueError, tarfile.TarError, OSError) as e:
+            logger.error(f"Restore of run {run.name} failed: {e}")
+            return False
+        logger.info(f"Run {run.name} is successfully restored to {outdir}")
+        return True
+
+    def _decrypt_key(self, run, restore_dir):
+        """Decrypt the retrieved key file of a run, return its path."""
+        key = os.path.join(restore_dir, run.key)
+        if self._call_commands(
+            cmd1=f"gpg --decrypt --batch --yes -o {key} {os.path.join(restore_dir, run.key_encrypted)}"
+        ):
+            return key
+        logger.error(f"Decryption of the key file of run {run.name} failed")
+        return None
@@ -0,0 +1,418 @@
+"""Chunked, encrypted run archives with a signed index of the archived files."""
+
+import fnmatch
+import hashlib
+import hmac
+import json
+import logging
+import os
+import subprocess as sp
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+INDEX_VERSION = 1
+DEFAULT_CHUNK_SIZE = 64 * 1024**3
+READ_SIZE = 1024 * 1024
+
+
+class ChunkedArchive:
+    """Archive of a run as a tar stream split into chunks of a fixed size, each
+    encrypted with gpg using the passphrase of the run key file.
+
+    The index lists the chunks with the sha256 of their content and the offset
+    of every file in the tar stream. It is signed with a HMAC of the key file,
+    so that a restore can trust it to fetch only the chunks holding the files
+    it needs. Chunks can be sent to and retrieved from PDC in parallel.
+
+    Layout of the archive, next to the run directory:
+        <run>.chunks/<run>.index.json
+        <run>.chunks/<run>.000000.gpg
+        <run>.chunks/<run>.000001.gpg
+        ...
+    """
+
+    def __init__(self, archive_dir, name):
+        self.name = name
+        self.path = os.path.join(archive_dir, f"{name}.chunks")
+        self.index_file = os.path.join(self.path, f"{name}.index.json")
+
+    def chunk_file(self, number):
+        return os.path.join(self.path, f"{self.name}.{number:06d}.gpg")
+
+    def exists(self):
+        return os.path.exists(self.index_file)
+
+    def create(self, run_path, key_file, chunk_size=DEFAULT_CHUNK_SIZE, exclude=[]):
+        """Archive the run directory in encrypted chunks and write the signed index."""
+        os.makedirs(self.path, exist_ok=True)
+        run_parent = os.path.dirname(os.path.abspath(run_path))
+        files = []
+        with _ChunkWriter(self, key_file, chunk_size) as writer:
+            with tarfile.open(
+                fileobj=writer, mode="w|", format=tarfile.PAX_FORMAT
+            ) as tar:
+                for file_path in _walk_run(run_path, exclude):
+                    arcname = os.path.relpath(file_path, run_parent)
+                    offset = tar.offset
+                    tar.add(file_path, arcname=arcname, recursive=False)
+                    files.append(
+                        {"name": arcname, "offset": offset, "size": tar.offset - offset}
+                    )
+        index = {
+            "version": INDEX_VERSION,
+            "run": self.name,
+            "chunk_size": chunk_size,
+            "chunks": writer.chunks,
+            "files": files,
+        }
+        with open(key_file, "rb") as key:
+            signature = _sign(index, key.read())
+        with open(self.index_file, "w") as index_file:
+            json.dump({"index": index, "hmac_sha256": signature}, index_file)
+        return index
+
+    def load_index(self, key_file):
+        """Read the index and check its signature with the run key file."""
+        with open(self.index_file) as index_file:
+            signed_index = json.load(index_file)
+        with open(key_file, "rb") as key:
+            signature = _sign(signed_index["index"], key.read())
+        if not hmac.compare_digest(signature, signed_index["hmac_sha256"]):
+            raise ValueError(f"Signature of the index {self.index_file} does not match")
+        return signed_index["index"]
+
+    def select(self, index, names=None):
+        """Return the index entries of the given files or directories, all files
+        if no names are given, with the numbers of the chunks holding them."""
+        if names:
+            names = [n.rstrip("/") for n in names]
+            entries = [
+                f
+                for f in index["files"]
+                if any(f["name"] == n or f["name"].startswith(f"{n}/") for n in names)
+            ]
+        else:
+            entries = list(index["files"])
+        chunk_numbers = set()
+        for entry in entries:
+            first = entry["offset"] // index["chunk_size"]
+            last = (entry["offset"] + entry["size"] - 1) // index["chunk_size"]
+            chunk_numbers.update(range(first, last + 1))
+        return entries, sorted(chunk_numbers)
+
+    def extract(self, key_file, dest_dir, names=None):
+        """Extract the given files, or the whole run, from the chunks on disk.
+
+        Only the chunks holding the files are decrypted, and their content is
+        checked against the sha256 in the index.
+        """
+        index = self.load_index(key_file)
+        entries, _ = self.select(index, names)
+        for start, end in _merge_ranges(entries):
+            with _RangeReader(self, index, key_file, start, end) as reader:
+                with tarfile.open(fileobj=reader, mode="r|") as tar:
+                    tar.extractall(dest_dir, filter="data")
+        return entries
+
+    def verify(self, key_file, max_workers=4):
+        """Decrypt every chunk and check its content against the index."""
+        index = self.load_index(key_file)
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            return all(
+                pool.map(
+                    lambda n: _check_chunk(self, index, key_file, n),
+                    range(len(index["chunks"])),
+                )
+            )
+
+    def upload(self, max_workers=4):
+        """Send the chunks and the index to PDC in parallel, return True if all
+        of them were archived."""
+        files = [self.chunk_file(n) for n in range(len(self._chunk_names()))]
+        return call_dsmc("archive", files + [self.index_file], max_workers)
+
+    def retrieve(self, source_dir, chunk_numbers=None, max_workers=4):
+        """Get back the index and the given chunks, or all of them, from PDC.
+
+        :param str source_dir: Directory the archive was sent to PDC from
+        """
+        source = ChunkedArchive(source_dir, self.name)
+        os.makedirs(self.path, exist_ok=True)
+        if not call_dsmc("retrieve", [source.index_file], 1, self.path):
+            return False
+        if chunk_numbers is None:
+            chunk_numbers = range(len(self._chunk_names()))
+        return call_dsmc(
+            "retrieve",
+            [source.chunk_file(n) for n in chunk_numbers],
+            max_workers,
+            self.path,
+        )
+
+    def _chunk_names(self):
+        """Chunks listed in the index, without checking its signature."""
+        with open(self.index_file) as index_file:
+            return json.load(index_file)["index"]["chunks"]
+
+
+class _ChunkWriter:
+    """File-like object splitting what is written to it into chunks that are
+    each piped to a gpg process."""
+
+    def __init__(self, archive, key_file, chunk_size):
+        self.archive = archive
+        self.key_file = key_file
+        self.chunk_size = chunk_size
+        self.chunks = []
+        self.offset = 0
+        self._gpg = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self._finish_chunk()
+        elif self._gpg is not None:
+            self._gpg.kill()
+            self._gpg.wait()
+
+    def write(self, data):
+        view = memoryview(data)
+        while view:
+            if self._gpg is None:
+                self._start_chunk()
+            n_bytes = min(len(view), self.chunk_size - self._size)
+            self._gpg.stdin.write(view[:n_bytes])
+            self._hasher.update(view[:n_bytes])
+            self._size += n_bytes
+            view = view[n_bytes:]
+            if self._size == self.chunk_size:
+                self._finish_chunk()
+        return len(data)
+
+    def _start_chunk(self):
+        self._chunk_file = self.archive.chunk_file(len(self.chunks))
+        self._gpg = sp.Popen(
+            [
+                "gpg",
+                "--symmetric",
+                "--cipher-algo",
+                "aes256",
+                "--passphrase-file",
+                self.key_file,
+                "--batch",
+                "--yes",
+                "--compress-algo",
+                "none",
+                "-o",
+                self._chunk_file,
+            ],
+            stdin=sp.PIPE,
+            stderr=sp.PIPE,
+        )
+        self._hasher = hashlib.sha256()
+        self._size = 0
+
+    def _finish_chunk(self):
+        if self._gpg is None:
+            return
+        _, err = self._gpg.communicate()
+        if self._gpg.returncode != 0:
+            raise RuntimeError(
+                f"Encryption of chunk {self._chunk_file} failed with the error {err}"
+            )
+        self.chunks.append(
+            {
+                "file": os.path.basename(self._chunk_file),
+                "offset": self.offset,
+                "size": self._size,
+                "sha256": self._hasher.hexdigest(),
+            }
+        )
+        self.offset += self._size
+        self._gpg = None
+
+
+class _RangeReader:
+    """File-like object reading a range of the tar stream from the decrypted
+    chunks, checking the content of every chunk it goes through."""
+
+    def __init__(self, archive, index, key_file, start, end):
+        self.archive = archive
+        self.index = index
+        self.key_file = key_file
+        self.position = start
+        self.end = end
+        self._chunk_number = None
+        self._gpg = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if self._gpg is not None:
+            self._gpg.kill()
+            self._gpg.wait()
+
+    def read(self, size=-1):
+        if self.position >= self.end:
+            return b""
+        if size < 0 or size > self.end - self.position:
+            size = self.end - self.position
+        chunk_number = self.position // self.index["chunk_size"]
+        if chunk_number != self._chunk_number:
+            self._open_chunk(chunk_number)
+        chunk = self.index["chunks"][chunk_number]
+        size = min(size, chunk["offset"] + chunk["size"] - self.position)
+        data = self._read_chunk(size)
+        self.position += len(data)
+        if (
+            self.position == chunk["offset"] + chunk["size"]
+            or self.position == self.end
+        ):
+            self._close_chunk()
+        return data
+
+    def _open_chunk(self, chunk_number):
+        self._close_chunk()
+        self._chunk_number = chunk_number
+        self._gpg = _decrypt(self.archive.chunk_file(chunk_number), self.key_file)
+        self._hasher = hashlib.sha256()
+        # skip to the position in the chunk
+        self._skipped = 0
+        to_skip = self.position - self.index["chunks"][chunk_number]["offset"]
+        while to_skip:
+            data = self._gpg.stdout.read(min(to_skip, READ_SIZE))
+            if not data:
+                raise ValueError(
+                    f"Chunk {chunk_number} of {self.archive.name} is truncated"
+                )
+            self._hasher.update(data)
+            to_skip -= len(data)
+
+    def _read_chunk(self, size):
+        data = self._gpg.stdout.read(size)
+        if len(data) != size:
+            raise ValueError(
+                f"Chunk {self._chunk_number} of {self.archive.name} is truncated"
+            )
+        self._hasher.update(data)
+        return data
+
+    def _close_chunk(self):
+        """Read the rest of the chunk to check its content."""
+        if self._gpg is None:
+            return
+        for data in iter(lambda: self._gpg.stdout.read(READ_SIZE), b""):
+            self._hasher.update(data)
+        self._gpg.stdout.close()
+        err = self._gpg.stderr.read()
+        self._gpg.stderr.close()
+        chunk_file = self.archive.chunk_file(self._chunk_number)
+        if self._gpg.wait() != 0:
+            self._gpg = None
+            raise ValueError(f"Decryption of {chunk_file} failed with the error {err}")
+        self._gpg = None
+        if (
+            self._hasher.hexdigest()
+            != self.index["chunks"][self._chunk_number]["sha256"]
+        ):
+            raise ValueError(f"Content of {chunk_file} does not match the index")
+
+
+def _walk_run(run_path, exclude):
+    """Yield the paths of the run directory and of everything in it, in a
+    stable order and with directories before their content, leaving out the
+    ones matching the exclude patterns like 'tar --exclude' would."""
+    run_parent = os.path.dirname(os.path.abspath(run_path))
+    dirs_to_walk = [run_path]
+    while dirs_to_walk:
+        path = dirs_to_walk.pop()
+        yield path
+        if not os.path.isdir(path) or os.path.islink(path):
+            continue
+        with os.scandir(path) as entries:
+            names = sorted(e.name for e in entries)
+        for name in reversed(names):
+            entry_path = os.path.join(path, name)
+            rel_path = os.path.relpath(entry_path, run_parent)
+            if not any(
+                fnmatch.fnmatch(name, p) or fnmatch.fnmatch(rel_path, p)
+                for p in exclude
+            ):
+                dirs_to_walk.append(entry_path)
+
+
+def _merge_ranges(entries):
+    """Merge the tar stream ranges of the entries that follow each other."""
+    ranges = []
+    for entry in sorted(entries, key=lambda e: e["offset"]):
+        start, end = entry["offset"], entry["offset"] + entry["size"]
+        if ranges and ranges[-1][1] == start:
+            ranges[-1][1] = end
+        else:
+            ranges.append([start, end])
+    return ranges
+
+
+def _sign(index, key):
+    return hmac.new(
+        key, json.dumps(index, sort_keys=True).encode(), hashlib.sha256
+    ).hexdigest()
+
+
+def _decrypt(chunk_file, key_file):
+    return sp.Popen(
+        [
+            "gpg",
+            "--decrypt",
+            "--batch",
+            "--passphrase-file",
+            key_file,
+            chunk_file,
+        ],
+        stdout=sp.PIPE,
+        stderr=sp.PIPE,
+    )
+
+
+def _check_chunk(archive, index, key_file, chunk_number):
+    chunk = index["chunks"][chunk_number]
+    try:
+        with _RangeReader(
+            archive, index, key_file, chunk["offset"], chunk["offset"] + chunk["size"]
+        ) as reader:
+            while reader.read(READ_SIZE):
+                pass
+    except ValueError as e:
+        logger.error(e)
+        return False
+    return True
+
+
+def call_dsmc(action, files, max_workers=4, dest_dir=None):
+    """Call 'dsmc archive' or 'dsmc retrieve' on each file, in parallel, and
+    return True if all calls succeeded.
+
+    :param str dest_dir: Directory to retrieve the files to, instead of their
+        original location
+    """
+
+    def call(file_path):
+        cmd = ["dsmc", action, file_path]
+        if dest_dir:
+            cmd.append(os.path.join(dest_dir, ""))
+        proc = sp.run(cmd, capture_output=True)
+        if proc.returncode != 0:
+            logger.error(
+                'Command "{}" failed with the error "{}"'.format(
+                    " ".join(cmd), proc.stderr
+                )
+            )
+        return proc.returncode == 0
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return all(list(pool.map(call, files)))
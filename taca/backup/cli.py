@@ -42,23 +42,34 @@ def put_data(ctx, run):
     bkut.pdc_put(run)
 
 
-@backup.command(name="get_data")
+@backup.command()
 @click.option(
     "-r",
     "--run",
+    "runs",
     required=True,
-    help="A run name (without extension) to download from PDC",
+    multiple=True,
+    help="A run name to restore from PDC, can be given multiple times",
 )
 @click.option(
     "-o",
     "--outdir",
+    required=True,
     type=click.Path(exists=True, file_okay=False, writable=True),
-    help="Optional directory name to save the downloaded file. Directory should exist",
+    help="Directory to restore the runs in",
+)
+@click.option(
+    "-f",
+    "--file",
+    "files",
+    multiple=True,
+    help="Only restore this file or directory of the run, given as a path starting "
+    "with the run name. Only for runs archived in chunks, can be given multiple times",
 )
 @click.pass_context
-def get_data(ctx, run, outdir):
-    ## W I P ##
-    raise NotImplementedError
+def restore(ctx, runs, outdir, files):
+    """Retrieve, decrypt, check and extract archived runs from PDC."""
+    bkut.restore_runs(runs, outdir, files)
 
 
 @backup.command()
@@ -1,18 +1,83 @@
 """Storage methods and utilities"""
 
+import csv
+import fnmatch
 import logging
 import os
 import re
+import shutil
+import time
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from glob import glob
 
+from taca.cleanup.inventory import open_inventory
+from taca.cleanup.removal import open_file_remover
 from taca.utils import filesystem, misc, statusdb
 from taca.utils.config import CONFIG, load_config
 
 logger = logging.getLogger(__name__)
 
 
+def cleanup_processing(seconds, dry_run=False):
+    """Remove old runs from the nosync and archived directories of the
+    preprocessing server, once they are both transferred to the analysis
+    cluster and archived to PDC.
+
+    :param int seconds: Days/hours converted as seconds to consider a run to be old
+    :param bool dry_run: Will summarize what is going to be done without really doing it
+
+    Example format for entry in the taca config file
+    cleanup:
+        processing:
+            ##directories where processed runs are kept, can give multiple paths
+            dirs:
+                - path/to/nosync
+                - path/to/nosync/archived
+            ##logs of the runs transferred to the analysis cluster
+            transfer_logs:
+                - path/to/transfer.tsv
+            ##log of the runs archived to PDC, defaults to the one used by backup
+            archive_log: path/to/archived_runs.tsv
+    """
+    try:
+        config = CONFIG["cleanup"]["processing"]
+        run_roots = config["dirs"]
+        transfer_logs = config["transfer_logs"]
+        archive_log = config.get("archive_log") or CONFIG["backup"]["archive_log"]
+    except KeyError as e:
+        logger.error(
+            f"Config file is missing the key {str(e)}, make sure it has all required information"
+        )
+        raise SystemExit
+
+    # read the ledgers once for all runs
+    transferred_runs = set()
+    for transfer_log in transfer_logs:
+        transferred_runs.update(_read_run_log(transfer_log))
+    archived_runs = {
+        os.path.basename(r).split(".", 1)[0] for r in _read_run_log(archive_log)
+    }
+
+    old_runs = collect_old_runs(run_roots, time.time() - seconds)
+    logger.info(f"Found {len(old_runs)} runs older than the given time")
+    for run_path in old_runs:
+        run = os.path.basename(run_path)
+        if run not in transferred_runs:
+            logger.warning(f"Run {run} is not in the transfer logs, skipping it")
+            continue
+        if run not in archived_runs:
+            logger.warning(f"Run {run} is not in the PDC archive log, skipping it")
+            continue
+        logger.info(f"Removing run {run_path}")
+        if not dry_run:
+            try:
+                shutil.rmtree(run_path)
+            except OSError as e:
+                logger.warning(f'Could not remove run {run_path} due to "{e}"')
+
+
 def cleanup_miarka(
     days_fastq,
     days_analysis,
@@ -53,6 +118,11 @@ def cleanup_miarka(
                 files_to_remove:
                     piper_ngi:
                         - "*.bam"
+            ##optional, see taca.cleanup.removal.FileRemover
+            removal:
+                journal: path/to/cleanup_removal.journal
+                max_workers: 8
+                max_rate: 200
     """
     try:
         config = CONFIG["cleanup"]["miarka"]
@@ -62,6 +132,7 @@ def cleanup_miarka(
         data_dir = config["data_dir"]
         analysis_dir = config["analysis"]["root"]
         analysis_data_to_remove = config["analysis"]["files_to_remove"]
+        inventory = open_inventory(config)
         if date:
             date = datetime.strptime(date, "%Y-%m-%d")
     except KeyError as e:
@@ -75,313 +146,419 @@ def cleanup_miarka(
         )
         raise SystemExit
 
-    # make a connection for project db
-    db_config = load_config(status_db_config)
-    pcon = statusdb.ProjectSummaryConnection(db_config.get("statusdb"))
-    assert pcon, "Could not connect to project database in StatusDB"
-
-    # make exclude project list if provided
-    exclude_list = []
-    if exclude_projects:
-        if os.path.isfile(exclude_projects):
-            with open(exclude_projects) as in_file:
-                exclude_list.extend([p.strip() for p in in_file.readlines()])
-        else:
-            exclude_list.extend(exclude_projects.split(","))
-        # sanity check for mentioned project to exculde or valid
-        invalid_projects = [
-            p
-            for p in exclude_list
-            if p not in pcon.id_view.keys() and p not in pcon.name_view.keys()
-        ]
-        if invalid_projects:
-            logger.error(
-                '"--exclude_projects" was called with some invalid projects "{}", '
-                "provide valid project name/id".format(",".join(invalid_projects))
+    try:
+        # make a connection for project db
+        db_config = load_config(status_db_config)
+        pcon = statusdb.ProjectSummaryConnection(db_config.get("statusdb"))
+        assert pcon, "Could not connect to project database in StatusDB"
+
+        # make exclude project list if provided
+        exclude_list = []
+        if exclude_projects:
+            if os.path.isfile(exclude_projects):
+                with open(exclude_projects) as in_file:
+                    exclude_list.extend([p.strip() for p in in_file.readlines()])
+            else:
+                exclude_list.extend(exclude_projects.split(","))
+            # sanity check for mentioned project to exculde or valid
+            exclude_docs_by_id = pcon.get_entries(exclude_list, use_id_view=True)
+            exclude_docs_by_name = pcon.get_entries(exclude_list)
+            invalid_projects = [
+                p
+                for p in exclude_list
+                if exclude_docs_by_id[p] is None and exclude_docs_by_name[p] is None
+            ]
+            if invalid_projects:
+                logger.error(
+                    '"--exclude_projects" was called with some invalid projects "{}", '
+                    "provide valid project name/id".format(",".join(invalid_projects))
+                )
+                raise SystemExit
+
+        # compile list for project to delete
+        project_clean_list, project_processed_list = ({}, [])
+        # closed projects to record in the inventory, with the size of all their data
+        inventory_projects = {}
+        if not list_only and not clean_undetermined:
+            logger.info("Building initial project list for removing data...")
+        if only_fastq:
+            logger.info(
+                'Option "--only_fastq" is given, so will not look for analysis data'
+            )
+        elif only_analysis:
+            logger.info(
+                'Option "--only_analysis" is given, so will not look for fastq data'
             )
-            raise SystemExit
-
-    # compile list for project to delete
-    project_clean_list, project_processed_list = ({}, [])
-    if not list_only and not clean_undetermined:
-        logger.info("Building initial project list for removing data...")
-    if only_fastq:
-        logger.info(
-            'Option "--only_fastq" is given, so will not look for analysis data'
-        )
-    elif only_analysis:
-        logger.info(
-            'Option "--only_analysis" is given, so will not look for fastq data'
-        )
 
-    if clean_undetermined:
-        all_undet_files = []
-        for flowcell_dir in flowcell_dir_root:
-            for fc in [
-                d
-                for d in os.listdir(flowcell_dir)
-                if re.match(filesystem.RUN_RE_ILLUMINA, d)
-            ]:
-                fc_abs_path = os.path.join(flowcell_dir, fc)
-                with filesystem.chdir(fc_abs_path):
-                    if not os.path.exists(flowcell_project_source):
-                        logger.warn(
-                            f'Flowcell {fc} does not contain a "{flowcell_project_source}" directory'
-                        )
-                        continue
-                    projects_in_fc = [
-                        d
-                        for d in os.listdir(flowcell_project_source)
-                        if re.match(r"^[A-Z]+[_\.]+[A-Za-z]+_\d\d_\d\d$", d)
-                        and not os.path.exists(
-                            os.path.join(flowcell_project_source, d, "cleaned")
-                        )
-                    ]
-                    # the above check looked for project directories and also that are not cleaned
-                    # so if it could not find any project, means there is no project diretory at all
-                    # or all the project directory is already cleaned. Then we can remove the undet
-                    if len(projects_in_fc) > 0:
-                        continue
-                    fc_undet_files = glob(
-                        os.path.join(flowcell_project_source, flowcell_undet_files)
-                    )
-                    if fc_undet_files:
-                        logger.info(
-                            f"All projects was cleaned for FC {fc}, found {len(fc_undet_files)} undeterminded files"
-                        )
-                        all_undet_files.extend(
-                            list(map(os.path.abspath, fc_undet_files))
+        if clean_undetermined:
+            all_undet_files = []
+            for flowcell_dir in flowcell_dir_root:
+                for fc in [
+                    d
+                    for d in os.listdir(flowcell_dir)
+                    if re.match(filesystem.RUN_RE_ILLUMINA, d)
+                ]:
+                    fc_abs_path = os.path.join(flowcell_dir, fc)
+                    with filesystem.chdir(fc_abs_path):
+                        if not os.path.exists(flowcell_project_source):
+                            logger.warn(
+                                f'Flowcell {fc} does not contain a "{flowcell_project_source}" directory'
+                            )
+                            continue
+                        projects_in_fc = [
+                            d
+                            for d in os.listdir(flowcell_project_source)
+                            if re.match(r"^[A-Z]+[_\.]+[A-Za-z]+_\d\d_\d\d$", d)
+                            and not os.path.exists(
+                                os.path.join(flowcell_project_source, d, "cleaned")
+                            )
+                        ]
+                        # the above check looked for project directories and also that are not cleaned
+                        # so if it could not find any project, means there is no project diretory at all
+                        # or all the project directory is already cleaned. Then we can remove the undet
+                        if len(projects_in_fc) > 0:
+                            continue
+                        fc_undet_files = glob(
+                            os.path.join(flowcell_project_source, flowcell_undet_files)
                         )
-        if all_undet_files:
-            undet_size = _def_get_size_unit(sum(map(os.path.getsize, all_undet_files)))
-            if misc.query_yes_no(
-                f"In total found {len(all_undet_files)} undetermined files which are {undet_size} in size, delete now ?",
-                default="no",
-            ):
-                _remove_files(all_undet_files)
-        return
-    elif only_analysis:
-        for pid in [
-            d
-            for d in os.listdir(analysis_dir)
-            if re.match(r"^P\d+$", d)
-            and not os.path.exists(os.path.join(analysis_dir, d, "cleaned"))
-        ]:
-            os.path.join(analysis_dir, pid)
-            proj_info = get_closed_proj_info(
-                pid, pcon.get_entry(pid, use_id_view=True), date
-            )
-            if proj_info and proj_info["closed_days"] >= days_analysis:
-                # move on if this project has to be excluded
+                        if fc_undet_files:
+                            logger.info(
+                                f"All projects was cleaned for FC {fc}, found {len(fc_undet_files)} undeterminded files"
+                            )
+                            all_undet_files.extend(
+                                list(map(os.path.abspath, fc_undet_files))
+                            )
+            if all_undet_files:
+                undet_size = _def_get_size_unit(_get_total_size(all_undet_files))
+                if misc.query_yes_no(
+                    f"In total found {len(all_undet_files)} undetermined files which are {undet_size} in size, delete now ?",
+                    default="no",
+                ):
+                    remover = open_file_remover(config)
+                    remover.remove_files(all_undet_files)
+                    _log_removal(remover)
+            return
+        elif only_analysis:
+            pids = [
+                d
+                for d in os.listdir(analysis_dir)
+                if re.match(r"^P\d+$", d)
+                and not os.path.exists(os.path.join(analysis_dir, d, "cleaned"))
+            ]
+            # fetch the documents of all projects at once
+            pdocs = pcon.get_entries(pids, use_id_view=True)
+            for pid in pids:
+                proj_info = get_closed_proj_info(pid, pdocs[pid], date)
+                # move on if this project is not closed or has to be excluded
                 if (
-                    proj_info["name"] in exclude_list
+                    not proj_info
+                    or proj_info["name"] in exclude_list
                     or proj_info["pid"] in exclude_list
                 ):
                     continue
+                if proj_info["closed_days"] < days_analysis and inventory is None:
+                    continue
                 analysis_data, analysis_size = collect_analysis_data_miarka(
-                    pid, analysis_dir, analysis_data_to_remove
+                    pid, analysis_dir, analysis_data_to_remove, inventory=inventory
                 )
-                proj_info["analysis_to_remove"] = analysis_data
-                proj_info["analysis_size"] = analysis_size
-                proj_info["fastq_to_remove"] = "not_selected"
-                proj_info["fastq_size"] = 0
-                project_clean_list[proj_info["name"]] = proj_info
-    else:
-        for flowcell_dir in flowcell_dir_root:
-            for fc in [
-                d
-                for d in os.listdir(flowcell_dir)
-                if re.match(filesystem.RUN_RE_ILLUMINA, d)
-            ]:
-                fc_abs_path = os.path.join(flowcell_dir, fc)
-                with filesystem.chdir(fc_abs_path):
-                    if not os.path.exists(flowcell_project_source):
-                        logger.warn(
-                            f'Flowcell {fc} do not contain a "{flowcell_project_source}" direcotry'
-                        )
+                if inventory is not None:
+                    # fastq data is not looked at, keep its recorded size
+                    inventory_projects[proj_info["name"]] = dict(
+                        proj_info, fastq_size=None, analysis_size=analysis_size
+                    )
+                if proj_info["closed_days"] >= days_analysis:
+                    proj_info["analysis_to_remove"] = analysis_data
+                    proj_info["analysis_size"] = analysis_size
+                    proj_info["fastq_to_remove"] = "not_selected"
+                    proj_info["fastq_size"] = 0
+                    project_clean_list[proj_info["name"]] = proj_info
+        else:
+            # list the projects of all flowcells first, to fetch their documents at once
+            fc_projects = []
+            for flowcell_dir in flowcell_dir_root:
+                for fc in [
+                    d
+                    for d in os.listdir(flowcell_dir)
+                    if re.match(filesystem.RUN_RE_ILLUMINA, d)
+                ]:
+                    fc_abs_path = os.path.join(flowcell_dir, fc)
+                    with filesystem.chdir(fc_abs_path):
+                        if not os.path.exists(flowcell_project_source):
+                            logger.warn(
+                                f'Flowcell {fc} do not contain a "{flowcell_project_source}" direcotry'
+                            )
+                            continue
+                        projects_in_fc = [
+                            d
+                            for d in os.listdir(flowcell_project_source)
+                            if re.match(r"^[A-Z]+[_\.]+[A-Za-z0-9]+_\d\d_\d\d$", d)
+                            and not os.path.exists(
+                                os.path.join(flowcell_project_source, d, "cleaned")
+                            )
+                        ]
+                    fc_projects.append((fc, fc_abs_path, projects_in_fc))
+            pdocs = pcon.get_entries(
+                re.sub(r"_+", ".", _proj, 1)
+                for _, _, projects_in_fc in fc_projects
+                for _proj in projects_in_fc
+            )
+
+            for fc, fc_abs_path, projects_in_fc in fc_projects:
+                for _proj in projects_in_fc:
+                    proj = re.sub(r"_+", ".", _proj, 1)
+                    # if a project is already processed no need of fetching it again from status db
+                    if proj in project_processed_list:
+                        # if the project is closed more than threshold days collect the fastq files from FC
+                        # no need of looking for analysis data as they would have been collected in the first time
+                        if (
+                            proj in project_clean_list
+                            and project_clean_list[proj]["closed_days"] >= days_fastq
+                        ):
+                            fc_fq_files, fq_size = collect_fastq_data_miarka(
+                                fc_abs_path,
+                                os.path.join(flowcell_project_source, _proj),
+                                inventory=inventory,
+                            )
+                            project_clean_list[proj]["fastq_to_remove"]["flowcells"][
+                                fc
+                            ] = fc_fq_files["flowcells"][fc]
+                            project_clean_list[proj]["fastq_size"] += fq_size
+                            if proj in inventory_projects:
+                                inventory_projects[proj]["fastq_size"] += fq_size
+                        elif proj in inventory_projects:
+                            _, fq_size = collect_fastq_data_miarka(
+                                fc_abs_path,
+                                os.path.join(flowcell_project_source, _proj),
+                                inventory=inventory,
+                            )
+                            inventory_projects[proj]["fastq_size"] += fq_size
                         continue
-                    projects_in_fc = [
-                        d
-                        for d in os.listdir(flowcell_project_source)
-                        if re.match(r"^[A-Z]+[_\.]+[A-Za-z0-9]+_\d\d_\d\d$", d)
-                        and not os.path.exists(
-                            os.path.join(flowcell_project_source, d, "cleaned")
-                        )
-                    ]
-                    for _proj in projects_in_fc:
-                        proj = re.sub(r"_+", ".", _proj, 1)
-                        # if a project is already processed no need of fetching it again from status db
-                        if proj in project_processed_list:
-                            # if the project is closed more than threshold days collect the fastq files from FC
-                            # no need of looking for analysis data as they would have been collected in the first time
-                            if (
-                                proj in project_clean_list
-                                and project_clean_list[proj]["closed_days"]
-                                >= days_fastq
-                            ):
-                                fc_fq_files, fq_size = collect_fastq_data_miarka(
-                                    fc_abs_path,
-                                    os.path.join(flowcell_project_source, _proj),
-                                )
-                                project_clean_list[proj]["fastq_to_remove"][
-                                    "flowcells"
-                                ][fc] = fc_fq_files["flowcells"][fc]
-                                project_clean_list[proj]["fastq_size"] += fq_size
+                    project_processed_list.append(proj)
+                    # by default assume all projects are not old enough for delete
+                    fastq_data, analysis_data = ("young", "young")
+                    fastq_size, analysis_size = (0, 0)
+                    proj_info = get_closed_proj_info(proj, pdocs[proj], date)
+                    if proj_info:
+                        # move on if this project has to be excluded
+                        if (
+                            proj_info["name"] in exclude_list
+                            or proj_info["pid"] in exclude_list
+                        ):
                             continue
-                        project_processed_list.append(proj)
-                        # by default assume all projects are not old enough for delete
-                        fastq_data, analysis_data = ("young", "young")
-                        fastq_size, analysis_size = (0, 0)
-                        proj_info = get_closed_proj_info(
-                            proj, pcon.get_entry(proj), date
+                        fastq_old = proj_info["closed_days"] >= days_fastq
+                        analysis_old = (
+                            not only_fastq and proj_info["closed_days"] >= days_analysis
                         )
-                        if proj_info:
-                            # move on if this project has to be excluded
-                            if (
-                                proj_info["name"] in exclude_list
-                                or proj_info["pid"] in exclude_list
-                            ):
-                                continue
-                            # if project not old enough for fastq files and only fastq files selected move on to next project
-                            if proj_info["closed_days"] >= days_fastq:
-                                fastq_data, fastq_size = collect_fastq_data_miarka(
-                                    fc_abs_path,
-                                    os.path.join(flowcell_project_source, _proj),
-                                    data_dir,
+                        # the inventory records the size of all the data of closed projects,
+                        # so it is collected whatever the thresholds
+                        if fastq_old:
+                            fastq_data, fastq_size = collect_fastq_data_miarka(
+                                fc_abs_path,
+                                os.path.join(flowcell_project_source, _proj),
+                                data_dir,
+                                proj_info["pid"],
+                                inventory=inventory,
+                            )
+                        elif inventory is not None:
+                            _, fastq_size = collect_fastq_data_miarka(
+                                fc_abs_path,
+                                os.path.join(flowcell_project_source, _proj),
+                                inventory=inventory,
+                            )
+                        if analysis_old or (inventory is not None and not only_fastq):
+                            collected_analysis, analysis_size = (
+                                collect_analysis_data_miarka(
                                     proj_info["pid"],
+                                    analysis_dir,
+                                    analysis_data_to_remove,
+                                    inventory=inventory,
                                 )
-                            if not only_fastq:
-                                # if project is old enough for fastq files and not 'only_fastq' try collect analysis files
-                                if proj_info["closed_days"] >= days_analysis:
-                                    (
-                                        analysis_data,
-                                        analysis_size,
-                                    ) = collect_analysis_data_miarka(
-                                        proj_info["pid"],
-                                        analysis_dir,
-                                        analysis_data_to_remove,
-                                    )
-                                # if both fastq and analysis files are not old enough move on
-                                if (analysis_data == fastq_data) or (
-                                    (not analysis_data or analysis_data == "cleaned")
-                                    and fastq_data == "young"
-                                ):
-                                    continue
-                            elif fastq_data == "young":
+                            )
+                            if analysis_old:
+                                analysis_data = collected_analysis
+                        if inventory is not None:
+                            # analysis data is not looked at with 'only_fastq', keep its recorded size
+                            inventory_projects[proj] = dict(
+                                proj_info,
+                                fastq_size=fastq_size,
+                                analysis_size=None if only_fastq else analysis_size,
+                            )
+                        if not fastq_old:
+                            fastq_size = 0
+                        if not analysis_old:
+                            analysis_size = 0
+                        if not only_fastq:
+                            # if both fastq and analysis files are not old enough move on
+                            if (analysis_data == fastq_data) or (
+                                (not analysis_data or analysis_data == "cleaned")
+                                and fastq_data == "young"
+                            ):
                                 continue
-                            else:
-                                analysis_data = "not_selected"
-                            proj_info["fastq_to_remove"] = fastq_data
-                            proj_info["fastq_size"] = fastq_size
-                            proj_info["analysis_to_remove"] = analysis_data
-                            proj_info["analysis_size"] = analysis_size
-                            project_clean_list[proj] = proj_info
-
-    if not project_clean_list:
-        logger.info("There are no projects to clean")
-        return
+                        elif fastq_data == "young":
+                            continue
+                        else:
+                            analysis_data = "not_selected"
+                        proj_info["fastq_to_remove"] = fastq_data
+                        proj_info["fastq_size"] = fastq_size
+                        proj_info["analysis_to_remove"] = analysis_data
+                        proj_info["analysis_size"] = analysis_size
+                        project_clean_list[proj] = proj_info
+
+        # record the projects, to report what can be cleaned without scanning again
+        for proj_info in inventory_projects.values():
+            inventory.put_project(proj_info)
 
-    # list only the project and exit if 'list_only' option is selected
-    if list_only:
-        print(
-            "Project ID\tProject Name\tBioinfo resp.\tClosed Days\tClosed Date\tFastq size\tAnalysis size"
+        if not project_clean_list:
+            logger.info("There are no projects to clean")
+            return
+
+        # list only the project and exit if 'list_only' option is selected
+        if list_only:
+            print_project_list(project_clean_list.values())
+            raise SystemExit
+
+        logger.info(
+            f"Initial list is built with {len(project_clean_list)} projects {get_files_size_text(project_clean_list)}"
         )
-        for p_info in sorted(
-            list(project_clean_list.values()),
-            key=lambda d: d["closed_days"],
-            reverse=True,
+        if misc.query_yes_no(
+            "Interactively filter projects for cleanup ?", default="yes"
         ):
-            print(
-                "\t".join(
-                    [
-                        p_info["name"],
-                        p_info["pid"],
-                        p_info["bioinfo_responsible"],
-                        str(p_info["closed_days"]),
-                        p_info["closed_date"],
-                        _def_get_size_unit(p_info["fastq_size"]),
-                        _def_get_size_unit(p_info["analysis_size"]),
-                    ]
-                )
+            filtered_project, proj_count = ([], 0)
+            # go through complied project list and remove files
+            for proj, info in project_clean_list.items():
+                proj_count += 1
+                if not misc.query_yes_no(
+                    f"{get_proj_meta_info(info, days_fastq)}Delete files for this project ({proj_count}/{len(project_clean_list)})",
+                    default="no",
+                ):
+                    logger.info(f"Will not remove files for project {proj}")
+                    filtered_project.append(proj)
+            # remove projects that were decided not to delete
+            map(project_clean_list.pop, filtered_project)
+            logger.info(
+                f"Removed {len(filtered_project)}/{proj_count} projects from initial list"
             )
-        raise SystemExit
+            if not project_clean_list:
+                logger.info("There are no projects to clean after filtering")
+                return
+            logger.info(
+                f"Final list is created with {len(project_clean_list)} projects {get_files_size_text(project_clean_list)}"
+            )
+            if not misc.query_yes_no("Proceed with cleanup ?", default="no"):
+                logger.info("Aborting cleanup")
+                return
+        logger.info("Will start cleaning up project now")
+        remover = None if dry_run else open_file_remover(config)
 
-    logger.info(
-        f"Initial list is built with {len(project_clean_list)} projects {get_files_size_text(project_clean_list)}"
-    )
-    if misc.query_yes_no("Interactively filter projects for cleanup ?", default="yes"):
-        filtered_project, proj_count = ([], 0)
-        # go through complied project list and remove files
         for proj, info in project_clean_list.items():
-            proj_count += 1
-            if not misc.query_yes_no(
-                f"{get_proj_meta_info(info, days_fastq)}Delete files for this project ({proj_count}/{len(project_clean_list)})",
-                default="no",
-            ):
-                logger.info(f"Will not remove files for project {proj}")
-                filtered_project.append(proj)
-        # remove projects that were decided not to delete
-        map(project_clean_list.pop, filtered_project)
-        logger.info(
-            f"Removed {len(filtered_project)}/{proj_count} projects from initial list"
-        )
-        if not project_clean_list:
-            logger.info("There are no projects to clean after filtering")
-            return
-        logger.info(
-            f"Final list is created with {len(project_clean_list)} projects {get_files_size_text(project_clean_list)}"
-        )
-        if not misc.query_yes_no("Proceed with cleanup ?", default="no"):
-            logger.info("Aborting cleanup")
-            return
-    logger.info("Will start cleaning up project now")
-
-    for proj, info in project_clean_list.items():
-        fastq_info = info.get("fastq_to_remove")
-        if fastq_info and isinstance(fastq_info, dict):
-            logger.info(f"Cleaning fastq files for project {proj}")
-            fastq_fc = fastq_info.get("flowcells", {})
-            removed_fc = []
-            for fc, fc_info in fastq_fc.items():
-                proj_fc_root = fc_info["proj_root"]
-                logger.info(f"Removing fastq files from {proj_fc_root}")
-                if not dry_run:
-                    if _remove_files(fc_info["fq_files"]):
+            fastq_info = info.get("fastq_to_remove")
+            if fastq_info and isinstance(fastq_info, dict):
+                logger.info(f"Cleaning fastq files for project {proj}")
+                fastq_fc = fastq_info.get("flowcells", {})
+                removed_fc = []
+                for fc, fc_info in fastq_fc.items():
+                    proj_fc_root = fc_info["proj_root"]
+                    logger.info(f"Removing fastq files from {proj_fc_root}")
+                    if not dry_run:
+                        if remover.remove_files(fc_info["fq_files"]):
+                            logger.info(
+                                f"Removed fastq files from FC {fc} for project {proj}, marking it as cleaned"
+                            )
+                            _touch_cleaned(proj_fc_root)
+                            removed_fc.append(fc)
+                if len(fastq_fc) == len(removed_fc):
+                    try:
+                        proj_data_root = fastq_info["proj_data"]["proj_data_root"]
                         logger.info(
-                            f"Removed fastq files from FC {fc} for project {proj}, marking it as cleaned"
+                            f"All flowcells cleaned for this project, marking it as cleaned in {proj_data_root}"
                         )
-                        _touch_cleaned(proj_fc_root)
-                        removed_fc.append(fc)
-            if len(fastq_fc) == len(removed_fc):
-                try:
-                    proj_data_root = fastq_info["proj_data"]["proj_data_root"]
+                        _touch_cleaned(proj_data_root)
+                    except:
+                        pass
+
+            analysis_info = info.get("analysis_to_remove")
+            if analysis_info and isinstance(analysis_info, dict):
+                proj_analysis_root = analysis_info["proj_analysis_root"]
+                logger.info(f"cleaning analysis data for project {proj}")
+                removed_qc = []
+                for qc, files in analysis_info["analysis_files"].items():
+                    logger.info(f'Removing files of "{qc}" from {proj_analysis_root}')
+                    if not dry_run:
+                        if remover.remove_files(files):
+                            removed_qc.append(qc)
+                        else:
+                            logger.warn(
+                                f'Could not remove some files in qc directory "{qc}"'
+                            )
+                map(analysis_info["analysis_files"].pop, removed_qc)
+                if len(analysis_info["analysis_files"]) == 0:
                     logger.info(
-                        f"All flowcells cleaned for this project, marking it as cleaned in {proj_data_root}"
+                        f"Removed analysis data for project {proj}, marking it cleaned"
                     )
-                    _touch_cleaned(proj_data_root)
-                except:
-                    pass
-
-        analysis_info = info.get("analysis_to_remove")
-        if analysis_info and isinstance(analysis_info, dict):
-            proj_analysis_root = analysis_info["proj_analysis_root"]
-            logger.info(f"cleaning analysis data for project {proj}")
-            removed_qc = []
-            for qc, files in analysis_info["analysis_files"].items():
-                logger.info(f'Removing files of "{qc}" from {proj_analysis_root}')
-                if not dry_run:
-                    if _remove_files(files):
-                        removed_qc.append(qc)
-                    else:
-                        logger.warn(
-                            f'Could not remove some files in qc directory "{qc}"'
-                        )
-            map(analysis_info["analysis_files"].pop, removed_qc)
-            if len(analysis_info["analysis_files"]) == 0:
-                logger.info(
-                    f"Removed analysis data for project {proj}, marking it cleaned"
-                )
-                _touch_cleaned(proj_analysis_root)
+                    _touch_cleaned(proj_analysis_root)
+
+            if inventory is not None and not dry_run:
+                # record the size of the data left for the project
+                proj_record = inventory_projects[proj]
+                if fastq_info and isinstance(fastq_info, dict):
+                    proj_record["fastq_size"] = 0
+                if analysis_info and isinstance(analysis_info, dict):
+                    proj_record["analysis_size"] = 0
+                inventory.put_project(proj_record)
+
+        if remover is not None:
+            _log_removal(remover)
+    finally:
+        if inventory is not None:
+            inventory.close()
+
+
+def cleanup_inventory_report(days_fastq, days_analysis, date):
+    """List the projects recorded in the cleanup inventory of Miarka with data
+    that could be removed at the given date, without scanning the filesystem.
+
+    :param int days_fastq: Days to consider to remove fastq files for project
+    :param int days_analysis: Days to consider to remove analysis data for project
+    :param str date: Date to consider instead of today, as YYYY-MM-DD
+    """
+    inventory = open_inventory(CONFIG["cleanup"]["miarka"])
+    if inventory is None:
+        logger.error("No cleanup inventory is given in the config")
+        raise SystemExit
+    if date:
+        date = datetime.strptime(date, "%Y-%m-%d")
+    freeable = inventory.get_freeable(days_fastq, days_analysis, date)
+    inventory.close()
+    if not freeable:
+        logger.info("There are no projects to clean in the inventory")
+        return
+    print_project_list(freeable)
+    print(f"Total {get_files_size_text({p['name']: p for p in freeable})}".rstrip())
+
+
+def print_project_list(project_list):
+    """Print a table of projects to clean, the longest closed first."""
+    print(
+        "Project ID\tProject Name\tBioinfo resp.\tClosed Days\tClosed Date\tFastq size\tAnalysis size"
+    )
+    for p_info in sorted(
+        list(project_list),
+        key=lambda d: d["closed_days"],
+        reverse=True,
+    ):
+        print(
+            "\t".join(
+                [
+                    p_info["name"],
+                    p_info["pid"],
+                    p_info["bioinfo_responsible"],
+                    str(p_info["closed_days"]),
+                    p_info["closed_date"],
+                    _def_get_size_unit(p_info["fastq_size"]),
+                    _def_get_size_unit(p_info["analysis_size"]),
+                ]
+            )
+        )
 
 
 #############################################################
@@ -420,7 +597,9 @@ def get_closed_proj_info(prj, pdoc, tdate=None):
     return pdict
 
 
-def collect_analysis_data_miarka(pid, analysis_root, files_ext_to_remove={}):
+def collect_analysis_data_miarka(
+    pid, analysis_root, files_ext_to_remove={}, inventory=None
+):
     """Collect the analysis files that have to be removed from Miarka
     return a tuple with files and total size of collected files."""
     size = 0
@@ -437,31 +616,25 @@ def collect_analysis_data_miarka(pid, analysis_root, files_ext_to_remove={}):
         for qc_type, ext in files_ext_to_remove.items():
             qc_path = os.path.join(proj_abs_path, qc_type)
             if os.path.exists(qc_path):
-                file_list["analysis_files"][qc_type].extend(
-                    collect_files_by_ext(qc_path, ext)
-                )
-    try:
-        size += sum(
-            [
-                sum(map(os.path.getsize, fls))
-                for fls in file_list["analysis_files"].values()
-            ]
-        )
-    except:
-        pass
+                qc_files = scan_files_by_ext(qc_path, ext, inventory=inventory)
+                file_list["analysis_files"][qc_type].extend(qc_files)
+                size += sum(qc_files.values())
     return (file_list, size)
 
 
-def collect_fastq_data_miarka(fc_root, fc_proj_src, proj_root=None, pid=None):
+def collect_fastq_data_miarka(
+    fc_root, fc_proj_src, proj_root=None, pid=None, inventory=None
+):
     """Collect the fastq files that have to be removed from Miarka.
     Return a tuple with files and total size of collected files."""
     size = 0
     file_list = {"flowcells": defaultdict(dict)}
     fc_proj_path = os.path.join(fc_root, fc_proj_src)
     fc_id = os.path.basename(fc_root)
+    fc_fq_files = scan_files_by_ext(fc_proj_path, "*.fastq.gz", inventory=inventory)
     file_list["flowcells"][fc_id] = {
         "proj_root": fc_proj_path,
-        "fq_files": collect_files_by_ext(fc_proj_path, "*.fastq.gz"),
+        "fq_files": list(fc_fq_files),
     }
     if proj_root and pid:
         proj_abs_path = os.path.join(proj_root, pid)
@@ -474,20 +647,83 @@ def collect_fastq_data_miarka(fc_root, fc_proj_src, proj_root=None, pid=None):
                 "proj_data_root": proj_abs_path,
                 "fastq_files": collect_files_by_ext(proj_abs_path, "*.fastq.gz"),
             }
-    size += sum(map(os.path.getsize, file_list["flowcells"][fc_id]["fq_files"]))
+    size += sum(fc_fq_files.values())
     return (file_list, size)
 
 
 def collect_files_by_ext(path, ext=[]):
     """Collect files with a given extension from a given path."""
+    return list(scan_files_by_ext(path, ext, with_sizes=False))
+
+
+def scan_files_by_ext(path, ext=[], with_sizes=True, inventory=None):
+    """Collect files matching any of the given patterns under a given path,
+    with a single traversal of the tree.
+
+    Patterns are matched against file names, or against the last parts of the
+    file paths for patterns with several parts, e.g. "qc/*.bam".
+    Return a dict mapping the paths of the files to their sizes, or to None
+    if with_sizes is False, which saves a stat per file.
+
+    With a CleanupInventory, directories whose modification time is the same as
+    in the previous scan are not read again, their recorded contents are used.
+    """
     if isinstance(ext, str):
         ext = [ext]
-    collected_files = []
-    for root, dirs, files in os.walk(path):
-        for e in ext:
-            collected_files.extend(glob(os.path.join(root, e)))
-        for d in dirs:
-            collected_files.extend(collect_files_by_ext(d, ext))
+    patterns = [(e, e.count(os.sep) + 1) for e in ext]
+    if inventory is not None:
+        # Sizes are recorded for later scans
+        with_sizes = True
+        recorded_dirs = inventory.get_dirs(path, ext)
+        scanned_dirs = {}
+    collected_files = {}
+    dirs_to_scan = [(path, [])]
+    while dirs_to_scan:
+        dir_path, dir_parts = dirs_to_scan.pop()
+        if inventory is not None:
+            try:
+                mtime_ns = os.stat(dir_path).st_mtime_ns
+            except OSError:
+                continue
+            recorded_dir = recorded_dirs.get(dir_path)
+            if recorded_dir is not None and recorded_dir[0] == mtime_ns:
+                scanned_dirs[dir_path] = recorded_dir
+                _, subdirs, dir_files = recorded_dir
+                for subdir in subdirs:
+                    dirs_to_scan.append(
+                        (os.path.join(dir_path, subdir), dir_parts + [subdir])
+                    )
+                collected_files.update(dir_files)
+                continue
+        try:
+            entries = list(os.scandir(dir_path))
+        except OSError:
+            continue
+        subdirs, dir_files = [], {}
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                dirs_to_scan.append((entry.path, dir_parts + [entry.name]))
+                subdirs.append(entry.name)
+            elif entry.is_file():
+                entry_parts = dir_parts + [entry.name]
+                for pattern, n_parts in patterns:
+                    if len(entry_parts) < n_parts:
+                        continue
+                    # Like glob, hidden files only match patterns for hidden files
+                    if entry.name.startswith(".") and not os.path.basename(
+                        pattern
+                    ).startswith("."):
+                        continue
+                    if fnmatch.fnmatch(os.sep.join(entry_parts[-n_parts:]), pattern):
+                        dir_files[entry.path] = (
+                            entry.stat().st_size if with_sizes else None
+                        )
+                        break
+        collected_files.update(dir_files)
+        if inventory is not None:
+            scanned_dirs[dir_path] = (mtime_ns, subdirs, dir_files)
+    if inventory is not None:
+        inventory.put_dirs(path, ext, scanned_dirs)
     return collected_files
 
 
@@ -583,16 +819,54 @@ def _def_get_size_unit(s):
     return str(s)
 
 
-def _remove_files(files):
-    """Remove files from given list."""
-    status = True
-    for fl in files:
+def collect_old_runs(roots, threshold):
+    """Collect the run directories modified before the given time, with a
+    single scandir of each given directory."""
+    old_runs = []
+    for root in roots:
         try:
-            os.remove(fl)
-        except Exception as e:
-            logger.warn(f'Could not remove file {fl} due to "{e.message}"')
-            status = False
-    return status
+            entries = list(os.scandir(root))
+        except OSError:
+            logger.warning(f"Path {root} does not exist or it is not a directory")
+            continue
+        for entry in entries:
+            if not (
+                re.match(filesystem.RUN_RE_ILLUMINA, entry.name)
+                or re.match(filesystem.RUN_RE_ONT, entry.name)
+                or re.match(filesystem.RUN_RE_ELEMENT, entry.name)
+            ):
+                continue
+            if (
+                entry.is_dir(follow_symlinks=False)
+                and entry.stat(follow_symlinks=False).st_mtime < threshold
+            ):
+                old_runs.append(entry.path)
+    return sorted(old_runs)
+
+
+def _read_run_log(log_file):
+    """Return the runs listed in the first column of a tab separated log."""
+    try:
+        with open(log_file) as log:
+            return {row[0] for row in csv.reader(log, delimiter="\t") if row}
+    except OSError as e:
+        logger.warning(f'Could not read log file {log_file} due to "{e}"')
+        return set()
+
+
+def _get_total_size(files, max_workers=16):
+    """Sum the sizes of the given files, with a bounded pool of threads waiting
+    for the stats."""
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return sum(pool.map(os.path.getsize, files))
+
+
+def _log_removal(remover):
+    """Finish the removal of files and log how much was freed."""
+    removed_files, freed_bytes = remover.finish()
+    logger.info(
+        f"Removed {removed_files} files, freeing {_def_get_size_unit(freed_bytes)}"
+    )
 
 
 def _touch_cleaned(path):
@@ -33,11 +33,14 @@ def cleanup(ctx, status_db_config):
     type=click.IntRange(min=1),
     help='Hours to consider as thershold, should not be combined with option "--days"',
 )
+@click.option(
+    "-n", "--dry_run", is_flag=True, help="Perform dry run i.e. execute nothing but log"
+)
 @click.pass_context
-def preproc(ctx, days, hours):
+def preproc(ctx, days, hours, dry_run):
     """Do appropriate cleanup on preproc."""
     seconds = misc.to_seconds(days, hours)
-    cln.cleanup_processing(seconds)
+    cln.cleanup_processing(seconds, dry_run)
 
 
 @cleanup.command()
@@ -124,3 +127,29 @@ def miarka(
         date,
         dry_run,
     )
+
+
+@cleanup.command()
+@click.option(
+    "--days_fastq",
+    type=click.IntRange(min=1),
+    help='Days to consider as thershold for removing "fastq" files',
+)
+@click.option(
+    "--days_analysis",
+    type=click.IntRange(min=1),
+    help="Days to consider as thershold for removing analysis data",
+)
+@click.option(
+    "--date",
+    type=click.STRING,
+    help="Consider the given date instead of today. "
+    'Date format should be "YYYY-MM-DD", ex: "2016-01-31"',
+)
+def inventory(days_fastq, days_analysis, date):
+    """List data that can be cleaned on Miarka from the cleanup inventory."""
+    if not days_fastq and not days_analysis:
+        raise SystemExit(
+            'ERROR: Either "days_fastq" or "days_analysis" should be given'
+        )
+    cln.cleanup_inventory_report(days_fastq, days_analysis, date)
@@ -0,0 +1,160 @@
+"""Local inventory of the data seen by cleanup, to make sweeps incremental."""
+
+import json
+import logging
+import os
+import sqlite3
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+
+class CleanupInventory:
+    """SQLite database of the directories scanned by cleanup and the data
+    collected for closed projects.
+
+    Directories are recorded with their modification time, subdirectories and
+    matching files, so that later scans only read directories that changed.
+    Projects are recorded with their close date and the size of their data, to
+    report what cleaning would free without touching the filesystem.
+
+    Example format for entry in the taca config file
+    cleanup:
+        miarka:
+            inventory: path/to/cleanup_inventory.sqlite
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.connection = sqlite3.connect(db_path)
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS dirs ("
+                "root TEXT, patterns TEXT, path TEXT, mtime_ns INTEGER, "
+                "subdirs TEXT, files TEXT, PRIMARY KEY (root, patterns, path))"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS projects ("
+                "name TEXT PRIMARY KEY, pid TEXT, closed_date TEXT, "
+                "bioinfo_responsible TEXT, fastq_size INTEGER, "
+                "analysis_size INTEGER, updated TEXT)"
+            )
+
+    def close(self):
+        self.connection.close()
+
+    def get_dirs(self, root, patterns):
+        """Return the recorded directories of a scan, mapped to their
+        modification time, subdirectories and matching files."""
+        rows = self.connection.execute(
+            "SELECT path, mtime_ns, subdirs, files FROM dirs "
+            "WHERE root = ? AND patterns = ?",
+            (root, json.dumps(patterns)),
+        )
+        return {
+            path: (mtime_ns, json.loads(subdirs), json.loads(files))
+            for path, mtime_ns, subdirs, files in rows
+        }
+
+    def put_dirs(self, root, patterns, dirs):
+        """Replace the recorded directories of a scan, given as a dict like the
+        one returned by get_dirs."""
+        patterns = json.dumps(patterns)
+        with self.connection:
+            self.connection.execute(
+                "DELETE FROM dirs WHERE root = ? AND patterns = ?", (root, patterns)
+            )
+            self.connection.executemany(
+                "INSERT INTO dirs VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    (
+                        root,
+                        patterns,
+                        path,
+                        mtime_ns,
+                        json.dumps(subdirs),
+                        json.dumps(files),
+                    )
+                    for path, (mtime_ns, subdirs, files) in dirs.items()
+                ),
+            )
+
+    def put_project(self, proj_info):
+        """Record a closed project and the size of all its data.
+
+        Sizes given as None, for data that was not looked at, keep their
+        recorded value.
+        """
+        with self.connection:
+            self.connection.execute(
+                "INSERT INTO projects VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET pid = excluded.pid, "
+                "closed_date = excluded.closed_date, "
+                "bioinfo_responsible = excluded.bioinfo_responsible, "
+                "fastq_size = COALESCE(excluded.fastq_size, fastq_size), "
+                "analysis_size = COALESCE(excluded.analysis_size, analysis_size), "
+                "updated = excluded.updated",
+                (
+                    proj_info["name"],
+                    proj_info["pid"],
+                    proj_info["closed_date"],
+                    proj_info.get("bioinfo_responsible", ""),
+                    proj_info.get("fastq_size"),
+                    proj_info.get("analysis_size"),
+                    datetime.now().isoformat(timespec="seconds"),
+                ),
+            )
+
+    def get_freeable(self, days_fastq, days_analysis, date=None):
+        """Return the recorded projects with data old enough to be cleaned at the
+        given date, with the sizes of the fastq and analysis data that would be freed.
+
+        :param int days_fastq: Days after closing to remove fastq files
+        :param int days_analysis: Days after closing to remove analysis data
+        :param datetime date: Date to consider instead of today
+        """
+        date = date or datetime.today()
+        freeable = []
+        for (
+            name,
+            pid,
+            closed_date,
+            bioinfo_responsible,
+            fastq_size,
+            analysis_size,
+        ) in self.connection.execute(
+            "SELECT name, pid, closed_date, bioinfo_responsible, fastq_size, "
+            "analysis_size FROM projects ORDER BY closed_date"
+        ):
+            closed_days = (date - datetime.strptime(closed_date, "%Y-%m-%d")).days
+            fastq_size = (
+                fastq_size or 0 if days_fastq and closed_days >= days_fastq else 0
+            )
+            analysis_size = (
+                analysis_size or 0
+                if days_analysis and closed_days >= days_analysis
+                else 0
+            )
+            if fastq_size or analysis_size:
+                freeable.append(
+                    {
+                        "name": name,
+                        "pid": pid,
+                        "closed_date": closed_date,
+                        "closed_days": closed_days,
+                        "bioinfo_responsible": bioinfo_responsible,
+                        "fastq_size": fastq_size,
+                        "analysis_size": analysis_size,
+                    }
+                )
+        return freeable
+
+
+def open_inventory(config):
+    """Open the cleanup inventory given in the config, if any."""
+    db_path = config.get("inventory")
+    if not db_path:
+        return None
+    os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+    logger.info(f"Using cleanup inventory {db_path}")
+    return CleanupInventory(db_path)
@@ -0,0 +1,107 @@
+"""Parallel, rate limited removal of files with a journal of the progress."""
+
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class FileRemover:
+    """Remove files with a pool of threads, starting at most max_rate removals
+    per second to spare the metadata servers of the file system.
+
+    Every removed file is appended with its size to the journal, so that a
+    cleanup that is interrupted can be started again and still report all the
+    bytes freed since the journal was started. The journal is emptied by
+    finish() once the cleanup is done.
+
+    Example format for entry in the taca config file
+    cleanup:
+        miarka:
+            removal:
+                journal: path/to/cleanup_removal.journal
+                max_workers: 8
+                max_rate: 200
+    """
+
+    def __init__(self, journal_path=None, max_workers=8, max_rate=None):
+        self.journal_path = journal_path
+        self.max_workers = max_workers
+        self.max_rate = max_rate
+        self.removed_files = 0
+        self.freed_bytes = 0
+        self._lock = threading.Lock()
+        self._next_slot = 0.0
+        self._journal = None
+        if journal_path:
+            if os.path.exists(journal_path):
+                with open(journal_path) as journal:
+                    for line in journal:
+                        path, _, size = line.rstrip("\n").rpartition("\t")
+                        if path and size.isdigit():
+                            self.removed_files += 1
+                            self.freed_bytes += int(size)
+                if self.removed_files:
+                    logger.info(
+                        f"Resuming from journal {journal_path}, {self.removed_files} "
+                        f"files with {self.freed_bytes} bytes were already removed"
+                    )
+            self._journal = open(journal_path, "a")
+
+    def _wait_for_slot(self):
+        """Block until the next removal is allowed by max_rate."""
+        if not self.max_rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(self._next_slot, now)
+            self._next_slot = slot + 1 / self.max_rate
+        if slot > now:
+            time.sleep(slot - now)
+
+    def remove_file(self, path):
+        """Remove a file and journal it, return True if it was removed."""
+        self._wait_for_slot()
+        try:
+            size = os.lstat(path).st_size
+            os.remove(path)
+        except OSError as e:
+            logger.warning(f'Could not remove file {path} due to "{e}"')
+            return False
+        with self._lock:
+            self.removed_files += 1
+            self.freed_bytes += size
+            if self._journal is not None:
+                self._journal.write(f"{path}\t{size}\n")
+                self._journal.flush()
+        return True
+
+    def remove_files(self, files):
+        """Remove the given files, return True if all of them were removed."""
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            return all(list(pool.map(self.remove_file, files)))
+
+    def finish(self):
+        """Close and empty the journal, return the number of removed files and
+        the freed bytes since it was started."""
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+            os.remove(self.journal_path)
+        return self.removed_files, self.freed_bytes
+
+
+def open_file_remover(config):
+    """Make a FileRemover with the removal settings given in the config, if any."""
+    removal_config = config.get("removal", {})
+    journal_path = removal_config.get("journal")
+    if journal_path:
+        os.makedirs(os.path.dirname(os.path.abspath(journal_path)), exist_ok=True)
+    return FileRemover(
+        journal_path=journal_path,
+        max_workers=removal_config.get("max_workers", 8),
+        max_rate=removal_config.get("max_rate"),
+    )
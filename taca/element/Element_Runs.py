@@ -1,5 +1,9 @@
 import csv
+import fnmatch
+import functools
 import glob
+import gzip
+import hashlib
 import json
 import logging
 import os
@@ -12,12 +16,24 @@ from pathlib import Path
 
 import pandas as pd
 
-from taca.utils.filesystem import chdir
+from taca.utils.filesystem import chdir, get_drop_folder_index
+from taca.utils.misc import allocate_threads, hashfile
 from taca.utils.statusdb import ElementRunsConnection
+from taca.utils.transfer import MetadataSyncAgent
 
 logger = logging.getLogger(__name__)
 
+# Buffer size for streaming LIMS zip files
+MANIFEST_BUFFER_SIZE = 1024 * 1024
 
+# Aggregated demux stats tables, which are kept out of the StatusDB document body
+DEMUX_STATS_TABLES = {
+    "Index_Assignment": "IndexAssignment.csv",
+    "Unassigned_Sequences": "UnassignedSequences.csv",
+}
+
+
+@functools.cache
 def get_mask(
     seq: str,
     keep_Ns: bool,
@@ -34,6 +50,8 @@ def get_mask(
     Example usage:
         get_mask( "ACGTNNN", True,  "I1:",  7 ) -> 'I1:N4Y3'
         get_mask( "ACGTNNN", False, "I2:", 10 ) -> 'I2:Y4N6'
+
+    Masks are memoized, since most samples of a run share them.
     """
 
     # Input assertions
@@ -118,6 +136,16 @@ def get_mask(
     return mask
 
 
+def prefetch_run_statuses(run_dirs, configuration):
+    """Fetch the statuses of all given runs with one query, so that the run
+    objects of a sweep check their status without querying the database.
+
+    Runs are looked up by the name of their directory.
+    """
+    db = ElementRunsConnection(configuration.get("statusdb", {}), dbname="element_runs")
+    db.prefetch_run_statuses(os.path.basename(run_dir) for run_dir in run_dirs)
+
+
 class Run:
     """Defines an Element run"""
 
@@ -145,6 +173,12 @@ class Run:
             .get("transfer_log")
         )
         self.rsync_exit_file = os.path.join(self.run_dir, ".rsync_exit_status")
+        self.aggregation_progress_file = os.path.join(
+            self.run_dir, ".demux_aggregation_progress.json"
+        )
+        self.lims_manifests_record_file = os.path.join(
+            self.run_dir, ".lims_manifests.json"
+        )
 
         # Instrument generated files
         self.run_parameters_file = os.path.join(self.run_dir, "RunParameters.json")
@@ -253,25 +287,14 @@ class Run:
                     )
             else:
                 instrument_generated_files[os.path.basename(file)] = None
-        # Aggregated demux stats files
-        index_assignments = self.read_index_assignement_file()
-
-        unassigned_sequences_file = os.path.join(
-            self.run_dir, "Demultiplexing", "UnassignedSequences.csv"
-        )
-        if os.path.exists(unassigned_sequences_file):
-            with open(unassigned_sequences_file) as unassigned_file:
-                reader = csv.DictReader(unassigned_file)
-                unassigned_sequences = [row for row in reader]
-        else:
-            unassigned_sequences = None
-
-        demultiplex_stats = {
-            "Demultiplex_Stats": {
-                "Index_Assignment": index_assignments,
-                "Unassigned_Sequences": unassigned_sequences,
-            }
-        }
+        # Aggregated demux stats tables are uploaded as attachments of the document
+        demultiplex_stats = {"Demultiplex_Stats": {}}
+        for key, file_name in DEMUX_STATS_TABLES.items():
+            if os.path.exists(os.path.join(self.demux_dir, file_name)):
+                reference = {"attachment": f"{file_name}.gz"}
+            else:
+                reference = None
+            demultiplex_stats["Demultiplex_Stats"][key] = reference
 
         demux_command_file = os.path.join(self.run_dir, ".bases2fastq_command")
         if os.path.exists(demux_command_file):
@@ -327,17 +350,35 @@ class Run:
             found_demux_stats_file = glob.glob(
                 os.path.join(demux_dir, self.demux_stats_file)
             )
+            exit_file = os.path.join(demux_dir, ".bases2fastq_exit")
+            if os.path.exists(exit_file):
+                with open(exit_file) as f:
+                    if f.read().strip() != "0":
+                        return "failed"
             if not found_demux_stats_file:
                 return "ongoing"
             elif found_demux_stats_file:
-                finished_count += (
-                    1  # TODO: check exit status of demux in exit status file
-                )
+                finished_count += 1
         if finished_count == len(sub_demux_dirs):
             return "finished"
         else:
             return "unknown"
 
+    def get_failed_demux(self):
+        """Return the sub-demux dirs whose bases2fastq job exited with an error,
+        mapped to the exit code."""
+        failed_demux = {}
+        for exit_file in sorted(
+            glob.glob(
+                os.path.join(self.run_dir, "Demultiplexing_*", ".bases2fastq_exit")
+            )
+        ):
+            with open(exit_file) as f:
+                exit_code = f.read().strip()
+            if exit_code != "0":
+                failed_demux[os.path.dirname(exit_file)] = exit_code
+        return failed_demux
+
     def status_changed(self):
         if not self.run_parameters_parsed:
             raise RuntimeError(
@@ -346,9 +387,23 @@ class Run:
         db_run_status = self.db.check_db_run_status(self.NGI_run_id)
         return db_run_status != self.status
 
+    def get_doc_attachments(self) -> dict:
+        """Return the gzipped aggregated demux stats tables to attach to the
+        StatusDB document, keyed by attachment name.
+        """
+        attachments = {}
+        for file_name in DEMUX_STATS_TABLES.values():
+            file_path = os.path.join(self.demux_dir, file_name)
+            if os.path.exists(file_path):
+                with open(file_path, "rb") as table_file:
+                    attachments[f"{file_name}.gz"] = gzip.compress(
+                        table_file.read(), mtime=0
+                    )
+        return attachments
+
     def update_statusdb(self):
         doc_obj = self.to_doc_obj()
-        self.db.upload_to_statusdb(doc_obj)
+        self.db.upload_to_statusdb(doc_obj, attachments=self.get_doc_attachments())
 
     def get_lims_step_id(self) -> str | None:
         """If the run was started using a LIMS-generated manifest,
@@ -372,52 +427,95 @@ class Run:
             str(self.year),
         )
 
-        # Use LIMS step ID if available, else flowcell ID, to make a query pattern
+        # Use LIMS step ID if available, else flowcell ID, to look up the manifests
         self.lims_step_id = self.get_lims_step_id()
         if self.lims_step_id is not None:
             logging.info(
                 f"Using LIMS step ID '{self.lims_step_id}' to find LIMS run manifests."
             )
-            glob_pattern = f"{dir_to_search}/*{self.lims_step_id}*.zip"
+            lookup_key = self.lims_step_id
         else:
             logging.warning(
                 "LIMS step ID not available, using flowcell ID to find LIMS run manifests."
             )
-            glob_pattern = f"{dir_to_search}/*{self.flowcell_id}*.zip"
+            lookup_key = self.flowcell_id
 
-        # Find paths matching the pattern
-        glob_results = glob.glob(glob_pattern)
-        if len(glob_results) == 0:
+        # Find the manifests in the index of the drop folder
+        found_paths = get_drop_folder_index(dir_to_search, ".zip").find(lookup_key)
+        if len(found_paths) == 0:
             logger.warning(
-                f"No manifest found for run '{self.run_dir}' with pattern '{glob_pattern}'."
+                f"No manifest found for run '{self.run_dir}' with key '{lookup_key}' in '{dir_to_search}'."
             )
             return None
-        elif len(glob_results) > 1:
+        elif len(found_paths) > 1:
             logger.warning(
-                f"Multiple manifests found for run '{self.run_dir}' with pattern '{glob_pattern}', using latest one."
+                f"Multiple manifests found for run '{self.run_dir}' with key '{lookup_key}' in '{dir_to_search}', using latest one."
             )
-            glob_results.sort()  # TODO: add CLI option to specify manifest for re-demux
-            lims_zip_src_path = glob_results[-1]
+            # TODO: add CLI option to specify manifest for re-demux
+            lims_zip_src_path = found_paths[-1]
         else:
-            lims_zip_src_path = glob_results[0]
+            lims_zip_src_path = found_paths[0]
         return lims_zip_src_path
 
     def copy_manifests(self, zip_src_path):
-        """Fetch the LIMS-generated run manifests from ngi-nas-ns and unzip them into a run subdir."""
-        # Make a run subdir named after the zip file and extract manifests there
-
-        # Extract the contents of the zip file into the destination directory
-        unzipped_manifests = []
-        with zipfile.ZipFile(zip_src_path, "r") as zip_ref:
-            for member in zip_ref.namelist():
-                # Extract each file individually into the destination directory
-                filename = os.path.basename(member)
-                if filename:  # Skip directories
-                    source = zip_ref.open(member)
-                    target = open(os.path.join(self.run_dir, filename), "wb")
-                    unzipped_manifests.append(target.name)
-                    with source, target:
-                        target.write(source.read())
+        """Fetch the LIMS-generated run manifests from ngi-nas-ns and unzip them into a run subdir.
+
+        Extracted manifests are recorded with the sha256 of the zip file, so that
+        they are only extracted again when a zip file with other contents is used.
+        """
+        record = {}
+        if os.path.exists(self.lims_manifests_record_file):
+            with open(self.lims_manifests_record_file) as record_file:
+                record = json.load(record_file)
+
+        # Only hash the zip file again if it is not the one that was last hashed
+        zip_stat = os.stat(zip_src_path)
+        zip_signature = [zip_src_path, zip_stat.st_size, zip_stat.st_mtime_ns]
+        if record.get("zip_signature") == zip_signature:
+            zip_digest = record["sha256"]
+        else:
+            zip_digest = hashfile(
+                zip_src_path, hasher="sha256", blocksize=MANIFEST_BUFFER_SIZE
+            )
+
+        unzipped_manifests = [
+            os.path.join(self.run_dir, filename)
+            for filename in record.get("manifests", [])
+        ]
+        if record.get("sha256") == zip_digest and all(
+            os.path.exists(manifest) for manifest in unzipped_manifests
+        ):
+            logger.info(
+                f"Manifests of {zip_src_path} are already extracted for {self}, skipping."
+            )
+        else:
+            # Stream each file of the zip into the run dir
+            unzipped_manifests = []
+            with zipfile.ZipFile(zip_src_path, "r") as zip_ref:
+                for member in zip_ref.namelist():
+                    filename = os.path.basename(member)
+                    if filename:  # Skip directories
+                        target_path = os.path.join(self.run_dir, filename)
+                        with (
+                            zip_ref.open(member) as source,
+                            open(f"{target_path}.tmp", "wb") as target,
+                        ):
+                            shutil.copyfileobj(source, target, MANIFEST_BUFFER_SIZE)
+                        os.replace(f"{target_path}.tmp", target_path)
+                        unzipped_manifests.append(target_path)
+
+        new_record = {
+            "zip_signature": zip_signature,
+            "sha256": zip_digest,
+            "manifests": [
+                os.path.basename(manifest) for manifest in unzipped_manifests
+            ],
+        }
+        if new_record != record:
+            tmp_record_file = f"{self.lims_manifests_record_file}.tmp"
+            with open(tmp_record_file, "w") as record_file:
+                json.dump(new_record, record_file)
+            os.replace(tmp_record_file, self.lims_manifests_record_file)
 
         # Pick out the manifest to use
         self.lims_manifest = [
@@ -459,60 +557,83 @@ class Run:
         df_samples = df[df["Project"] != "Control"].copy()
         df_controls = df[df["Project"] == "Control"].copy()
 
-        # Add masks
-        df_samples["I1Mask"] = df_samples["Index1"].apply(
+        # Add masks, computing each mask only once. Index masks only depend on
+        # the positions of Ns, so indexes with the same N pattern share a mask.
+        bases_to_pattern = str.maketrans("CGT", "AAA")
+
+        def map_unique(column, make_mask, key=None):
+            masks = {}
+            value_masks = {}
+            for value in column.unique():
+                mask_key = value.translate(key) if key else value
+                if mask_key not in masks:
+                    masks[mask_key] = make_mask(value)
+                value_masks[value] = masks[mask_key]
+            return column.map(value_masks)
+
+        df_samples["I1Mask"] = map_unique(
+            df_samples["Index1"],
             lambda seq: get_mask(
                 seq=seq,
                 keep_Ns=False,
                 prefix="I1:",
                 cycles_used=self.cycles["I1"],
-            )
+            ),
+            key=bases_to_pattern,
         )
-        df_samples["I2Mask"] = df_samples["Index2"].apply(
+        df_samples["I2Mask"] = map_unique(
+            df_samples["Index2"],
             lambda seq: get_mask(
                 seq=seq,
                 keep_Ns=False,
                 prefix="I2:",
                 cycles_used=self.cycles["I2"],
-            )
+            ),
+            key=bases_to_pattern,
         )
-        df_samples["I1UmiMask"] = df_samples["Index1"].apply(
+        df_samples["I1UmiMask"] = map_unique(
+            df_samples["Index1"],
             lambda seq: get_mask(
                 seq=seq,
                 keep_Ns=True,
                 prefix="I1:",
                 cycles_used=self.cycles["I1"],
-            )
+            ),
+            key=bases_to_pattern,
         )
-        df_samples["I2UmiMask"] = df_samples["Index2"].apply(
+        df_samples["I2UmiMask"] = map_unique(
+            df_samples["Index2"],
             lambda seq: get_mask(
                 seq=seq,
                 keep_Ns=True,
                 prefix="I2:",
                 cycles_used=self.cycles["I2"],
-            )
+            ),
+            key=bases_to_pattern,
         )
-        df_samples["R1Mask"] = df_samples["Recipe"].apply(
+        df_samples["R1Mask"] = map_unique(
+            df_samples["Recipe"],
             lambda recipe: get_mask(
                 seq="N" * int(recipe.split("-")[0]),
                 keep_Ns=True,
                 prefix="R1:",
                 cycles_used=self.cycles["R1"],
-            )
+            ),
         )
-        df_samples["R2Mask"] = df_samples["Recipe"].apply(
+        df_samples["R2Mask"] = map_unique(
+            df_samples["Recipe"],
             lambda recipe: get_mask(
                 seq="N" * int(recipe.split("-")[3]),
                 keep_Ns=True,
                 prefix="R2:",
                 cycles_used=self.cycles["R2"],
-            )
+            ),
         )
 
         # Re-make Index2 column without any Ns
         df_samples["Index2_with_Ns"] = df_samples["Index2"]
-        df_samples.loc[:, "Index2"] = df_samples["Index2"].apply(
-            lambda x: x.replace("N", "")
+        df_samples.loc[:, "Index2"] = df_samples["Index2"].str.replace(
+            "N", "", regex=False
         )
 
         # Apply default dir path for output
@@ -533,13 +654,17 @@ class Run:
         )
 
         # Sanity check
-        if sum([len(group) for _, group in grouped_df]) < len(df_samples):
+        n_grouped_samples = grouped_df.size().sum()
+        if n_grouped_samples < len(df_samples):
             msg = "Some samples were not included in any submanifest."
             logging.error(msg)
             raise AssertionError(msg)
-        elif sum([len(group) for _, group in grouped_df]) > len(df_samples):
+        elif n_grouped_samples > len(df_samples):
             logging.warning("Some samples were included in multiple submanifests.")
 
+        # Split controls by lane once, to pick them for each group
+        controls_by_lane = dict(list(df_controls.groupby("Lane")))
+
         # Iterate over groups to build composite manifests
         manifest_root_name = f"{self.NGI_run_id}_demux"
         manifests = []
@@ -600,19 +725,22 @@ class Run:
             )
 
             # Add PhiX stratified by index length
-            group_controls = df_controls[
-                df_controls["Lane"].isin(group["Lane"].unique())
-            ].copy()
+            group_lanes_controls = [
+                controls_by_lane[lane]
+                for lane in group["Lane"].unique()
+                if lane in controls_by_lane
+            ]
+            if group_lanes_controls:
+                # Keep the order of the controls in the manifest
+                group_controls = pd.concat(group_lanes_controls).sort_index()
+            else:
+                group_controls = df_controls.iloc[0:0].copy()
 
             # Trim PhiX indexes to match group
-            i1_len = group["Index1"].apply(len).max()
-            group_controls.loc[:, "Index1"] = group_controls.loc[:, "Index1"].apply(
-                lambda x: x[:i1_len]
-            )
-            i2_len = group["Index2"].apply(len).max()
-            group_controls.loc[:, "Index2"] = group_controls.loc[:, "Index2"].apply(
-                lambda x: x[:i2_len]
-            )
+            i1_len = group["Index1"].str.len().max()
+            group_controls.loc[:, "Index1"] = group_controls["Index1"].str[:i1_len]
+            i2_len = group["Index2"].str.len().max()
+            group_controls.loc[:, "Index2"] = group_controls["Index2"].str[:i2_len]
 
             # Add PhiX to group
             group = pd.concat([group, group_controls], axis=0, ignore_index=True)
@@ -636,12 +764,12 @@ class Run:
         manifest_paths = [t[0] for t in manifests]
         return manifest_paths
 
-    def generate_demux_command(self, run_manifest, demux_dir):
+    def generate_demux_command(self, run_manifest, demux_dir, n_threads=8):
         command = (
             f"{self.CONFIG.get('element_analysis').get('bases2fastq')}"
             + f" {self.run_dir}"
             + f" {demux_dir}"
-            + " -p 8"
+            + f" -p {n_threads}"
             + " --num-unassigned 500"
             + f" -r {run_manifest}"
             + " --legacy-fastq"
@@ -653,14 +781,101 @@ class Run:
             command_file.write(command)
         return command
 
-    def start_demux(self, run_manifest, demux_dir):
+    def queue_demux(self, run_manifest, demux_dir):
+        """Queue a bases2fastq job for a sub-demux, to be started by start_queued_demux."""
+        with open(os.path.join(demux_dir, ".bases2fastq_queued"), "w") as queue_file:
+            queue_file.write(run_manifest)
+
+    def get_bases2fastq_threads_in_use(self):
+        """Sum the threads of the bases2fastq jobs running for any run in the data dirs.
+
+        A job holds its threads from the moment it is started, when its threads
+        file is written, until it has written its exit code. The ongoing marker
+        is not used, since it is only written once the job's shell is running.
+        """
+        threads_in_use = 0
+        for data_dir in self.CONFIG.get("element_analysis").get("data_dirs", []):
+            for threads_file in glob.glob(
+                os.path.join(data_dir, "*", "Demultiplexing_*", ".bases2fastq_threads")
+            ):
+                exit_file = os.path.join(
+                    os.path.dirname(threads_file), ".bases2fastq_exit"
+                )
+                if not os.path.exists(exit_file):
+                    with open(threads_file) as f:
+                        threads_in_use += int(f.read())
+        return threads_in_use
+
+    def start_queued_demux(self):
+        """Start the queued bases2fastq jobs of the run.
+
+        If a core budget is configured, jobs are admitted as long as the budget
+        allows and the -p of each job is sized from the free cores. Jobs that do
+        not fit are left in the queue and started on later sweeps. Without a
+        budget, all queued jobs are started with 8 threads each. Jobs that fail
+        to start are also left in the queue, to be retried on the next sweep.
+        """
+        queued_files = sorted(
+            glob.glob(
+                os.path.join(self.run_dir, "Demultiplexing_*", ".bases2fastq_queued")
+            )
+        )
+        cores_budget = self.CONFIG.get("element_analysis").get("bases2fastq_cores")
+        if cores_budget is not None:
+            threads_in_use = self.get_bases2fastq_threads_in_use()
+        for n, queued_file in enumerate(queued_files):
+            demux_dir = os.path.dirname(queued_file)
+            with open(queued_file) as f:
+                run_manifest = f.read().strip()
+            if cores_budget is None:
+                n_threads = 8
+            else:
+                n_threads = allocate_threads(
+                    budget=cores_budget,
+                    in_use=threads_in_use,
+                    n_waiting=len(queued_files) - n,
+                    min_threads=self.CONFIG.get("element_analysis").get(
+                        "bases2fastq_min_threads", 4
+                    ),
+                    max_threads=self.CONFIG.get("element_analysis").get(
+                        "bases2fastq_max_threads", cores_budget
+                    ),
+                )
+                if n_threads is None:
+                    logger.info(
+                        f"{threads_in_use} of {cores_budget} bases2fastq cores are in use, "
+                        f"{len(queued_files) - n} demultiplexing job(s) of {self} stay queued."
+                    )
+                    break
+            if not self.start_demux(run_manifest, demux_dir, n_threads):
+                continue
+            if cores_budget is not None:
+                threads_in_use += n_threads
+            os.remove(queued_file)
+
+    def start_demux(self, run_manifest, demux_dir, n_threads=8):
+        """Start a bases2fastq job in the background, return True if it was started."""
         with chdir(self.run_dir):
-            cmd = self.generate_demux_command(run_manifest, demux_dir)
-            stderr_abspath = f"{self.run_dir}/bases2fastq_stderr.txt"  # TODO: individual files for each sub-demux
+            cmd = self.generate_demux_command(run_manifest, demux_dir, n_threads)
+            ongoing_abspath = os.path.join(demux_dir, ".bases2fastq_ongoing")
+            exit_abspath = os.path.join(demux_dir, ".bases2fastq_exit")
+            stderr_abspath = os.path.join(demux_dir, "bases2fastq_stderr.txt")
+            threads_abspath = os.path.join(demux_dir, ".bases2fastq_threads")
+            with open(threads_abspath, "w") as threads_file:
+                threads_file.write(str(n_threads))
+            # Track the PID and exit code of each job
+            full_cmd = "; ".join(
+                [
+                    f"echo $$ > {ongoing_abspath}",
+                    cmd,
+                    f"echo $? > {exit_abspath}",
+                    f"rm {ongoing_abspath}",
+                ]
+            )
             try:
                 with open(stderr_abspath, "w") as stderr:
                     process = subprocess.Popen(
-                        cmd,
+                        full_cmd,
                         shell=True,
                         cwd=self.run_dir,
                         stderr=stderr,
@@ -668,14 +883,17 @@ class Run:
                 logger.info(
                     "Bases2Fastq conversion and demultiplexing "
                     f"started for run {self} on {datetime.now()}"
-                    f"with p_handle {process}"
+                    f"with p_handle {process} and {n_threads} threads"
                 )
-            except subprocess.CalledProcessError:
+            except (subprocess.CalledProcessError, OSError):
+                # Release the threads claimed by the job
+                os.remove(threads_abspath)
                 logger.warning(
                     "An error occurred while starting demultiplexing for "
                     f"{self} on {datetime.now()}."
                 )
-        return
+                return False
+        return True
 
     def get_transfer_status(self):
         if (
@@ -717,29 +935,19 @@ class Run:
         else:
             return False
 
-    # Clear all content under a dir
-    def clear_dir(self, dir):
-        for filename in os.listdir(dir):
-            file_path = os.path.join(dir, filename)
-            try:
-                if os.path.isfile(file_path) or os.path.islink(file_path):
-                    os.unlink(file_path)
-                elif os.path.isdir(file_path):
-                    shutil.rmtree(file_path)
-            except Exception as e:
-                print(f"Failed to delete {file_path} Reason {e}")
-
-    # Write to csv
+    # Write to csv, replacing any existing file atomically
     def write_to_csv(self, data, filename):
         # Get the fieldnames from the keys of the first dictionary
         fieldnames = data[0].keys()
-        # Open the file and write the CSV
-        with open(filename, mode="w", newline="") as file:
+        # Open a temporary file and write the CSV
+        tmp_filename = f"{filename}.tmp"
+        with open(tmp_filename, mode="w", newline="") as file:
             writer = csv.DictWriter(file, fieldnames=fieldnames)
             # Write the header (fieldnames)
             writer.writeheader()
             # Write the data (rows)
             writer.writerows(data)
+        os.replace(tmp_filename, filename)
 
     # Collect demux info into a list of dictionaries
     # Structure: [{'sub_demux_count':XXX, 'SampleName':XXX, 'Index1':XXX, 'Index2':XXX, 'Lane':XXX, 'Project':XXX, 'Recipe':XXX}]
@@ -782,8 +990,40 @@ class Run:
         )
         return sorted_demux_runmanifest
 
-    # Aggregate the output FastQ files of samples from multiple demux
-    def aggregate_sample_fastq(self, demux_runmanifest):
+    # Scan the output FastQ files of all sub-demuxes once
+    # Structure: {(sub_demux_count, relative dir under Samples): [file names]}
+    def scan_demux_fastq(self, demux_runmanifest):
+        sub_demux_fastq = {}
+        sub_demux_list = sorted(
+            set(sample["sub_demux_count"] for sample in demux_runmanifest)
+        )
+        for sub_demux in sub_demux_list:
+            samples_dir = os.path.join(
+                self.run_dir, f"Demultiplexing_{sub_demux}", "Samples"
+            )
+            if not os.path.isdir(samples_dir):
+                continue
+            for project_entry in os.scandir(samples_dir):
+                if not project_entry.is_dir():
+                    continue
+                # Undetermined FastQ files are found directly under the project dir,
+                # sample FastQ files in one dir per sample
+                for entry in os.scandir(project_entry.path):
+                    if entry.is_file():
+                        sub_demux_fastq.setdefault(
+                            (sub_demux, project_entry.name), []
+                        ).append(entry.name)
+                    elif entry.is_dir():
+                        sub_demux_fastq[
+                            (sub_demux, f"{project_entry.name}/{entry.name}")
+                        ] = [e.name for e in os.scandir(entry.path) if e.is_file()]
+        return sub_demux_fastq
+
+    # Plan the symlinks to the output FastQ files of samples from multiple demux
+    # Structure: {link path relative to demux_dir: target abspath}
+    def plan_sample_fastq(self, demux_runmanifest, sub_demux_fastq):
+        planned_dirs = set()
+        planned_links = {}
         lanes = sorted(list(set(sample["Lane"] for sample in demux_runmanifest)))
         for lane in lanes:
             unique_sample_demux = set()
@@ -797,31 +1037,18 @@ class Run:
                 if lanenr == lane and sample_name != "PhiX":
                     sample_tuple = (sample_name, sub_demux_count)
                     if sample_tuple not in unique_sample_demux:
-                        project_dest = os.path.join(
-                            self.run_dir, self.demux_dir, project
-                        )
-                        sample_dest = os.path.join(
-                            self.run_dir,
-                            self.demux_dir,
-                            project,
-                            f"Sample_{sample_name}",
-                        )
-                        if not os.path.exists(project_dest):
-                            os.makedirs(project_dest)
-                        if not os.path.exists(sample_dest):
-                            os.makedirs(sample_dest)
-                        fastqfiles = glob.glob(
-                            os.path.join(
-                                self.run_dir,
-                                f"Demultiplexing_{sub_demux_count}",
-                                "Samples",
-                                project,
-                                sample_name,
-                                f"*L00{lane}*.fastq.gz",
-                            )
+                        sample_dest = os.path.join(project, f"Sample_{sample_name}")
+                        planned_dirs.add(project)
+                        planned_dirs.add(sample_dest)
+                        fastqfiles = fnmatch.filter(
+                            sub_demux_fastq.get(
+                                (sub_demux_count, f"{project}/{sample_name}"), []
+                            ),
+                            f"*L00{lane}*.fastq.gz",
                         )
-                        for fastqfile in fastqfiles:
-                            old_name = os.path.basename(fastqfile)
+                        for old_name in fastqfiles:
+                            if old_name.startswith("."):
+                                continue
                             read_label = re.search(
                                 rf"L00{lane}_(.*?)_001", old_name
                             ).group(1)
@@ -834,12 +1061,24 @@ class Run:
                                     "001.fastq.gz",
                                 ]
                             )
-                            os.symlink(fastqfile, os.path.join(sample_dest, new_name))
+                            planned_links[os.path.join(sample_dest, new_name)] = (
+                                os.path.join(
+                                    self.run_dir,
+                                    f"Demultiplexing_{sub_demux_count}",
+                                    "Samples",
+                                    project,
+                                    sample_name,
+                                    old_name,
+                                )
+                            )
                         unique_sample_demux.add(sample_tuple)
                         sample_count += 1
+        return planned_dirs, planned_links
 
-    # Symlink the output FastQ files of undet only if a lane does not have multiple demux
-    def aggregate_undet_fastq(self, demux_runmanifest):
+    # Plan the symlinks to the output FastQ files of undet only if a lane does not have multiple demux
+    def plan_undet_fastq(self, demux_runmanifest, sub_demux_fastq):
+        planned_dirs = set()
+        planned_links = {}
         lanes = sorted(list(set(sample["Lane"] for sample in demux_runmanifest)))
         for lane in lanes:
             sub_demux = list(
@@ -850,25 +1089,117 @@ class Run:
                 )
             )
             if len(sub_demux) == 1:
-                project_dest = os.path.join(
-                    self.run_dir, self.demux_dir, "Undetermined"
+                planned_dirs.add("Undetermined")
+                fastqfiles = fnmatch.filter(
+                    sub_demux_fastq.get((sub_demux[0], "Undetermined"), []),
+                    f"*L00{lane}*.fastq.gz",
                 )
-                if not os.path.exists(project_dest):
-                    os.makedirs(project_dest)
-                fastqfiles = glob.glob(
+                for base_name in fastqfiles:
+                    if base_name.startswith("."):
+                        continue
+                    # TODO: Make symlinks relative instead of absolute to maintain them after archiving
+                    planned_links[os.path.join("Undetermined", base_name)] = (
+                        os.path.join(
+                            self.run_dir,
+                            f"Demultiplexing_{sub_demux[0]}",
+                            "Samples",
+                            "Undetermined",
+                            base_name,
+                        )
+                    )
+        return planned_dirs, planned_links
+
+    # Apply the planned symlinks under demux_dir, only touching links that differ
+    def apply_fastq_plan(self, planned_dirs, planned_links):
+        # Collect existing symlinks
+        existing_links = {}
+        for root, _, files in os.walk(self.demux_dir):
+            for file in files:
+                link_path = os.path.join(root, file)
+                if os.path.islink(link_path):
+                    existing_links[os.path.relpath(link_path, self.demux_dir)] = (
+                        os.readlink(link_path)
+                    )
+
+        for planned_dir in sorted(planned_dirs):
+            os.makedirs(os.path.join(self.demux_dir, planned_dir), exist_ok=True)
+
+        n_changed = 0
+        for link, target in planned_links.items():
+            if existing_links.get(link) == target:
+                continue
+            # Replace the link atomically, so readers never see it missing
+            link_path = os.path.join(self.demux_dir, link)
+            tmp_link_path = f"{link_path}.tmp"
+            if os.path.lexists(tmp_link_path):
+                os.unlink(tmp_link_path)
+            os.symlink(target, tmp_link_path)
+            os.replace(tmp_link_path, link_path)
+            n_changed += 1
+
+        # Remove links that are no longer planned
+        n_removed = 0
+        for link in existing_links:
+            if link not in planned_links:
+                os.unlink(os.path.join(self.demux_dir, link))
+                n_removed += 1
+                # Remove the directories left empty, up to the planned ones
+                link_dir = os.path.dirname(link)
+                while link_dir and link_dir not in planned_dirs:
+                    dir_path = os.path.join(self.demux_dir, link_dir)
+                    if not os.path.isdir(dir_path) or os.listdir(dir_path):
+                        break
+                    os.rmdir(dir_path)
+                    link_dir = os.path.dirname(link_dir)
+
+        logger.info(
+            f"{self}: Aggregated FastQ files, {n_changed} links created or updated, {n_removed} removed and {len(planned_links) - n_changed} unchanged."
+        )
+
+    # Check that the planned symlinks are all in place under demux_dir
+    def fastq_plan_applied(self, planned_links):
+        for link, target in planned_links.items():
+            link_path = os.path.join(self.demux_dir, link)
+            if not os.path.islink(link_path) or os.readlink(link_path) != target:
+                return False
+        return True
+
+    # Progress of the demux aggregation, to resume after a crash
+    def read_aggregation_progress(self, plan_digest):
+        if os.path.exists(self.aggregation_progress_file):
+            with open(self.aggregation_progress_file) as progress_file:
+                progress = json.load(progress_file)
+            if progress.get("plan_digest") == plan_digest:
+                return progress.get("steps_done", [])
+        return []
+
+    def write_aggregation_progress(self, plan_digest, steps_done):
+        tmp_progress_file = f"{self.aggregation_progress_file}.tmp"
+        with open(tmp_progress_file, "w") as progress_file:
+            json.dump(
+                {"plan_digest": plan_digest, "steps_done": steps_done}, progress_file
+            )
+        os.replace(tmp_progress_file, self.aggregation_progress_file)
+
+    def get_aggregation_plan_digest(self, planned_links, demux_results_dirs):
+        """Hash the planned links together with the sub-demux stats files,
+        so that any change of the demux output invalidates the recorded progress."""
+        digest = hashlib.sha256()
+        digest.update(json.dumps(sorted(planned_links.items())).encode())
+        for demux_dir in sorted(demux_results_dirs):
+            for stats_file in sorted(
+                glob.glob(os.path.join(self.run_dir, demux_dir, "*.csv"))
+                + glob.glob(
                     os.path.join(
-                        self.run_dir,
-                        f"Demultiplexing_{sub_demux[0]}",
-                        "Samples",
-                        "Undetermined",
-                        f"*L00{lane}*.fastq.gz",
+                        self.run_dir, demux_dir, "Samples", "*", "*_RunStats.json"
                     )
                 )
-                for fastqfile in fastqfiles:
-                    base_name = os.path.basename(
-                        fastqfile
-                    )  # TODO: Make symlinks relative instead of absolute to maintain them after archiving
-                    os.symlink(fastqfile, os.path.join(project_dest, base_name))
+            ):
+                stat = os.stat(stats_file)
+                digest.update(
+                    f"{stats_file}:{stat.st_size}:{stat.st_mtime_ns}".encode()
+                )
+        return digest.hexdigest()
 
     # Read in each Project_RunStats.json to fetch PercentMismatch, PercentQ30, PercentQ40 and QualityScoreMean
     # Note that Element promised that they would include these stats into IndexAssignment.csv
@@ -925,12 +1256,20 @@ class Run:
         sub_demux_list = sorted(
             list(set(sample["sub_demux_count"] for sample in demux_runmanifest))
         )
-        lanes = sorted(list(set(sample["Lane"] for sample in demux_runmanifest)))
+        lanes = set(sample["Lane"] for sample in demux_runmanifest)
+        # Look up projects by sample name, keeping the first occurrence in the manifest
+        sample_projects = {}
+        for sample in demux_runmanifest:
+            sample_projects.setdefault(sample["SampleName"], sample["Project"])
         for sub_demux in sub_demux_list:
             # Read in each Project_RunStats.json to fetch PercentMismatch, PercentQ30, PercentQ40 and QualityScoreMean
             # Note that Element promised that they would include these stats into IndexAssignment.csv
             # But for now we have to do this by ourselves in this hard way
-            project_runstats = self.get_project_runstats(sub_demux, demux_runmanifest)
+            project_runstats = {}
+            for d in self.get_project_runstats(sub_demux, demux_runmanifest):
+                project_runstats.setdefault(
+                    (d["SampleName"], d["Lane"], d["ExpectedSequence"]), d
+                )
             # Read in IndexAssignment.csv
             assigned_csv = os.path.join(
                 self.run_dir, f"Demultiplexing_{sub_demux}", "IndexAssignment.csv"
@@ -941,20 +1280,20 @@ class Run:
                     index_assignment = [row for row in reader]
                 for sample in index_assignment:
                     if sample["Lane"] in lanes:
-                        project_runstats_sample = [
-                            d
-                            for d in project_runstats
-                            if d["SampleName"] == sample["SampleName"]
-                            and d["Lane"] == sample["Lane"]
-                            and d["ExpectedSequence"] == sample["I1"] + sample["I2"]
+                        project_runstats_sample = project_runstats[
+                            (
+                                sample["SampleName"],
+                                sample["Lane"],
+                                sample["I1"] + sample["I2"],
+                            )
                         ]
                         sample["sub_demux_count"] = sub_demux
-                        sample["PercentMismatch"] = project_runstats_sample[0][
+                        sample["PercentMismatch"] = project_runstats_sample[
                             "PercentMismatch"
                         ]
-                        sample["PercentQ30"] = project_runstats_sample[0]["PercentQ30"]
-                        sample["PercentQ40"] = project_runstats_sample[0]["PercentQ40"]
-                        sample["QualityScoreMean"] = project_runstats_sample[0][
+                        sample["PercentQ30"] = project_runstats_sample["PercentQ30"]
+                        sample["PercentQ40"] = project_runstats_sample["PercentQ40"]
+                        sample["QualityScoreMean"] = project_runstats_sample[
                             "QualityScoreMean"
                         ]
                         aggregated_assigned_indexes.append(sample)
@@ -964,51 +1303,47 @@ class Run:
                 )
         # Remove redundant rows for PhiX
         aggregated_assigned_indexes_filtered = []
-        phix_filtered = []
+        # PhiX records are only compared within the same lane
+        phix_filtered_by_lane = {}
         for sample in aggregated_assigned_indexes:
             # Add project name
-            sample["Project"] = [
-                d for d in demux_runmanifest if d["SampleName"] == sample["SampleName"]
-            ][0]["Project"]
+            sample["Project"] = sample_projects[sample["SampleName"]]
             # Get the PhiX with the longest index combination.
             if sample["SampleName"] == "PhiX":
-                lane = sample["Lane"]
                 idx1 = sample["I1"]
                 idx2 = sample["I2"]
                 num_polonies_assigned = sample["NumPoloniesAssigned"]
-                if not phix_filtered:
+                phix_filtered = phix_filtered_by_lane.setdefault(sample["Lane"], [])
+                found_flag = False
+                replaced_flag = False
+                for phix_record in list(phix_filtered):
+                    idx1_shorter_len = min(len(idx1), len(phix_record["I1"]))
+                    idx2_shorter_len = min(len(idx2), len(phix_record["I2"]))
+                    if (
+                        idx1[:idx1_shorter_len] == phix_record["I1"][:idx1_shorter_len]
+                        and idx2[:idx2_shorter_len]
+                        == phix_record["I2"][:idx2_shorter_len]
+                    ):
+                        found_flag = True
+                        # When the new record has a longer index combination length, take the new record and remove the old one
+                        # When the index combination length happen to be the same, keep the one with the higher polonies assigned
+                        if len(idx1) + len(idx2) > len(phix_record["I1"]) + len(
+                            phix_record["I2"]
+                        ) or (
+                            len(idx1) + len(idx2)
+                            == len(phix_record["I1"]) + len(phix_record["I2"])
+                            and num_polonies_assigned
+                            >= phix_record["NumPoloniesAssigned"]
+                        ):
+                            phix_filtered.remove(phix_record)
+                            replaced_flag = True
+                if not found_flag or replaced_flag:
                     phix_filtered.append(sample)
-                else:
-                    found_flag = False
-                    for phix_record in phix_filtered:
-                        if lane == phix_record["Lane"]:
-                            idx1_shorter_len = min(len(idx1), len(phix_record["I1"]))
-                            idx2_shorter_len = min(len(idx2), len(phix_record["I2"]))
-                            if (
-                                idx1[:idx1_shorter_len]
-                                == phix_record["I1"][:idx1_shorter_len]
-                                and idx2[:idx2_shorter_len]
-                                == phix_record["I2"][:idx2_shorter_len]
-                            ):
-                                found_flag = True
-                                # When the new record has a longer index combination length, take the new record and remove the old one
-                                # When the index combination length happen to be the same, keep the one with the higher polonies assigned
-                                if len(idx1) + len(idx2) > len(phix_record["I1"]) + len(
-                                    phix_record["I2"]
-                                ) or (
-                                    len(idx1) + len(idx2)
-                                    == len(phix_record["I1"]) + len(phix_record["I2"])
-                                    and num_polonies_assigned
-                                    >= phix_record["NumPoloniesAssigned"]
-                                ):
-                                    phix_filtered.remove(phix_record)
-                                    phix_filtered.append(sample)
-                    if not found_flag:
-                        phix_filtered.append(sample)
             else:
                 aggregated_assigned_indexes_filtered.append(sample)
         # Combine the list of samples and PhiX
-        aggregated_assigned_indexes_filtered += phix_filtered
+        for phix_filtered in phix_filtered_by_lane.values():
+            aggregated_assigned_indexes_filtered += phix_filtered
         # Sort the list by Lane, SampleName and sub_demux_count
         aggregated_assigned_indexes_filtered_sorted = sorted(
             aggregated_assigned_indexes_filtered,
@@ -1038,6 +1373,8 @@ class Run:
     ):
         aggregated_unassigned_indexes = []
         lanes = sorted(list(set(sample["Lane"] for sample in demux_runmanifest)))
+        # Rows of each UnassignedSequences.csv grouped by lane, read once per sub-demux
+        unassigned_indexes_by_lane = {}
         for lane in lanes:
             sub_demux_index_lens = set()
             for sample in demux_runmanifest:
@@ -1051,6 +1388,10 @@ class Run:
                             ),
                         )
                     )
+            # Index lengths of each sub-demux
+            index_lens = {}
+            for sub_demux, lens in sub_demux_index_lens:
+                index_lens.setdefault(sub_demux, lens)
             # List of sub-demux with a decreasing order of index lengths
             sub_demux_list = [
                 x[0]
@@ -1065,73 +1406,68 @@ class Run:
                 f"Demultiplexing_{sub_demux_with_max_index_lens}",
                 "UnassignedSequences.csv",
             )
-            if os.path.exists(max_unassigned_csv):
-                with open(max_unassigned_csv) as max_unassigned_file:
-                    reader = csv.DictReader(max_unassigned_file)
-                    max_unassigned_indexes = [row for row in reader]
-            else:
-                logger.warning(
-                    f"No {os.path.basename(max_unassigned_csv)} file found for sub-demultiplexing {sub_demux_with_max_index_lens}."
-                )
-                break
+            if max_unassigned_csv not in unassigned_indexes_by_lane:
+                if os.path.exists(max_unassigned_csv):
+                    unassigned_indexes_by_lane[max_unassigned_csv] = {}
+                    with open(max_unassigned_csv) as max_unassigned_file:
+                        reader = csv.DictReader(max_unassigned_file)
+                        for row in reader:
+                            unassigned_indexes_by_lane[max_unassigned_csv].setdefault(
+                                row["Lane"], []
+                            ).append(row)
+                else:
+                    logger.warning(
+                        f"No {os.path.basename(max_unassigned_csv)} file found for sub-demultiplexing {sub_demux_with_max_index_lens}."
+                    )
+                    break
             # Filter by lane
-            max_unassigned_indexes = [
-                idx for idx in max_unassigned_indexes if idx["Lane"] == lane
-            ]
+            max_unassigned_indexes = unassigned_indexes_by_lane[max_unassigned_csv].get(
+                lane, []
+            )
             # Complicated case with multiple demuxes. Take the full list if there is only one sub-demux otherwise
             if len(sub_demux_list) > 1:
-                # Order: from longer to shorter indexes
-                sub_demux_with_shorter_index_lens = sub_demux_list[1:]
-                for sub_demux in sub_demux_with_shorter_index_lens:
-                    sub_demux_assigned_indexes = [
-                        sub_demux_assigned_index
-                        for sub_demux_assigned_index in aggregated_assigned_indexes_filtered_sorted
-                        if sub_demux_assigned_index["sub_demux_count"] == sub_demux
-                        and sub_demux_assigned_index["Lane"] == lane
-                    ]
-                    # Remove overlapped indexes from the list of max_unassigned_indexes
+                # Collect the overlapping index prefixes assigned in the sub-demuxes with shorter indexes,
+                # grouped by the overlapping index lengths
+                assigned_prefixes = {}
+                for sub_demux in sub_demux_list[1:]:
                     idx1_overlapped_len = min(
-                        [
-                            demux_lens_pair[1]
-                            for demux_lens_pair in sub_demux_index_lens
-                            if demux_lens_pair[0] == sub_demux
-                        ][0][0],
-                        [
-                            demux_lens_pair[1]
-                            for demux_lens_pair in sub_demux_index_lens
-                            if demux_lens_pair[0] == sub_demux_with_max_index_lens
-                        ][0][0],
+                        index_lens[sub_demux][0],
+                        index_lens[sub_demux_with_max_index_lens][0],
                     )
                     idx2_overlapped_len = min(
-                        [
-                            demux_lens_pair[1]
-                            for demux_lens_pair in sub_demux_index_lens
-                            if demux_lens_pair[0] == sub_demux
-                        ][0][1],
-                        [
-                            demux_lens_pair[1]
-                            for demux_lens_pair in sub_demux_index_lens
-                            if demux_lens_pair[0] == sub_demux_with_max_index_lens
-                        ][0][1],
+                        index_lens[sub_demux][1],
+                        index_lens[sub_demux_with_max_index_lens][1],
                     )
-                    for sub_demux_assigned_index in sub_demux_assigned_indexes:
-                        idx1_overlapped_seq = sub_demux_assigned_index["I1"][
-                            :idx1_overlapped_len
-                        ]
-                        idx2_overlapped_seq = sub_demux_assigned_index["I2"][
-                            :idx2_overlapped_len
-                        ]
-                        # Remove the overlapped record from the max_unassigned_indexes list
-                        max_unassigned_indexes = [
-                            max_unassigned_index
-                            for max_unassigned_index in max_unassigned_indexes
-                            if not (
-                                max_unassigned_index["I1"][:idx1_overlapped_len]
-                                == idx1_overlapped_seq
-                                and max_unassigned_index["I2"][:idx2_overlapped_len]
-                                == idx2_overlapped_seq
+                    prefixes = assigned_prefixes.setdefault(
+                        (idx1_overlapped_len, idx2_overlapped_len), set()
+                    )
+                    for assigned_index in aggregated_assigned_indexes_filtered_sorted:
+                        if (
+                            assigned_index["sub_demux_count"] == sub_demux
+                            and assigned_index["Lane"] == lane
+                        ):
+                            prefixes.add(
+                                (
+                                    assigned_index["I1"][:idx1_overlapped_len],
+                                    assigned_index["I2"][:idx2_overlapped_len],
+                                )
                             )
-                        ]
+                # Remove the overlapped records from the max_unassigned_indexes list in one pass
+                max_unassigned_indexes = [
+                    max_unassigned_index
+                    for max_unassigned_index in max_unassigned_indexes
+                    if not any(
+                        (
+                            max_unassigned_index["I1"][:idx1_overlapped_len],
+                            max_unassigned_index["I2"][:idx2_overlapped_len],
+                        )
+                        in prefixes
+                        for (
+                            idx1_overlapped_len,
+                            idx2_overlapped_len,
+                        ), prefixes in assigned_prefixes.items()
+                    )
+                ]
             # Append to the aggregated_unassigned_indexes list
             aggregated_unassigned_indexes += max_unassigned_indexes
         # Sort aggregated_unassigned_indexes list first by lane and then by Count in the decreasing order
@@ -1203,34 +1539,82 @@ class Run:
             )
 
         # Write to a new UnassignedSequences.csv file under demux_dir
+        aggregated_unassigned_csv = os.path.join(
+            self.run_dir, self.demux_dir, "UnassignedSequences.csv"
+        )
         if aggregated_unassigned_indexes:
-            aggregated_unassigned_csv = os.path.join(
-                self.run_dir, self.demux_dir, "UnassignedSequences.csv"
-            )
             self.write_to_csv(aggregated_unassigned_indexes, aggregated_unassigned_csv)
+        elif os.path.exists(aggregated_unassigned_csv):
+            # Remove the output of a previous aggregation
+            os.remove(aggregated_unassigned_csv)
 
     # Aggregate demux results
     def aggregate_demux_results(self, demux_results_dirs):
+        """Aggregate the output of all sub-demuxes into demux_dir.
+
+        The target layout is planned from one scan of the sub-demux outputs and
+        only the differences to what is already in place are applied. Finished
+        steps are recorded, so that a crashed aggregation resumes where it stopped.
+        """
         # Ensure the destination directory exists
         if not os.path.exists(os.path.join(self.run_dir, self.demux_dir)):
             os.makedirs(os.path.join(self.run_dir, self.demux_dir))
-        # Clear all content under dest_dir
-        self.clear_dir(os.path.join(self.run_dir, self.demux_dir))
         demux_runmanifest = self.collect_demux_runmanifest(demux_results_dirs)
+        # Plan the FastQ symlinks from one scan of the sub-demux outputs
+        sub_demux_fastq = self.scan_demux_fastq(demux_runmanifest)
+        sample_dirs, sample_links = self.plan_sample_fastq(
+            demux_runmanifest, sub_demux_fastq
+        )
+        undet_dirs, undet_links = self.plan_undet_fastq(
+            demux_runmanifest, sub_demux_fastq
+        )
+        planned_links = {**sample_links, **undet_links}
+        plan_digest = self.get_aggregation_plan_digest(
+            planned_links, demux_results_dirs
+        )
+        steps_done = self.read_aggregation_progress(plan_digest)
+        # The plan only covers the inputs, so redo the finished steps whose
+        # output was removed since
+        if "fastq" in steps_done and not self.fastq_plan_applied(planned_links):
+            steps_done.remove("fastq")
+        if "assigned" in steps_done and not os.path.exists(
+            os.path.join(self.demux_dir, "IndexAssignment.csv")
+        ):
+            steps_done = [
+                step for step in steps_done if step not in ["assigned", "unassigned"]
+            ]
+        if steps_done:
+            logger.info(f"{self}: Resuming demux aggregation after {steps_done[-1]}.")
+
         # Aggregate the output FastQ files of samples from multiple demux
-        self.aggregate_sample_fastq(demux_runmanifest)
-        # Symlink the output FastQ files of undet only if a lane does not have multiple demux
-        self.aggregate_undet_fastq(demux_runmanifest)
+        # and of undet only if a lane does not have multiple demux
+        if "fastq" not in steps_done:
+            self.apply_fastq_plan(sample_dirs | undet_dirs, planned_links)
+            steps_done.append("fastq")
+            self.write_aggregation_progress(plan_digest, steps_done)
         # Aggregate stats in IndexAssignment.csv
-        aggregated_assigned_indexes_filtered_sorted = self.aggregate_stats_assigned(
-            demux_runmanifest
-        )
+        if "assigned" not in steps_done:
+            aggregated_assigned_indexes_filtered_sorted = self.aggregate_stats_assigned(
+                demux_runmanifest
+            )
+            steps_done.append("assigned")
+            self.write_aggregation_progress(plan_digest, steps_done)
+        else:
+            with open(os.path.join(self.demux_dir, "IndexAssignment.csv")) as file:
+                aggregated_assigned_indexes_filtered_sorted = list(csv.DictReader(file))
         # Aggregate stats in UnassignedSequences.csv
-        self.aggregate_stats_unassigned(
-            demux_runmanifest, aggregated_assigned_indexes_filtered_sorted
-        )
+        if "unassigned" not in steps_done:
+            self.aggregate_stats_unassigned(
+                demux_runmanifest, aggregated_assigned_indexes_filtered_sorted
+            )
+            steps_done.append("unassigned")
+            self.write_aggregation_progress(plan_digest, steps_done)
 
     def sync_metadata(self):
+        """Copy the metadata files of the run that changed into the metadata archive.
+
+        :returns: the number of bytes copied
+        """
         files_to_copy = [
             self.run_stats_file,
             os.path.join(self.run_dir, "Demultiplexing", "IndexAssignment.csv"),
@@ -1242,10 +1626,17 @@ class Run:
         if not os.path.exists(dest):
             os.makedirs(dest)
         for f in files_to_copy:  # UnassignedSequences.csv missing in NoIndex case
-            if os.path.exists(f):
-                shutil.copy(f, dest)
-            else:
-                logger.warning(f"File {f} missing for run {self.run}")
+            if not os.path.exists(f):
+                logger.warning(f"File {f} missing for run {self}")
+        sync_agent = MetadataSyncAgent(
+            src_path=self.run_dir,
+            dest_path=dest,
+            files={
+                os.path.relpath(f, self.run_dir): os.path.basename(f)
+                for f in files_to_copy
+            },
+        )
+        return sync_agent.transfer()
 
     def make_transfer_indicator(self):
         transfer_indicator = os.path.join(self.run_dir, ".rsync_ongoing")
@@ -1,9 +1,11 @@
 import csv
+import fnmatch
 import glob
 import json
 import logging
 import os
 import re
+import shlex
 import shutil
 import subprocess
 from datetime import datetime
@@ -12,8 +14,10 @@ from typing import Union
 import pandas as pd
 
 from taca.utils.config import CONFIG
+from taca.utils.filesystem import get_drop_folder_index
+from taca.utils.misc import allocate_threads
 from taca.utils.statusdb import NanoporeRunsConnection
-from taca.utils.transfer import RsyncAgent, RsyncError
+from taca.utils.transfer import MetadataSyncAgent, RsyncAgent, RsyncError
 
 logger = logging.getLogger(__name__)
 
@@ -22,6 +26,76 @@ ONT_RUN_PATTERN = re.compile(
 )
 
 
+def find_run_markers(data_dirs, marker_name: str) -> list[str]:
+    """Return the abspaths of all files named marker_name found directly
+    within the run dirs of the given data dirs."""
+
+    marker_abspaths = []
+    for data_dir in sorted(data_dirs):
+        if not os.path.isdir(data_dir):
+            continue
+        with os.scandir(data_dir) as entries:
+            for entry in entries:
+                marker_abspath = os.path.join(entry.path, marker_name)
+                if entry.is_dir() and os.path.exists(marker_abspath):
+                    marker_abspaths.append(marker_abspath)
+
+    return marker_abspaths
+
+
+def prefetch_run_statuses(run_dirs: list[str]):
+    """Fetch the database entries of all given runs with one query, so that the
+    run objects of a sweep check their status without querying the database."""
+
+    db = NanoporeRunsConnection(CONFIG["statusdb"], dbname="nanopore_runs")
+    db.prefetch_run_statuses(os.path.basename(run_dir) for run_dir in run_dirs)
+
+
+def read_length_n50(length_counts: pd.Series | None) -> int | None:
+    """Calculate the read length N50 from a series of read counts indexed by read length."""
+
+    if length_counts is None or length_counts.empty:
+        return None
+
+    length_counts = length_counts.sort_index(ascending=False)
+    cum_bases = (length_counts.index.to_series() * length_counts).cumsum()
+    return int(cum_bases[cum_bases >= cum_bases.iloc[-1] / 2].index[0])
+
+
+def summarize_read_lengths(
+    all_counts: pd.Series | None, pass_counts: pd.Series | None
+) -> dict:
+    """Summarize read counts, yields and N50s from read length counts."""
+
+    def _reads(counts):
+        return 0 if counts is None else int(counts.sum())
+
+    def _bases(counts):
+        return 0 if counts is None else int((counts.index * counts).sum())
+
+    read_count = _reads(all_counts)
+    pass_read_count = _reads(pass_counts)
+
+    return {
+        "read_count": read_count,
+        "pass_read_count": pass_read_count,
+        "pass_reads_pc": round(100 * pass_read_count / read_count, 2)
+        if read_count
+        else None,
+        "yield_bases": _bases(all_counts),
+        "pass_yield_bases": _bases(pass_counts),
+        "read_length_n50": read_length_n50(all_counts),
+        "pass_read_length_n50": read_length_n50(pass_counts),
+    }
+
+
+def _sum_counts(counts_iter) -> pd.Series | None:
+    counts = [c for c in counts_iter if c is not None]
+    if not counts:
+        return None
+    return pd.concat(counts).groupby(level=0).sum()
+
+
 class ONT_run:
     """General Nanopore run.
 
@@ -33,6 +107,9 @@ class ONT_run:
         self.run_name = os.path.basename(run_abspath)
         self.run_abspath = run_abspath
 
+        # Snapshot of the top-level run dir contents, see list_run_dir()
+        self._run_dir_listing: dict[str, bool] | None = None
+
         self.run_type: str | None = (
             None  # This will be defined upon instantiation of a child class
         )
@@ -65,38 +142,88 @@ class ONT_run:
             "toulligqc_reports_dir"
         ]
         self.toulligqc_executable = CONFIG["nanopore_analysis"]["toulligqc_executable"]
+        self.toulligqc_max_concurrent = CONFIG["nanopore_analysis"].get(
+            "toulligqc_max_concurrent", 2
+        )
+        self.sequencing_summary_chunksize = CONFIG["nanopore_analysis"].get(
+            "sequencing_summary_chunksize", 1_000_000
+        )
         self.analysis_server = CONFIG["nanopore_analysis"].get("analysis_server", None)
         self.rsync_options = CONFIG["nanopore_analysis"]["rsync_options"]
         for k, v in self.rsync_options.items():
             if v == "None":
                 self.rsync_options[k] = None
 
+        # Get ToulligQC attributes from run
+        self.toulligqc_report_dir_name = "toulligqc_report"
+        self.toulligqc_done_abspath = f"{self.run_abspath}/.toulligqc_done"
+        self.toulligqc_ongoing_abspath = f"{self.run_abspath}/.toulligqc_ongoing"
+        self.toulligqc_published_abspath = f"{self.run_abspath}/.toulligqc_published"
+
         # Get DB
         self.db = NanoporeRunsConnection(CONFIG["statusdb"], dbname="nanopore_runs")
 
     # Looking for files within the run dir
 
-    def has_file(self, content_pattern: str) -> bool:
-        """Checks within run dir for pattern, e.g. '/report*.json', returns bool."""
-        query_path = self.run_abspath + content_pattern
-        query_glob = glob.glob(query_path)
+    def list_run_dir(self) -> dict[str, bool]:
+        """Return a snapshot of the top-level contents of the run dir, mapping
+        entry names to whether they are directories.
 
-        if len(query_glob) > 0:
-            return True
+        The run dir is only read once and the snapshot is reused for all
+        subsequent lookups, until invalidate_run_dir_listing() is called.
+        """
+        if self._run_dir_listing is None:
+            listing = {}
+            with os.scandir(self.run_abspath) as entries:
+                for entry in entries:
+                    listing[entry.name] = entry.is_dir()
+            self._run_dir_listing = listing
+        return self._run_dir_listing
+
+    def invalidate_run_dir_listing(self):
+        """Discard the run dir snapshot, e.g. after TACA has written to the run dir."""
+        self._run_dir_listing = None
+
+    def query_run_dir(self, content_pattern: str) -> list[str]:
+        """Checks within run dir for pattern, e.g. '/report*.json', returns sorted list of matching abspaths.
+
+        Top-level patterns are matched against the run dir snapshot, deeper patterns
+        fall back to globbing, but only if their top-level dir is in the snapshot.
+        """
+        relative_pattern = content_pattern.lstrip("/")
+        top_level_pattern, _, subpattern = relative_pattern.partition("/")
+
+        matches = fnmatch.filter(self.list_run_dir(), top_level_pattern)
+        # Mimic glob, which ignores hidden entries unless explicitly queried
+        if not top_level_pattern.startswith("."):
+            matches = [match for match in matches if not match.startswith(".")]
+
+        if subpattern:
+            return sorted(
+                path
+                for match in matches
+                if self.list_run_dir()[match]
+                for path in glob.glob(os.path.join(self.run_abspath, match, subpattern))
+            )
         else:
-            return False
+            return [os.path.join(self.run_abspath, match) for match in sorted(matches)]
+
+    def has_file(self, content_pattern: str) -> bool:
+        """Checks within run dir for pattern, e.g. '/report*.json', returns bool."""
+        return len(self.query_run_dir(content_pattern)) > 0
 
     def get_file(self, content_pattern) -> str:
         """Checks within run dir for pattern, e.g. '/report*.json', returns file abspath as string."""
-        query_path = self.run_abspath + content_pattern
-        query_glob = glob.glob(query_path)
+        query_results = self.query_run_dir(content_pattern)
 
-        if len(query_glob) == 1:
-            return query_glob[0]
-        elif len(query_glob) == 0:
-            raise AssertionError(f"Could not find {query_path}")
+        if len(query_results) == 1:
+            return query_results[0]
+        elif len(query_results) == 0:
+            raise AssertionError(f"Could not find {self.run_abspath + content_pattern}")
         else:
-            raise AssertionError(f"Found multiple instances of {query_path}")
+            raise AssertionError(
+                f"Found multiple instances of {self.run_abspath + content_pattern}"
+            )
 
     # Evaluating run status
 
@@ -113,7 +240,7 @@ class ONT_run:
         # Raw seq files
         assert any(
             [
-                dir in os.listdir(self.run_abspath)
+                dir in self.list_run_dir()
                 for dir in ["pod5", "pod5_pass", "fast5", "fast5_pass"]
             ]
         )
@@ -189,6 +316,9 @@ class ONT_run:
             # Parse pore_activity_*.csv
             self.parse_pore_activity(db_update)
 
+            # Parse sequencing_summary_*.txt
+            self.parse_sequencing_summary(db_update)
+
             # Update the DB entry
             self.db.finish_ongoing_run(self, db_update)
 
@@ -251,6 +381,79 @@ class ONT_run:
         # Add to the db update
         db_update["pore_activity"] = pore_activity
 
+    def parse_sequencing_summary(self, db_update):
+        """Summarize read counts, yields and read length N50s per barcode from
+        the sequencing summary file.
+
+        The file is streamed in chunks, reading only the needed columns, and
+        each chunk is reduced to read length counts, so memory use is bounded
+        by the number of distinct read lengths rather than the number of reads.
+        """
+
+        logger.info(f"{self.run_name}: Parsing sequencing summary...")
+
+        summary_files = self.query_run_dir("/sequencing_summary*.txt")
+        if len(summary_files) != 1:
+            logger.warning(
+                f"{self.run_name}: Found {len(summary_files)} sequencing summary files, skipping read summary."
+            )
+            return
+
+        length_col = "sequence_length_template"
+        filter_col = "passes_filtering"
+        barcode_col = "barcode_arrangement"
+
+        # Read length counts per barcode, for all reads and passed reads
+        length_counts: dict[str, dict[str, pd.Series]] = {}
+
+        try:
+            chunks = pd.read_csv(
+                summary_files[0],
+                sep="\t",
+                usecols=lambda col: col in [length_col, filter_col, barcode_col],
+                chunksize=self.sequencing_summary_chunksize,
+                engine="c",
+            )
+            for chunk in chunks:
+                if barcode_col not in chunk.columns:
+                    chunk[barcode_col] = "all"
+                passed = chunk[filter_col].astype(str).str.lower() == "true"
+                for (barcode, is_pass), lengths in chunk.groupby(
+                    [chunk[barcode_col], passed]
+                )[length_col]:
+                    counts = length_counts.setdefault(barcode, {})
+                    chunk_counts = lengths.value_counts()
+                    for key in ["all", "pass"] if is_pass else ["all"]:
+                        if key in counts:
+                            counts[key] = (
+                                counts[key].add(chunk_counts, fill_value=0)
+                            ).astype("int64")
+                        else:
+                            counts[key] = chunk_counts
+        except pd.errors.EmptyDataError:
+            logger.warning(
+                f"{self.run_name}: Sequencing summary is empty, skipping read summary."
+            )
+            return
+        except (KeyError, ValueError) as e:
+            logger.warning(
+                f"{self.run_name}: Could not parse sequencing summary ({e}), skipping read summary."
+            )
+            return
+
+        read_summary = {
+            barcode: summarize_read_lengths(counts.get("all"), counts.get("pass"))
+            for barcode, counts in sorted(length_counts.items())
+        }
+        if read_summary:
+            read_summary["all"] = summarize_read_lengths(
+                _sum_counts(counts.get("all") for counts in length_counts.values()),
+                _sum_counts(counts.get("pass") for counts in length_counts.values()),
+            )
+
+        # Add to the db update
+        db_update["read_summary"] = read_summary
+
     def parse_minknow_json(self, db_update):
         """Parse useful stuff from the MinKNOW .json report to add to CouchDB"""
 
@@ -304,30 +507,22 @@ class ONT_run:
     # Transferring metadata
 
     def copy_metadata(self):
-        """Copies run dir (excluding seq data) to metadata dir"""
+        """Copies changed files of the run dir (excluding seq data) to the metadata dir
 
-        exclude_patterns = [
+        :returns: the number of bytes copied
+        """
+
+        sync_agent = MetadataSyncAgent(
+            src_path=self.run_abspath,
+            dest_path=os.path.join(
+                self.transfer_details["metadata_dir"], self.run_name
+            ),
             # Main seq dirs
-            "**/bam*/***",
-            "**/fast5*/***",
-            "**/fastq*/***",
-            "**/pod5*/***",
+            exclude_dirs=["bam*", "fast5*", "fastq*", "pod5*"],
             # Any files found elsewhere
-            "*.bam*",
-            "*.bai*",
-            "*.fast5*",
-            "*.fastq*",
-            "*.pod5*",
-        ]
-
-        exclude_patterns_quoted = ["'" + pattern + "'" for pattern in exclude_patterns]
-
-        src = self.run_abspath
-        dst = self.transfer_details["metadata_dir"]
-
-        os.system(
-            f"rsync -rv --exclude={{{','.join(exclude_patterns_quoted)}}} {src} {dst}"
+            exclude_files=["*.bam*", "*.bai*", "*.fast5*", "*.fastq*", "*.pod5*"],
         )
+        return sync_agent.transfer()
 
     def copy_html_report(self):
         logger.info(f"{self.run_name}: Transferring .html report to ngi-internal...")
@@ -350,20 +545,95 @@ class ONT_run:
             logger.error(msg)
             raise RsyncError(msg)
 
-    def toulligqc_report(self):
-        """Generate a QC report for the run using ToulligQC and publish it to GenStat."""
+    # ToulligQC methods
 
-        report_dir_name = "toulligqc_report"
+    def get_toulligqc_exit_code(self) -> int | None:
+        """Check whether ToulligQC has finished.
 
-        # Do not run this function if it's output dir exists in the run dir
-        if os.path.exists(f"{self.run_abspath}/{report_dir_name}"):
-            logging.info(
-                f"{self.run_name}: ToulligQC report dir already exists, skipping."
-            )
+        Return exit code or None.
+        """
+        if os.path.exists(self.toulligqc_done_abspath):
+            return int(open(self.toulligqc_done_abspath).read())
+        else:
+            return None
+
+    def get_toulligqc_pid(self) -> str | None:
+        """Check whether ToulligQC is ongoing.
+
+        Return process ID or None."""
+        if os.path.exists(self.toulligqc_ongoing_abspath):
+            return str(open(self.toulligqc_ongoing_abspath).read())
+        else:
             return None
 
+    def count_ongoing_toulligqc(self) -> int:
+        """Count the ToulligQC reports currently being generated for any run
+        in the data dirs of the config."""
+
+        data_dirs = set()
+        for run_type_config in CONFIG["nanopore_analysis"]["run_types"].values():
+            data_dirs.update(run_type_config.get("data_dirs", []))
+
+        return len(find_run_markers(data_dirs, ".toulligqc_ongoing"))
+
+    def toulligqc_report(self) -> bool:
+        """Generate a QC report for the run using ToulligQC and publish it to GenStat.
+
+        ToulligQC is run as a background process, which is checked upon by
+        subsequent calls. Return True once the report is finished and published,
+        otherwise False.
+        """
+
+        exit_code = self.get_toulligqc_exit_code()
+
+        # ToulligQC not run
+        if exit_code is None:
+            toulligqc_pid = self.get_toulligqc_pid()
+            if toulligqc_pid:
+                logger.info(
+                    f"{self.run_name}: ToulligQC is ongoing with process ID {toulligqc_pid}."
+                )
+                return False
+
+            # Do not run ToulligQC if it's output dir exists in the run dir
+            if self.toulligqc_report_dir_name in self.list_run_dir():
+                logger.info(
+                    f"{self.run_name}: ToulligQC report dir already exists, skipping."
+                )
+                return True
+
+            n_ongoing = self.count_ongoing_toulligqc()
+            if n_ongoing >= self.toulligqc_max_concurrent:
+                logger.info(
+                    f"{self.run_name}: {n_ongoing} ToulligQC reports are already being generated, waiting."
+                )
+                return False
+
+            self.run_toulligqc()
+            return False
+
+        # ToulligQC run
+        elif exit_code == 0:
+            if os.path.exists(self.toulligqc_published_abspath):
+                return True
+            logger.info(f"{self.run_name}: ToulligQC report generated successfully.")
+            self.publish_toulligqc_report()
+            open(self.toulligqc_published_abspath, "w").close()
+            return True
+        else:
+            raise AssertionError(
+                f"{self.run_name}: ToulligQC failed with exit code {exit_code}."
+            )
+
+    def run_toulligqc(self):
+        """Run ToulligQC as a background subprocess.
+        Dump files to indicate ongoing and finished processes.
+        """
+
+        timestamp = datetime.now().strftime("%Y_%m_%d_%H%M%S")
+
         # Get sequencing summary file
-        glob_summary = glob.glob(f"{self.run_abspath}/sequencing_summary*.txt")
+        glob_summary = self.query_run_dir("/sequencing_summary*.txt")
         assert len(glob_summary) == 1, f"Found {len(glob_summary)} summary files"
         summary = glob_summary[0]
 
@@ -376,7 +646,7 @@ class ONT_run:
         ]
         raw_data_dir = None
         for raw_data_dir_option in raw_data_dir_options:
-            if os.path.exists(f"{self.run_abspath}/{raw_data_dir_option}"):
+            if raw_data_dir_option in self.list_run_dir():
                 raw_data_dir = raw_data_dir_option
                 break
         if raw_data_dir is None:
@@ -384,17 +654,17 @@ class ONT_run:
         raw_data_format = "pod5" if "pod5" in raw_data_dir else "fast5"
 
         # Load samplesheet, if any
-        ss_glob = glob.glob(f"{self.run_abspath}/sample_sheet*.csv")
+        ss_glob = self.query_run_dir("/sample_sheet*.csv")
         if len(ss_glob) == 0:
             samplesheet = None
         elif len(ss_glob) > 1:
             # If multiple samplesheet, use latest one
-            samplesheet = ss_glob.sort()[-1]
+            samplesheet = ss_glob[-1]
         else:
             samplesheet = ss_glob[0]
 
         # Run has barcode subdirs
-        barcode_dirs_glob = glob.glob(f"{self.run_abspath}/{raw_data_dir}/barcode*")
+        barcode_dirs_glob = self.query_run_dir(f"/{raw_data_dir}/barcode*")
         if len(barcode_dirs_glob) > 0:
             barcode_dirs = True
             raw_data_path = barcode_dirs_glob[0]
@@ -421,7 +691,7 @@ class ONT_run:
             "--sequencing-summary-source": summary,
             f"--{raw_data_format}-source": raw_data_path,
             "--output-directory": self.run_abspath,
-            "--report-name": report_dir_name,
+            "--report-name": self.toulligqc_report_dir_name,
         }
         if barcode_dirs:
             command_args["--barcoding"] = ""
@@ -436,23 +706,60 @@ class ONT_run:
             if v:
                 command_list.append(v)
 
-        # Run the command
-        # Small enough to wait for, should be done in 1-5 minutes
-        process = subprocess.run(command_list)
+        # Create dir to trace TACA executing ToulligQC as a subprocess
+        taca_toulligqc_run_dir = f"taca_toulligqc_run_{timestamp}"
+        taca_toulligqc_run_dir_abspath = f"{self.run_abspath}/{taca_toulligqc_run_dir}"
+        os.mkdir(taca_toulligqc_run_dir_abspath)
+        self.invalidate_run_dir_listing()
+        # Create files to dump subprocess std
+        stderr_abspath = f"{taca_toulligqc_run_dir_abspath}/stderr.txt"
 
-        # Check if the command was successful
-        if process.returncode == 0:
-            logging.info(f"{self.run_name}: ToulligQC report generated successfully.")
-        else:
-            raise subprocess.CalledProcessError(process.returncode, command_list)
+        full_command = [
+            # Dump subprocess PID into 'run-ongoing'-indicator file.
+            f"echo $$ > {self.toulligqc_ongoing_abspath}",
+            # Run ToulligQC
+            shlex.join(command_list),
+            # Dump ToulligQC exit code into file
+            f"echo $? > {self.toulligqc_done_abspath}",
+            # Remove 'run-ongoing' file.
+            f"rm {self.toulligqc_ongoing_abspath}",
+        ]
+
+        with open(f"{taca_toulligqc_run_dir_abspath}/command.sh", "w") as stream:
+            stream.write("\n".join(full_command))
 
-        # Copy the report to GenStat
+        # Mark the run as ongoing before starting, so that runs handled later in
+        # the same sweep count it towards the limit. The subprocess overwrites
+        # the marker with its PID.
+        with open(self.toulligqc_ongoing_abspath, "w") as stream:
+            stream.write("starting")
+
+        # Start ToulligQC subprocess
+        try:
+            with open(stderr_abspath, "w") as stderr:
+                process = subprocess.Popen(
+                    f"bash {taca_toulligqc_run_dir}/command.sh",
+                    shell=True,
+                    cwd=self.run_abspath,
+                    stderr=stderr,
+                )
+        except OSError:
+            os.remove(self.toulligqc_ongoing_abspath)
+            raise
+        logger.info(
+            f"{self.run_name}: ToulligQC subprocess started with process ID {process.pid}."
+        )
+
+    def publish_toulligqc_report(self):
+        """Copy the ToulligQC report to GenStat."""
 
         logger.info(
             f"{self.run_name}: Transferring ToulligQC report to ngi-internal..."
         )
         # Transfer the ToulligQC .html report file to ngi-internal, renaming it to the full run ID. Requires password-free SSH access.
-        report_src_path = self.get_file(f"/{report_dir_name}/report.html")
+        report_src_path = self.get_file(
+            f"/{self.toulligqc_report_dir_name}/report.html"
+        )
         report_dest_path = os.path.join(
             self.toulligqc_reports_dir,
             f"report_{self.run_name}.html",
@@ -555,6 +862,14 @@ class ONT_qc_run(ONT_run):
             "anglerfish_samplesheets_dir"
         ]
         self.anglerfish_path = self.anglerfish_config["anglerfish_path"]
+        self.anglerfish_threads_budget = self.anglerfish_config.get("threads_budget", 8)
+        self.anglerfish_min_threads = self.anglerfish_config.get("min_threads", 2)
+        self.anglerfish_threads_per_barcode = self.anglerfish_config.get(
+            "threads_per_barcode", 2
+        )
+
+        self.anglerfish_queued_abspath = f"{self.run_abspath}/.anglerfish_queued"
+        self.anglerfish_threads_abspath = f"{self.run_abspath}/.anglerfish_threads"
 
     def is_transferred(self) -> bool:
         """Return True if run ID in transfer.tsv, else False."""
@@ -592,27 +907,23 @@ class ONT_qc_run(ONT_run):
         b) If the file is not yet available, return False.
         """
 
-        # Define query pattern
-        expected_file_pattern = f"*{self.run_name}*.csv"
-        pattern_abspath = os.path.join(
-            self.anglerfish_samplesheets_dir, "*", expected_file_pattern
-        )
-
-        glob_results = glob.glob(pattern_abspath)
+        # Look up the samplesheets in the index of the nested drop folder
+        found_paths = get_drop_folder_index(
+            self.anglerfish_samplesheets_dir, ".csv", depth=1
+        ).find(self.run_name)
 
-        if len(glob_results) == 0:
+        if len(found_paths) == 0:
             return False
 
         else:
-            # Sort by ascending date
-            glob_results.sort()
-
-            # Grab abspath of latest samplesheet
-            src = glob_results[-1]
+            # Grab abspath of latest samplesheet, paths are sorted by ascending date
+            src = found_paths[-1]
             dst = os.path.join(self.run_abspath, os.path.basename(src))
 
             # Copy into run directory
-            if os.system(f"rsync -v {src} {dst}") == 0:
+            exit_code = os.system(f"rsync -v {src} {dst}")
+            self.invalidate_run_dir_listing()
+            if exit_code == 0:
                 self.anglerfish_samplesheet = dst
                 return True
             else:
@@ -623,9 +934,7 @@ class ONT_qc_run(ONT_run):
     def has_fastq_output(self) -> bool:
         """Check whether run has fastq output."""
 
-        reads_dir = os.path.join(self.run_abspath, "fastq_pass")
-
-        return os.path.exists(reads_dir)
+        return "fastq_pass" in self.list_run_dir()
 
     def has_raw_seq_output(self) -> bool:
         """Check whether run has sequencing data output."""
@@ -633,32 +942,88 @@ class ONT_qc_run(ONT_run):
         raw_seq_dirs = ["pod5", "pod5_pass", "fast5", "fast5_pass"]
 
         for dir in raw_seq_dirs:
-            if os.path.exists(os.path.join(self.run_abspath, dir)):
+            if dir in self.list_run_dir():
                 return True
 
         return False
 
-    def has_barcode_dirs(self) -> bool:
+    def count_barcode_dirs(self) -> int:
         barcode_dir_pattern = r"barcode\d{2}"
 
-        for dir in os.listdir(os.path.join(self.run_abspath, "fastq_pass")):
-            if re.search(barcode_dir_pattern, dir):
-                return True
+        return len(
+            [
+                dir
+                for dir in os.listdir(os.path.join(self.run_abspath, "fastq_pass"))
+                if re.search(barcode_dir_pattern, dir)
+            ]
+        )
 
-        return False
+    def has_barcode_dirs(self) -> bool:
+        return self.count_barcode_dirs() > 0
+
+    def allocate_anglerfish_threads(self) -> int | None:
+        """Queue the run for Anglerfish and size its share of the host-wide
+        thread budget.
+
+        Threads held by ongoing Anglerfish runs are taken from the budget and
+        the remainder is shared between all queued runs, capped by the number
+        of barcodes of this run. Return the number of threads to use, or None
+        if the run has to stay in the queue until threads are freed.
+        """
 
-    def run_anglerfish(self):
+        data_dirs = CONFIG["nanopore_analysis"]["run_types"][self.run_type]["data_dirs"]
+
+        # Put run in queue
+        if not os.path.exists(self.anglerfish_queued_abspath):
+            open(self.anglerfish_queued_abspath, "w").close()
+            self.invalidate_run_dir_listing()
+
+        # Sum up threads of ongoing runs
+        threads_in_use = 0
+        for ongoing_abspath in find_run_markers(data_dirs, ".anglerfish_ongoing"):
+            threads_abspath = os.path.join(
+                os.path.dirname(ongoing_abspath), ".anglerfish_threads"
+            )
+            if os.path.exists(threads_abspath):
+                threads_in_use += int(open(threads_abspath).read())
+            else:
+                threads_in_use += self.anglerfish_min_threads
+
+        n_queued = len(find_run_markers(data_dirs, ".anglerfish_queued"))
+
+        n_threads = allocate_threads(
+            budget=self.anglerfish_threads_budget,
+            in_use=threads_in_use,
+            n_waiting=n_queued,
+            min_threads=self.anglerfish_min_threads,
+            max_threads=self.anglerfish_threads_per_barcode
+            * max(self.count_barcode_dirs(), 1),
+        )
+
+        if n_threads is None:
+            logger.info(
+                f"{self.run_name}: {threads_in_use} of {self.anglerfish_threads_budget} Anglerfish threads are in use, waiting in queue."
+            )
+        else:
+            logger.info(
+                f"{self.run_name}: Allocated {n_threads} Anglerfish threads, {n_queued} run(s) in queue."
+            )
+
+        return n_threads
+
+    def run_anglerfish(self, n_threads: int | None = None):
         """Run Anglerfish as subprocess within it's own Conda environment.
         Dump files to indicate ongoing and finished processes.
         """
 
+        if n_threads is None:
+            n_threads = self.anglerfish_min_threads
+
         timestamp = datetime.now().strftime("%Y_%m_%d_%H%M%S")
 
         # "anglerfish_run*" is the dir pattern recognized by the LIMS script parsing the results
         anglerfish_run_name = "anglerfish_run"
 
-        n_threads = 2  # This could possibly be changed
-
         anglerfish_command = [
             self.anglerfish_path,
             "run",
@@ -679,6 +1044,7 @@ class ONT_qc_run(ONT_run):
             f"{self.run_abspath}/{taca_anglerfish_run_dir}"
         )
         os.mkdir(taca_anglerfish_run_dir_abspath)
+        self.invalidate_run_dir_listing()
         # Copy samplesheet used for traceability
         shutil.copy(self.anglerfish_samplesheet, taca_anglerfish_run_dir_abspath)
         # Create files to dump subprocess std
@@ -706,14 +1072,29 @@ class ONT_qc_run(ONT_run):
         with open(f"{taca_anglerfish_run_dir_abspath}/command.sh", "w") as stream:
             stream.write("\n".join(full_command))
 
+        # Claim threads from the budget and leave the queue. The run is marked
+        # as ongoing before starting, so that runs handled later in the same
+        # sweep count its threads. The subprocess overwrites the marker with its PID.
+        with open(self.anglerfish_threads_abspath, "w") as stream:
+            stream.write(str(n_threads))
+        with open(self.anglerfish_ongoing_abspath, "w") as stream:
+            stream.write("starting")
+        if os.path.exists(self.anglerfish_queued_abspath):
+            os.remove(self.anglerfish_queued_abspath)
+        self.invalidate_run_dir_listing()
+
         # Start Anglerfish subprocess
-        with open(stderr_abspath, "w") as stderr:
-            process = subprocess.Popen(
-                f"bash {taca_anglerfish_run_dir}/command.sh",
-                shell=True,
-                cwd=self.run_abspath,
-                stderr=stderr,
-            )
+        try:
+            with open(stderr_abspath, "w") as stderr:
+                process = subprocess.Popen(
+                    f"bash {taca_anglerfish_run_dir}/command.sh",
+                    shell=True,
+                    cwd=self.run_abspath,
+                    stderr=stderr,
+                )
+        except OSError:
+            os.remove(self.anglerfish_ongoing_abspath)
+            raise
         logger.info(
             f"{self.run_name}: Anglerfish subprocess started with process ID {process.pid}."
         )
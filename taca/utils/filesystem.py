@@ -1,6 +1,7 @@
 """Filesystem utilities."""
 
 import contextlib
+import functools
 import os
 import shutil
 
@@ -50,3 +51,81 @@ def do_copy(src_path, dst_path):
     # if symlinks, will copy content, not the links
     # dst_path will be created, it must NOT exist
     shutil.copytree(src_path, dst_path)
+
+
+class DropFolderIndex:
+    """Index of the files dropped by LIMS in a folder, to look them up by e.g.
+    flowcell ID, LIMS step ID or run name without listing the folder each time.
+
+    Files are matched like the glob "*<key>*<suffix>", by a substring search of
+    their cached names. The listing of a directory is only read again when its
+    modification time changes.
+
+    :param str root: Folder to index
+    :param str suffix: Suffix of the files to index, e.g. ".zip"
+    :param int depth: Number of subdirectory levels between root and the files
+    """
+
+    def __init__(self, root, suffix, depth=0):
+        self.root = root
+        self.suffix = suffix
+        self.depth = depth
+        # Directory path -> (mtime, subdirectories, files)
+        self._listings = {}
+        # (file name, file path) of the indexed files
+        self._files = []
+
+    def _list_dir(self, dir_path, listing):
+        try:
+            mtime = os.stat(dir_path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        if listing is None or listing[0] != mtime:
+            subdirs, files = [], []
+            with os.scandir(dir_path) as entries:
+                for entry in entries:
+                    if entry.name.startswith("."):
+                        continue
+                    if entry.is_dir():
+                        subdirs.append(entry.path)
+                    elif entry.name.endswith(self.suffix):
+                        files.append(entry.path)
+            listing = (mtime, subdirs, files)
+        return listing
+
+    def refresh(self):
+        """Read the listings of new or modified directories and update the index."""
+        previous_listings = self._listings
+        self._listings = {}
+        dir_paths = [self.root]
+        for level in range(self.depth + 1):
+            next_dir_paths = []
+            for dir_path in dir_paths:
+                listing = self._list_dir(dir_path, previous_listings.get(dir_path))
+                if listing is not None:
+                    self._listings[dir_path] = listing
+                    next_dir_paths.extend(listing[1])
+            if level < self.depth:
+                dir_paths = next_dir_paths
+        if self._listings == previous_listings:
+            return
+
+        self._files = [
+            (os.path.basename(file_path), file_path)
+            for dir_path in sorted(dir_paths)
+            if dir_path in self._listings
+            for file_path in self._listings[dir_path][2]
+        ]
+
+    def find(self, key):
+        """Return the sorted paths of the files with key in their name."""
+        self.refresh()
+        return sorted(
+            file_path for file_name, file_path in self._files if key in file_name
+        )
+
+
+@functools.cache
+def get_drop_folder_index(root, suffix, depth=0):
+    """Return the DropFolderIndex of a folder, shared within the process."""
+    return DropFolderIndex(root, suffix, depth)
@@ -120,6 +120,34 @@ def to_seconds(days=None, hours=None):
         return 3600 * hours
 
 
+def allocate_threads(
+    budget: int,
+    in_use: int,
+    n_waiting: int,
+    min_threads: int,
+    max_threads: int,
+) -> int | None:
+    """Size a job from a shared thread budget.
+
+    The free threads are shared evenly between all jobs waiting to start,
+    capped by how many threads the job can make use of.
+
+    :param int budget: total number of threads that may be used
+    :param int in_use: number of threads used by running jobs
+    :param int n_waiting: number of jobs waiting to start, including this one
+    :param int min_threads: least number of threads to start a job with
+    :param int max_threads: most number of threads the job can make use of
+    :returns: number of threads for the job, or None if it has to wait
+    """
+
+    free = budget - in_use
+    if free < min_threads:
+        return None
+
+    fair_share = free // max(n_waiting, 1)
+    return max(min_threads, min(fair_share, max_threads, free))
+
+
 def hashfile(afile, hasher="sha1", blocksize=65536):
     """Calculate the hash digest of a file with the specified algorithm and
     return it.
@@ -185,7 +213,7 @@ def return_unique(seq):
     return [x for x in seq if not (x in seen or seen_add(x))]
 
 
-def run_is_demuxed(run, couch_info=None, seq_run_type=None):
+def run_is_demuxed(run, couch_info=None, seq_run_type=None, fc_connection=None):
     """
     For ONT runs:
     check that .sync_finished exists, which is created by TACA when the sync is finalized. Since demux is done on the sequencers
@@ -199,6 +227,8 @@ def run_is_demuxed(run, couch_info=None, seq_run_type=None):
     demultiplexed (as TACA only creates a document upon successfull demultiplexing)
 
     :param dict couch_info: a dict with 'statusDB' info
+    :param fc_connection: a FlowcellNamesConnection to the 'x_flowcells' database
+        to reuse, one is made from couch_info if not given
     """
     if seq_run_type in ["promethion", "minion"]:
         if os.path.exists(os.path.join(run.abs_path, ".sync_finished")):
@@ -223,23 +253,23 @@ def run_is_demuxed(run, couch_info=None, seq_run_type=None):
             raise SystemExit(
                 'To check for demultiplexing is enabled in config file but no "statusDB" info was given'
             )
-        run_terms = run.name.split("_")
-        run_date = run_terms[0]
-        if len(run_date) > 6:
-            run_date = run_date[2:]
-        run_fc = run_terms[-1]
-        run_name = f"{run_date}_{run_fc}"
-        try:
-            couch_connection = statusdb.StatusdbSession(couch_info).connection
-            fc_db = couch_connection[couch_info["xten_db"]]
-            for fc in fc_db.view("names/name", reduce=False, descending=True):
-                if fc.key != run_name:
-                    continue
-                fc_doc = fc_db.get(fc.id)
-                if not fc_doc or not fc_doc.get("illumina", {}).get(
-                    "Demultiplex_Stats", {}
-                ):
-                    return False
-                return True
-        except Exception as e:
-            raise e
+        fc_connection = fc_connection or statusdb.FlowcellNamesConnection(
+            couch_info, dbname=couch_info["xten_db"]
+        )
+        fc_entry = fc_connection.get_flowcell_entry(
+            statusdb_fc_name(run.name), include_docs=True
+        )
+        if not fc_entry or not fc_entry[1]:
+            return False
+        return bool(fc_entry[1].get("illumina", {}).get("Demultiplex_Stats", {}))
+
+
+def statusdb_fc_name(run_name):
+    """Return the name of a run's flowcell in StatusDB, its short run date and
+    flowcell ID, e.g. "200201_BHHFCFDSXX" for "20200201_A00621_0032_BHHFCFDSXX".
+    """
+    run_terms = run_name.split("_")
+    run_date = run_terms[0]
+    if len(run_date) > 6:
+        run_date = run_date[2:]
+    return f"{run_date}_{run_terms[-1]}"
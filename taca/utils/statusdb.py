@@ -1,6 +1,9 @@
 """Classes for handling connection to StatusDB."""
 
+import base64
 import csv
+import functools
+import hashlib
 import logging
 from datetime import datetime
 
@@ -86,12 +89,31 @@ class ProjectSummaryConnection(StatusdbSession):
     def __init__(self, config, dbname="projects"):
         super().__init__(config)
         self.db = self.connection[dbname]
-        self.name_view = {
-            k.key: k.id for k in self.db.view("project/project_name", reduce=False)
-        }
-        self.id_view = {
-            k.key: k.id for k in self.db.view("project/project_id", reduce=False)
-        }
+
+    # The full views are only loaded when needed
+    @functools.cached_property
+    def name_view(self):
+        return {k.key: k.id for k in self.db.view("project/project_name", reduce=False)}
+
+    @functools.cached_property
+    def id_view(self):
+        return {k.key: k.id for k in self.db.view("project/project_id", reduce=False)}
+
+    def get_entries(self, names, use_id_view=False):
+        """Retrieve the entries for the given names with one keyed query.
+
+        :param names: project names, or project IDs if use_id_view is True
+        :returns: dict mapping each name to its document, or None if there is none
+        """
+        view_name = "project/project_id" if use_id_view else "project/project_name"
+        entries = dict.fromkeys(names)
+        if entries:
+            for row in self.db.view(
+                view_name, keys=list(entries), reduce=False, include_docs=True
+            ):
+                if entries.get(row.key) is None:
+                    entries[row.key] = row.doc
+        return entries
 
 
 class FlowcellRunMetricsConnection(StatusdbSession):
@@ -118,22 +140,85 @@ class X_FlowcellRunMetricsConnection(StatusdbSession):
         }
 
 
+class FlowcellNamesConnection(StatusdbSession):
+    """Keyed lookups of flowcell documents by their "names/name" key, which is
+    the run date and flowcell ID, e.g. "200201_BHHFCFDSXX".
+    """
+
+    # (database, flowcell name) -> (document ID, document or None), or None for
+    # flowcells without a document. Shared by all connections, so that a sweep
+    # only queries each database once.
+    flowcell_entries = {}
+
+    def __init__(self, config, dbname="x_flowcells"):
+        super().__init__(config)
+        self.dbname = dbname
+        self.db = self.connection[dbname]
+
+    def prefetch_flowcells(self, fc_names, include_docs=False):
+        """Fetch the entries of the given flowcells with one keyed view query,
+        so that later lookups of these flowcells are local reads.
+        """
+        entries = dict.fromkeys(fc_names)
+        if entries:
+            for row in self.db.view(
+                "names/name",
+                keys=list(entries),
+                reduce=False,
+                include_docs=include_docs,
+            ):
+                # Keep the last document of a flowcell, the newest one
+                entries[row.key] = (row.id, row.doc if include_docs else None)
+        self.flowcell_entries.update(
+            {(self.dbname, fc_name): entry for fc_name, entry in entries.items()}
+        )
+
+    def get_flowcell_entry(self, fc_name, include_docs=False):
+        """Return the document ID and document of a flowcell, or None."""
+        key = (self.dbname, fc_name)
+        entry = self.flowcell_entries.get(key)
+        if key not in self.flowcell_entries or (
+            include_docs and entry and entry[1] is None
+        ):
+            self.prefetch_flowcells([fc_name], include_docs=include_docs)
+        return self.flowcell_entries[key]
+
+
 class NanoporeRunsConnection(StatusdbSession):
+    # Run name -> (document ID, run status), or None for runs without a document.
+    # Shared by all connections, so that a sweep only queries the database once.
+    run_entries = {}
+
     def __init__(self, config, dbname="nanopore_runs"):
         super().__init__(config)
         self.db = self.connection[dbname]
 
+    def prefetch_run_statuses(self, run_names):
+        """Fetch the documents of the given runs with one keyed view query,
+        so that later checks of these runs are local reads.
+        """
+        run_names = list(run_names)
+        entries = dict.fromkeys(run_names)
+        for row in self.db.view("names/name", keys=run_names, include_docs=True):
+            if entries.get(row.key) is None:
+                entries[row.key] = (row.id, row.doc["run_status"])
+        self.run_entries.update(entries)
+
+    def get_run_entry(self, run_name):
+        if run_name not in self.run_entries:
+            rows = self.db.view("names/name", include_docs=True)[run_name].rows
+            if rows:
+                self.run_entries[run_name] = (rows[0].id, rows[0].doc["run_status"])
+            else:
+                self.run_entries[run_name] = None
+        return self.run_entries[run_name]
+
     def check_run_exists(self, ont_run) -> bool:
-        view_names = self.db.view("names/name")
-        if len(view_names[ont_run.run_name].rows) > 0:
-            return True
-        else:
-            return False
+        return self.get_run_entry(ont_run.run_name) is not None
 
     def check_run_status(self, ont_run) -> str:
-        view_all_stats = self.db.view("names/name")
-        doc_id = view_all_stats[ont_run.run_name].rows[0].id
-        return self.db[doc_id]["run_status"]
+        doc_id, run_status = self.get_run_entry(ont_run.run_name)
+        return run_status
 
     def create_ongoing_run(
         self, ont_run, run_path_file: str, pore_count_history_file: str
@@ -152,21 +237,26 @@ class NanoporeRunsConnection(StatusdbSession):
         }
 
         new_doc_id, new_doc_rev = self.db.save(new_doc)
+        self.run_entries[ont_run.run_name] = (new_doc_id, "ongoing")
         logger.info(
             f"New database entry created: {ont_run.run_name}, id {new_doc_id}, rev {new_doc_rev}"
         )
 
     def finish_ongoing_run(self, ont_run, dict_json: dict):
-        view_names = self.db.view("names/name")
-        doc_id = view_names[ont_run.run_name].rows[0].id
+        doc_id, _ = self.get_run_entry(ont_run.run_name)
         doc = self.db[doc_id]
 
         doc.update(dict_json)
         doc["run_status"] = "finished"
         self.db[doc.id] = doc
+        self.run_entries[ont_run.run_name] = (doc_id, "finished")
 
 
 class ElementRunsConnection(StatusdbSession):
+    # Run name -> run status, shared by all connections, so that a sweep only
+    # queries the database once
+    run_statuses = {}
+
     def __init__(self, config, dbname="element_runs"):
         super().__init__(config)
         self.db = self.connection[dbname]
@@ -181,36 +271,83 @@ class ElementRunsConnection(StatusdbSession):
     def check_if_run_exists(self, run_id) -> bool:
         return self.get_db_entry(run_id) is not None
 
+    def prefetch_run_statuses(self, run_names):
+        """Fetch the statuses of the given runs with one keyed view query,
+        so that later status checks of these runs are local reads.
+        """
+        run_names = list(run_names)
+        statuses = {}
+        for row in self.db.view("info/status", keys=run_names):
+            statuses.setdefault(row.key, row.value)
+        for run_name in run_names:
+            self.run_statuses[run_name] = statuses.get(run_name, "Unknown")
+
     def check_db_run_status(self, run_name) -> str:
+        if run_name in self.run_statuses:
+            return self.run_statuses[run_name]
         view_status = self.db.view("info/status")
         try:
             status = view_status[run_name].rows[0].value
         except IndexError:  # No rows found
-            return "Unknown"
+            status = "Unknown"
+        self.run_statuses[run_name] = status
         return status
 
-    def upload_to_statusdb(self, run_obj: dict):
-        update_doc(self.db, run_obj)
+    def upload_to_statusdb(self, run_obj: dict, attachments: dict | None = None):
+        update_doc(self.db, run_obj, attachments=attachments)
+        if "run_status" in run_obj:
+            self.run_statuses[run_obj["name"]] = run_obj["run_status"]
+        else:
+            self.run_statuses.pop(run_obj["name"], None)
+
 
+def update_doc(db, obj, over_write_db_entry=False, attachments=None):
+    """Save obj as the document with the same name, creating it if needed.
 
-def update_doc(db, obj, over_write_db_entry=False):
+    :param db: Database with an "info/name" view emitting the documents
+    :param dict obj: Document contents
+    :param bool over_write_db_entry: Replace the stored contents instead of merging them
+    :param dict attachments: Attachment names mapped to their contents, only
+        uploaded when they differ from the stored attachments
+    """
     view = db.view("info/name")
     if len(view[obj["name"]].rows) == 1:
         remote_doc = view[obj["name"]].rows[0].value
         doc_id = remote_doc.pop("_id")
         doc_rev = remote_doc.pop("_rev")
+        # Keep the stubs of stored attachments, they are not part of the comparison
+        remote_attachments = remote_doc.pop("_attachments", None)
+        obj.pop("_attachments", None)
         if remote_doc != obj:
             if not over_write_db_entry:
                 obj = merge_dicts(obj, remote_doc)
             obj["_id"] = doc_id
             obj["_rev"] = doc_rev
+            if remote_attachments:
+                obj["_attachments"] = remote_attachments
             db[doc_id] = obj
             logger.info("Updating {}".format(obj["name"]))
     elif len(view[obj["name"]].rows) == 0:
-        db.save(obj)
+        doc_id, _ = db.save(obj)
         logger.info("Saving {}".format(obj["name"]))
     else:
         logger.warning("More than one row with name {} found".format(obj["name"]))
+        return
+
+    if attachments:
+        put_changed_attachments(db, doc_id, attachments)
+
+
+def put_changed_attachments(db, doc_id, attachments):
+    """Upload the attachments whose contents differ from those stored with the document."""
+    doc = db[doc_id]
+    stored_attachments = doc.get("_attachments", {})
+    for name, content in attachments.items():
+        digest = "md5-" + base64.b64encode(hashlib.md5(content).digest()).decode()
+        if stored_attachments.get(name, {}).get("digest") == digest:
+            continue
+        db.put_attachment(doc, content, filename=name, content_type="application/gzip")
+        logger.info("Attaching {} to {}".format(name, doc.get("name", doc_id)))
 
 
 def merge_dicts(d1, d2):
@@ -225,8 +362,7 @@ def merge_dicts(d1, d2):
                 pass  # same leaf value
             else:
                 logger.debug(
-                    f"Values for key {key} in d1 and d2 differ, "
-                    "using the value of d1"
+                    f"Values for key {key} in d1 and d2 differ, using the value of d1"
                 )
         else:
             d1[key] = d2[key]
@@ -1,9 +1,11 @@
 """Helper classes for handling file trasfers."""
 
+import fnmatch
 import logging
 import os
 import shutil
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 
 from taca.utils.filesystem import create_folder
 from taca.utils.misc import call_external_command, hashfile
@@ -320,6 +322,119 @@ class SymlinkAgent(TransferAgent):
         )
 
 
+class MetadataSyncAgent(TransferAgent):
+    def __init__(
+        self,
+        src_path,
+        dest_path,
+        files=None,
+        exclude_dirs=(),
+        exclude_files=(),
+        max_workers=4,
+        **kwargs,
+    ):
+        """Creates a MetadataSyncAgent instance for copying the files of a
+        folder to a local or mounted destination folder.
+
+        Only files that differ from their destination in size, or in content
+        when their modification times differ, are copied. Copies keep the
+        modification time of the source, so that unchanged files are
+        recognized without hashing the next time.
+
+        :param string src_path: the folder to copy files from
+        :param string dest_path: the folder to copy files into
+        :param dict files: paths relative to src_path of the files to copy,
+            mapped to their paths relative to dest_path, all files under
+            src_path are copied to the same relative paths if None
+        :param list exclude_dirs: patterns of directory names to skip
+        :param list exclude_files: patterns of file names to skip
+        :param int max_workers: number of files to compare or copy in parallel
+        """
+        super().__init__(src_path=src_path, dest_path=dest_path, **kwargs)
+        self.files = files
+        self.exclude_dirs = exclude_dirs
+        self.exclude_files = exclude_files
+        self.max_workers = max_workers
+
+    def list_files(self):
+        """Return the paths relative to src_path of the files to sync, mapped
+        to their paths relative to dest_path."""
+        if self.files is not None:
+            return {
+                src_file: dest_file
+                for src_file, dest_file in self.files.items()
+                if os.path.isfile(os.path.join(self.src_path, src_file))
+            }
+
+        files = {}
+        for root, dirs, file_names in os.walk(self.src_path):
+            dirs[:] = [
+                d
+                for d in dirs
+                if not any(fnmatch.fnmatch(d, p) for p in self.exclude_dirs)
+            ]
+            for file_name in file_names:
+                if not any(fnmatch.fnmatch(file_name, p) for p in self.exclude_files):
+                    file = os.path.relpath(os.path.join(root, file_name), self.src_path)
+                    files[file] = file
+        return dict(sorted(files.items()))
+
+    def needs_copy(self, src_file, dest_file):
+        src = os.path.join(self.src_path, src_file)
+        dest = os.path.join(self.dest_path, dest_file)
+        try:
+            dest_stat = os.stat(dest)
+        except FileNotFoundError:
+            return True
+        src_stat = os.stat(src)
+        if src_stat.st_size != dest_stat.st_size:
+            return True
+        if src_stat.st_mtime_ns == dest_stat.st_mtime_ns:
+            return False
+        if hashfile(src) != hashfile(dest):
+            return True
+        # Same contents, align the modification time to skip hashing next time
+        shutil.copystat(src, dest)
+        return False
+
+    def copy_file(self, src_file, dest_file):
+        src = os.path.join(self.src_path, src_file)
+        dest = os.path.join(self.dest_path, dest_file)
+        if not create_folder(os.path.dirname(dest)):
+            raise TransferError(
+                "failed to create target folder hierarchy", src, os.path.dirname(dest)
+            )
+        shutil.copy2(src, f"{dest}.tmp")
+        os.replace(f"{dest}.tmp", dest)
+        return os.path.getsize(dest)
+
+    def transfer(self):
+        """Copy the files that differ from their destination.
+
+        :returns: the number of bytes copied
+        :raises transfer.TransferError:
+            if src_path or dest_path were not valid
+        """
+        self.validate_src_path()
+        self.validate_dest_path()
+        files = self.list_files()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            needs_copy = pool.map(self.needs_copy, files.keys(), files.values())
+            files_to_copy = {
+                src_file: dest_file
+                for (src_file, dest_file), copy in zip(files.items(), needs_copy)
+                if copy
+            }
+            bytes_copied = sum(
+                pool.map(self.copy_file, files_to_copy.keys(), files_to_copy.values())
+            )
+        logger.info(
+            f"Copied {len(files_to_copy)} of {len(files)} files ({bytes_copied} bytes) "
+            f"from {self.src_path} to {self.dest_path}"
+        )
+        return bytes_copied
+
+
 class TransferError(Exception):
     def __init__(self, msg, src_path=None, dest_path=None):
         super().__init__(msg)
@@ -190,3 +190,39 @@ def test_process_on_finished_run(aviti_fixture):
 
     assert "Bases2Fastq conversion and demultiplexing started for run " in caplog.text
     assert mocks["mock_db"].return_value.upload_to_statusdb.called
+
+
+def test_process_on_failed_demux(aviti_fixture):
+    """Should report the failed sub-demux once and set the run status."""
+    to_test, tmp, caplog, mocks = aviti_fixture
+
+    run_dir = create_element_run_dir(
+        tmp=tmp,
+        lims_manifest=True,
+        metadata_files=True,
+        run_finished=True,
+        outcome_completed=True,
+        demux_dir=True,
+        demux_done=False,
+    )
+    with open(f"{run_dir}/Demultiplexing_1/.bases2fastq_exit", "w") as f:
+        f.write("137")
+
+    # First sweep reports the failure
+    mocks["mock_db"].return_value.check_db_run_status.return_value = "demultiplexing"
+    to_test.run_preprocessing(run_dir)
+
+    mocks["mock_mail"].assert_called_once()
+    email_message = mocks["mock_mail"].call_args.args[1]
+    assert f"{run_dir}/Demultiplexing_1 exited with code 137" in email_message
+    assert f"{run_dir}/Demultiplexing_1/bases2fastq_stderr.txt" in email_message
+    assert "Unknown demultiplexing status" not in caplog.text
+    uploaded_doc = mocks["mock_db"].return_value.upload_to_statusdb.call_args.args[0]
+    assert uploaded_doc["run_status"] == "demultiplexing failed"
+
+    # Later sweeps do not mail again
+    mocks["mock_db"].return_value.check_db_run_status.return_value = (
+        "demultiplexing failed"
+    )
+    to_test.run_preprocessing(run_dir)
+    mocks["mock_mail"].assert_called_once()
@@ -1,6 +1,5 @@
 import importlib
 import logging
-import os
 import subprocess
 from io import StringIO
 from unittest.mock import patch
@@ -22,25 +21,27 @@ def parametrize_testruns():
     """
 
     parameter_string_table = """
-    desc            instrument qc    run_finished sync_finished fastq_dirs barcode_dirs anglerfish_samplesheets anglerfish_ongoing anglerfish_exit
-    prom_ongoing    promethion False False        False         False      False        False                   False              NA
-    prom_done       promethion False True         False         False      False        False                   False              NA
-    prom_synced     promethion False True         True          False      False        False                   False              NA
-    prom_fastq      promethion False True         True          True       False        False                   False              NA
-    prom_bcs        promethion False True         True          True       True         False                   False              NA
-    min_ongoing     minion     False False        False         False      False        False                   False              NA
-    min_done        minion     False True         False         False      False        False                   False              NA
-    min_synced      minion     False True         True          False      False        False                   False              NA
-    min_fastq       minion     False True         True          True       False        False                   False              NA
-    min_bcs         minion     False True         True          True       True         False                   False              NA
-    min_qc_ongoing  minion     True  False        False         False      False        False                   False              NA
-    min_qc_done     minion     True  True         False         False      False        False                   False              NA
-    min_qc_synced   minion     True  True         True          False      False        False                   False              NA
-    min_qc_fastq    minion     True  True         True          True       False        False                   False              NA
-    min_qc_bcs      minion     True  True         True          True       True         False                   False              NA
-    min_qc_ang_ss   minion     True  True         True          True       True         True                    False              NA
-    min_qc_ang_run  minion     True  True         True          True       True         True                    True               NA
-    min_qc_ang_done minion     True  True         True          True       True         True                    False              0
+    desc            instrument qc    run_finished sync_finished fastq_dirs barcode_dirs anglerfish_samplesheets anglerfish_ongoing anglerfish_exit toulligqc_exit
+    prom_ongoing    promethion False False        False         False      False        False                   False              NA              NA
+    prom_done       promethion False True         False         False      False        False                   False              NA              NA
+    prom_tqc_start  promethion False True         True          False      False        False                   False              NA              NA
+    prom_synced     promethion False True         True          False      False        False                   False              NA              0
+    prom_fastq      promethion False True         True          True       False        False                   False              NA              0
+    prom_bcs        promethion False True         True          True       True         False                   False              NA              0
+    min_ongoing     minion     False False        False         False      False        False                   False              NA              NA
+    min_done        minion     False True         False         False      False        False                   False              NA              NA
+    min_synced      minion     False True         True          False      False        False                   False              NA              0
+    min_fastq       minion     False True         True          True       False        False                   False              NA              0
+    min_bcs         minion     False True         True          True       True         False                   False              NA              0
+    min_qc_ongoing  minion     True  False        False         False      False        False                   False              NA              NA
+    min_qc_done     minion     True  True         False         False      False        False                   False              NA              NA
+    min_qc_tqc      minion     True  True         True          False      False        False                   False              NA              NA
+    min_qc_synced   minion     True  True         True          False      False        False                   False              NA              0
+    min_qc_fastq    minion     True  True         True          True       False        False                   False              NA              0
+    min_qc_bcs      minion     True  True         True          True       True         False                   False              NA              0
+    min_qc_ang_ss   minion     True  True         True          True       True         True                    False              NA              0
+    min_qc_ang_run  minion     True  True         True          True       True         True                    True               NA              0
+    min_qc_ang_done minion     True  True         True          True       True         True                    False              0               0
     """
 
     # Turn string table to datastream
@@ -51,6 +52,7 @@ def parametrize_testruns():
 
     # Fix data types
     df.anglerfish_exit = df.anglerfish_exit[df.anglerfish_exit.notna()].astype("Int64")
+    df.toulligqc_exit = df.toulligqc_exit[df.toulligqc_exit.notna()].astype("Int64")
 
     # Replace nan(s) with None(s)
     df = df.replace(np.nan, None)
@@ -98,11 +100,11 @@ def test_ont_transfer(create_dirs, run_properties, caplog):
     patch("taca.nanopore.ONT_run_classes.ONT_run.parse_minknow_json").start()
     patch("taca.nanopore.ONT_run_classes.ONT_run.parse_pore_activity").start()
 
-    # Mock subprocess.Popen ONLY for Anglerfish
+    # Mock subprocess.Popen ONLY for Anglerfish and ToulligQC
     original_popen = subprocess.Popen
 
     def mock_Popen_side_effect(*args, **kwargs):
-        if "anglerfish" in args[0]:
+        if "anglerfish" in args[0] or "toulligqc" in args[0]:
             return mock_Popen
         else:
             return original_popen(*args, **kwargs)
@@ -113,22 +115,6 @@ def test_ont_transfer(create_dirs, run_properties, caplog):
     ).start()
     mock_Popen.pid = 1337  # Nice
 
-    # Mock subprocess.run ONLY for ToulligQC
-    original_run = subprocess.run
-
-    def mock_run_side_effect(*args, **kwargs):
-        if "toulligqc" in args[0]:
-            os.mkdir(f"{args[0][6]}/toulligqc_report")
-            open(f"{args[0][6]}/toulligqc_report/report.html", "w").close()
-            return mock_run
-        else:
-            return original_run(*args, **kwargs)
-
-    mock_run = patch(
-        "taca.nanopore.ONT_run_classes.subprocess.run", side_effect=mock_run_side_effect
-    ).start()
-    mock_run.returncode = 0
-
     # Reload module to implement mocks
     importlib.reload(analysis_nanopore)
 
@@ -145,6 +131,7 @@ def test_ont_transfer(create_dirs, run_properties, caplog):
         anglerfish_samplesheets=run_properties.pop("anglerfish_samplesheets"),
         anglerfish_ongoing=run_properties.pop("anglerfish_ongoing"),
         anglerfish_exit=run_properties.pop("anglerfish_exit"),
+        toulligqc_exit=run_properties.pop("toulligqc_exit"),
     )
 
     # Make sure we used everything
@@ -0,0 +1,445 @@
+import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import time
+from types import SimpleNamespace
+from unittest import mock
+
+import pytest
+
+from taca.backup import backup as to_test
+
+
+def create_run(root: str, run: str, n_files: int = 3, file_size: int = 100):
+    """Create a finished run directory with a subdirectory of data."""
+    os.makedirs(os.path.join(root, run, "Data"))
+    for i in range(n_files):
+        with open(os.path.join(root, run, "Data", f"file_{i}"), "w") as stream:
+            stream.write("x" * file_size)
+    open(os.path.join(root, run, "RTAComplete.txt"), "w").close()
+    return n_files * file_size
+
+
+def test_run_size_cache():
+    tmp = tempfile.TemporaryDirectory()
+    size = create_run(tmp.name, "run")
+    cache_file = os.path.join(tmp.name, "run_sizes.json")
+    run_sizes = to_test.run_size_cache(cache_file)
+
+    assert run_sizes.measure(os.path.join(tmp.name, "run")) == size
+    run_sizes.record("run", "novaseq", size)
+    run_sizes.save()
+
+    # Unchanged directories are not read again
+    run_sizes = to_test.run_size_cache(cache_file)
+    with mock.patch.object(to_test.os, "scandir", wraps=os.scandir) as mock_scandir:
+        assert run_sizes.measure(os.path.join(tmp.name, "run")) == size
+    mock_scandir.assert_not_called()
+
+    # Only the changed directory is read again
+    with open(os.path.join(tmp.name, "run", "Data", "new_file"), "w") as stream:
+        stream.write("x" * 10)
+    with mock.patch.object(to_test.os, "scandir", wraps=os.scandir) as mock_scandir:
+        assert run_sizes.measure(os.path.join(tmp.name, "run")) == size + 10
+    mock_scandir.assert_called_once_with(os.path.join(tmp.name, "run", "Data"))
+
+    # Estimates use the measured runs, or the static sizes for other types
+    assert run_sizes.estimate("novaseq") == size
+    assert run_sizes.estimate("miseq") == 20 * to_test.GB
+    assert run_sizes.estimate("") == 900 * to_test.GB
+
+    tmp.cleanup()
+
+
+def test_avail_disk_space():
+    tmp = tempfile.TemporaryDirectory()
+    archive_dir = os.path.join(tmp.name, "nosync")
+    data_dir = os.path.join(tmp.name, "data")
+    os.makedirs(archive_dir)
+    size_1 = create_run(archive_dir, "200101_A00001_0001_AHXXXXXXX")
+    size_2 = create_run(archive_dir, "200102_A00001_0002_BHXXXXXXX", file_size=200)
+    # encryption started by another process, half of the tarball written
+    size_3 = create_run(archive_dir, "200103_A00001_0003_AHXXXXXXX")
+    open(os.path.join(archive_dir, "200103_A00001_0003_AHXXXXXXX.encrypting"), "w")
+    with open(os.path.join(archive_dir, "200103_A00001_0003_AHXXXXXXX.tar"), "w") as f:
+        f.write("x" * (size_3 // 2))
+    # run still being sequenced, estimated from the largest measured run
+    os.makedirs(os.path.join(data_dir, "200104_A00001_0004_AHXXXXXXX"))
+    config = {
+        "backup": {
+            "data_dirs": {"novaseq": data_dir},
+            "archive_dirs": {"novaseq": archive_dir},
+            "archived_dirs": {},
+            "exclude_list": [],
+            "keys_path": tmp.name,
+            "gpg_receiver": "receiver",
+            "archive_log": os.path.join(tmp.name, "archived.tsv"),
+            "run_sizes_cache": os.path.join(tmp.name, "run_sizes.json"),
+        },
+        "mail": {"recipients": "some_user@some_email.com"},
+    }
+    free_space = 1000 + 2 * size_1 + 2 * size_2 - 1 + (2 * size_3 - size_3 // 2)
+
+    with (
+        mock.patch.dict(to_test.CONFIG, config),
+        mock.patch.object(
+            to_test.os,
+            "statvfs",
+            return_value=SimpleNamespace(f_bavail=free_space, f_frsize=1),
+        ) as mock_statvfs,
+        mock.patch.object(to_test.misc, "send_mail") as mock_send_mail,
+    ):
+        bk = to_test.backup_utils()
+        bk.run_sizes.record("200001_A00001_0001_AHXXXXXXX", "novaseq", 1000)
+        bk.avail_disk_space(archive_dir, "200101_A00001_0001_AHXXXXXXX")
+        assert bk.disk_space[os.stat(archive_dir).st_dev] == 2 * size_2 - 1
+        # The second run only fits once the first tarball is removed
+        with pytest.raises(SystemExit):
+            bk.avail_disk_space(archive_dir, "200102_A00001_0002_BHXXXXXXX")
+        mock_send_mail.assert_called_once()
+        bk.release_disk_space(archive_dir, "200101_A00001_0001_AHXXXXXXX")
+        bk.avail_disk_space(archive_dir, "200102_A00001_0002_BHXXXXXXX")
+    # The free space is read once per sweep
+    mock_statvfs.assert_called_once()
+
+    tmp.cleanup()
+
+
+def test_encrypt_runs_scheduling():
+    """Runs are encrypted concurrently, the smallest first, with a cap per disk."""
+    tmp = tempfile.TemporaryDirectory()
+    archive_dir = os.path.join(tmp.name, "nosync")
+    os.makedirs(archive_dir)
+    run_sizes = {
+        "20240101_AV242106_B2345678901": 400,
+        "20240102_AV242106_B2345678902": 100,
+        "20240103_AV242106_B2345678903": 300,
+        "20240104_AV242106_B2345678904": 200,
+    }
+    for run, size in run_sizes.items():
+        create_run(archive_dir, run, n_files=1, file_size=size)
+        open(os.path.join(archive_dir, run, "RunUploaded.json"), "w").close()
+    # already being encrypted by another process
+    create_run(archive_dir, "20240105_AV242106_B2345678905", n_files=1)
+    open(os.path.join(archive_dir, "20240105_AV242106_B2345678905.encrypting"), "w")
+    config = {
+        "backup": {
+            "data_dirs": {},
+            "archive_dirs": {"aviti": archive_dir},
+            "archived_dirs": {},
+            "exclude_list": [],
+            "keys_path": tmp.name,
+            "gpg_receiver": "receiver",
+            "archive_log": os.path.join(tmp.name, "archived.tsv"),
+            "max_encryption_jobs": 3,
+            "max_encryption_jobs_per_disk": 2,
+        },
+        "mail": {"recipients": "some_user@some_email.com"},
+    }
+    started, running, max_running = [], set(), [0]
+    encryption_space = to_test.backup_utils._encryption_space
+    free_disk_space = to_test.backup_utils._free_disk_space
+    measured_runs = []
+
+    def counting_encryption_space(self, path, run):
+        measured_runs.append(run)
+        return encryption_space(self, path, run)
+
+    def unlocked_free_disk_space(self, path):
+        # other runs are measured without holding up the running threads
+        assert not self._disk_space_lock.locked()
+        return free_disk_space(self, path)
+
+    def fake_encrypt_run(self, run, force):
+        started.append(run.name)
+        running.add(run.name)
+        max_running[0] = max(max_running[0], len(running))
+        time.sleep(0.05)
+        running.discard(run.name)
+        return True
+
+    with (
+        mock.patch.dict(to_test.CONFIG, config),
+        mock.patch.object(to_test.backup_utils, "_encrypt_run", fake_encrypt_run),
+        mock.patch.object(
+            to_test.backup_utils, "_encryption_space", counting_encryption_space
+        ),
+        mock.patch.object(
+            to_test.backup_utils, "_free_disk_space", unlocked_free_disk_space
+        ),
+        mock.patch.object(to_test.run_size_cache, "save") as mock_save,
+        mock.patch.object(to_test.os, "getloadavg", return_value=(0.0, 0.0, 0.0)),
+        mock.patch.object(to_test.os, "cpu_count", return_value=8),
+        mock.patch.object(
+            to_test.os,
+            "statvfs",
+            return_value=SimpleNamespace(f_bavail=10000, f_frsize=1),
+        ),
+    ):
+        to_test.backup_utils.encrypt_runs(None, False)
+
+    assert started == sorted(run_sizes, key=run_sizes.get)
+    assert max_running[0] == 2
+    # Waiting runs are measured once, when queued, and the sizes saved once
+    assert sorted(r for r in measured_runs if r in run_sizes) == sorted(run_sizes)
+    mock_save.assert_called_once()
+
+    tmp.cleanup()
+
+
+FAKE_DSMC = """#!/bin/sh
+# Fake dsmc keeping the archived files under $PDC_STORE
+case "$1" in
+    archive) mkdir -p "$PDC_STORE$(dirname "$2")" && cp "$2" "$PDC_STORE$2" ;;
+    query) test -f "$PDC_STORE$3" ;;
+    retrieve) echo "$2" >> "$PDC_STORE.log" && mkdir -p "$3" && cp "$PDC_STORE$2" "$3" ;;
+    *) exit 1 ;;
+esac
+"""
+
+
+@pytest.fixture
+def pdc_backup(monkeypatch):
+    """A backup setup with a fake PDC and a gpg key to encrypt runs for."""
+    tmp = tempfile.TemporaryDirectory()
+    bin_dir = os.path.join(tmp.name, "bin")
+    os.mkdir(bin_dir)
+    with open(os.path.join(bin_dir, "dsmc"), "w") as f:
+        f.write(FAKE_DSMC)
+    os.chmod(os.path.join(bin_dir, "dsmc"), 0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}:{os.environ['PATH']}")
+    monkeypatch.setenv("PDC_STORE", os.path.join(tmp.name, "pdc"))
+    gnupg_home = os.path.join(tmp.name, "gnupg")
+    os.mkdir(gnupg_home, mode=0o700)
+    monkeypatch.setenv("GNUPGHOME", gnupg_home)
+    subprocess.run(
+        [
+            "gpg",
+            "--batch",
+            "--passphrase",
+            "",
+            "--quick-gen-key",
+            "receiver@example.com",
+            "default",
+            "default",
+            "never",
+        ],
+        check=True,
+        capture_output=True,
+    )
+    archive_dir = os.path.join(tmp.name, "nosync")
+    archived_dir = os.path.join(tmp.name, "archived")
+    keys_dir = os.path.join(tmp.name, "keys")
+    for path in (archive_dir, archived_dir, keys_dir):
+        os.mkdir(path)
+    config = {
+        "backup": {
+            "data_dirs": {},
+            "archive_dirs": {"aviti": archive_dir},
+            "archived_dirs": {"aviti": archived_dir},
+            "exclude_list": [],
+            "keys_path": keys_dir,
+            "gpg_receiver": "receiver@example.com",
+            "archive_log": os.path.join(tmp.name, "archived.tsv"),
+            "chunk_size": 4000,
+        },
+        "mail": {"recipients": "some_user@some_email.com"},
+    }
+    with (
+        mock.patch.dict(to_test.CONFIG, config),
+        mock.patch.object(to_test.os, "getloadavg", return_value=(0.0, 0.0, 0.0)),
+        mock.patch.object(to_test.time, "sleep"),
+    ):
+        yield tmp.name, archive_dir, archived_dir
+
+
+def archive_run(archive_dir, run, archive_format="tar"):
+    """Encrypt a run and send it to the fake PDC."""
+    create_run(archive_dir, run, n_files=4, file_size=600)
+    open(os.path.join(archive_dir, run, "RunUploaded.json"), "w").close()
+    with mock.patch.dict(to_test.CONFIG["backup"], {"archive_format": archive_format}):
+        to_test.backup_utils.encrypt_runs(None, False)
+        to_test.backup_utils.pdc_put(None)
+    assert not os.path.exists(os.path.join(archive_dir, run))
+
+
+def read_run(run_dir):
+    return {
+        os.path.relpath(os.path.join(dir_path, file_name), run_dir): open(
+            os.path.join(dir_path, file_name)
+        ).read()
+        for dir_path, _, files in os.walk(run_dir)
+        for file_name in files
+    }
+
+
+def test_restore_runs(pdc_backup):
+    tmp, archive_dir, archived_dir = pdc_backup
+    run = "20240101_AV242106_B2345678901"
+    archive_run(archive_dir, run)
+    outdir = os.path.join(tmp, "restored")
+    os.mkdir(outdir)
+
+    to_test.backup_utils.restore_runs([run], outdir)
+
+    assert read_run(os.path.join(outdir, run)) == read_run(
+        os.path.join(archived_dir, run)
+    )
+    # the retrieved files are removed once the run is extracted
+    assert os.listdir(outdir) == [run]
+    # single files can only be restored from chunked archives
+    with pytest.raises(SystemExit):
+        to_test.backup_utils.restore_runs([run], outdir, [f"{run}/Data/file_0"])
+
+
+def test_restore_runs_noisy_decryption(pdc_backup):
+    """Lots of output from gpg on stderr does not block the restore."""
+    tmp, archive_dir, archived_dir = pdc_backup
+    run = "20240101_AV242106_B2345678901"
+    archive_run(archive_dir, run)
+    gpg_path = os.path.join(tmp, "bin", "gpg")
+    with open(gpg_path, "w") as f:
+        f.write(
+            "#!/bin/sh\n"
+            'case "$*" in *--passphrase-file*) '
+            "head -c 1000000 /dev/zero | tr '\\0' w >&2 ;; esac\n"
+            f'exec {shutil.which("gpg")} "$@"\n'
+        )
+    os.chmod(gpg_path, 0o755)
+    outdir = os.path.join(tmp, "restored")
+    os.mkdir(outdir)
+
+    to_test.backup_utils.restore_runs([run], outdir)
+
+    assert read_run(os.path.join(outdir, run)) == read_run(
+        os.path.join(archived_dir, run)
+    )
+
+
+def test_restore_runs_md5_mismatch(pdc_backup):
+    tmp, archive_dir, _ = pdc_backup
+    run = "20240101_AV242106_B2345678901"
+    archive_run(archive_dir, run)
+    md5_file = f"{tmp}/pdc{tmp}/keys/{run}.tar.md5"
+    with open(md5_file, "w") as f:
+        f.write(f"{'0' * 32}  {run}.tar\n")
+    outdir = os.path.join(tmp, "restored")
+    os.mkdir(outdir)
+
+    with pytest.raises(SystemExit):
+        to_test.backup_utils.restore_runs([run], outdir)
+    assert os.listdir(outdir) == []
+
+
+def test_restore_runs_chunked(pdc_backup):
+    tmp, archive_dir, _ = pdc_backup
+    run = "20240101_AV242106_B2345678901"
+    archive_run(archive_dir, run, archive_format="chunked")
+    outdir = os.path.join(tmp, "restored")
+    os.mkdir(outdir)
+
+    to_test.backup_utils.restore_runs([run], outdir, [f"{run}/Data/file_1"])
+
+    assert read_run(os.path.join(outdir, run)) == {"Data/file_1": "x" * 600}
+    assert os.listdir(outdir) == [run]
+    # only the chunks holding the file are retrieved
+    archive = to_test.ChunkedArchive(archive_dir, run)
+    archived_chunks = os.listdir(f"{tmp}/pdc{archive.path}")
+    with open(f"{tmp}/pdc.log") as retrieve_log:
+        retrieved = [os.path.basename(f) for f in retrieve_log.read().split()]
+    retrieved_chunks = [f for f in retrieved if f in archived_chunks]
+    assert f"{run}.key.gpg" in retrieved
+    assert f"{run}.index.json" in retrieved_chunks
+    assert 1 < len(set(retrieved_chunks)) < len(archived_chunks)
+
+
+@mock.patch.dict(to_test.statusdb.FlowcellNamesConnection.flowcell_entries, clear=True)
+@mock.patch("taca.utils.statusdb.couchdb.Server")
+def test_statusdb_lookups(mock_server):
+    """The flowcells of a sweep are looked up with one keyed query."""
+    tmp = tempfile.TemporaryDirectory()
+    runs = ["200201_A00621_0032_BHHFCFDSXX", "200202_A00621_0033_AHHFCFDSXX"]
+    config = {
+        "backup": {
+            "data_dirs": {},
+            "archive_dirs": {"novaseq": tmp.name},
+            "archived_dirs": {},
+            "exclude_list": [],
+            "keys_path": tmp.name,
+            "gpg_receiver": "receiver",
+            "archive_log": os.path.join(tmp.name, "archived.tsv"),
+        },
+        "statusdb": {"db": "x_flowcells", "xten_db": "x_flowcells"},
+        "mail": {"recipients": "some_user@some_email.com"},
+    }
+    db = mock_server.return_value.__getitem__.return_value
+    db.view.return_value = [
+        mock.Mock(
+            key="200201_BHHFCFDSXX",
+            id="doc_1",
+            doc={"illumina": {"Demultiplex_Stats": {"Barcode_lane_statistics": []}}},
+        )
+    ]
+    db.get.return_value = {"_id": "doc_1"}
+    with mock.patch.dict(to_test.CONFIG, config):
+        bk = to_test.backup_utils()
+        bk._prefetch_flowcells(
+            [to_test.run_vars(os.path.join(tmp.name, run), tmp.name) for run in runs],
+            "x_flowcells",
+            include_docs=True,
+        )
+        connection = bk._flowcell_connection("x_flowcells")
+        assert to_test.misc.run_is_demuxed(
+            to_test.run_vars(os.path.join(tmp.name, runs[0]), tmp.name),
+            bk.couch_info,
+            "novaseq",
+            connection,
+        )
+        assert not to_test.misc.run_is_demuxed(
+            to_test.run_vars(os.path.join(tmp.name, runs[1]), tmp.name),
+            bk.couch_info,
+            "novaseq",
+            connection,
+        )
+        bk._log_pdc_statusdb(runs[0])
+
+    db.view.assert_called_once_with(
+        "names/name",
+        keys=["200201_BHHFCFDSXX", "200202_AHHFCFDSXX"],
+        reduce=False,
+        include_docs=True,
+    )
+    mock_server.assert_called_once()
+    db.get.assert_called_once_with("doc_1")
+    assert "pdc_archived" in db.save.call_args.args[0]
+
+    tmp.cleanup()
+
+
+def test_restore_runs_failure_is_per_run(pdc_backup):
+    """An extraction error of one run is logged, the other runs are restored."""
+    tmp, archive_dir, archived_dir = pdc_backup
+    runs = ["20240101_AV242106_B2345678901", "20240102_AV242106_B2345678902"]
+    for run in runs:
+        archive_run(archive_dir, run, archive_format="chunked")
+    outdir = os.path.join(tmp, "restored")
+    os.mkdir(outdir)
+    extract = to_test.ChunkedArchive.extract
+
+    def failing_extract(archive, *args, **kwargs):
+        if archive.name == runs[0]:
+            raise tarfile.FilterError("unsafe member")
+        return extract(archive, *args, **kwargs)
+
+    with (
+        mock.patch.object(to_test.ChunkedArchive, "extract", failing_extract),
+        pytest.raises(SystemExit),
+    ):
+        to_test.backup_utils.restore_runs(runs, outdir)
+
+    assert os.listdir(outdir) == [runs[1]]
+    assert read_run(os.path.join(outdir, runs[1])) == read_run(
+        os.path.join(archived_dir, runs[1])
+    )
@@ -0,0 +1,134 @@
+import json
+import os
+import tempfile
+from unittest import mock
+
+import pytest
+
+from taca.backup import chunked_archive as to_test
+
+
+@pytest.fixture
+def run_archive(monkeypatch):
+    """A run directory with its key file, and an archive dir with a gpg home."""
+    tmp = tempfile.TemporaryDirectory()
+    gnupg_home = os.path.join(tmp.name, "gnupg")
+    os.mkdir(gnupg_home, mode=0o700)
+    monkeypatch.setenv("GNUPGHOME", gnupg_home)
+    run_path = os.path.join(tmp.name, "20240101_AV242106_B2345678901")
+    os.makedirs(os.path.join(run_path, "Data", "Lane1"))
+    os.makedirs(os.path.join(run_path, "Thumbs"))
+    for i in range(4):
+        with open(os.path.join(run_path, "Data", f"reads_{i}.bin"), "wb") as f:
+            f.write(os.urandom(20000 * (i + 1)))
+    with open(os.path.join(run_path, "Data", "Lane1", "InterOp.bin"), "wb") as f:
+        f.write(os.urandom(1000))
+    with open(os.path.join(run_path, "Thumbs", "thumb.jpg"), "w") as f:
+        f.write("thumbnail")
+    with open(os.path.join(run_path, "SampleSheet.csv"), "w") as f:
+        f.write("Lane,Sample\n1,S1\n")
+    key_file = os.path.join(tmp.name, "run.key")
+    with open(key_file, "w") as f:
+        f.write("passphrase")
+    yield tmp.name, run_path, key_file
+    tmp.cleanup()
+
+
+def read_tree(root):
+    tree = {}
+    for dir_path, _, files in os.walk(root):
+        for file_name in files:
+            with open(os.path.join(dir_path, file_name), "rb") as f:
+                tree[os.path.relpath(os.path.join(dir_path, file_name), root)] = (
+                    f.read()
+                )
+    return tree
+
+
+def test_create_and_extract(run_archive):
+    tmp, run_path, key_file = run_archive
+    run_name = os.path.basename(run_path)
+    archive = to_test.ChunkedArchive(tmp, run_name)
+
+    index = archive.create(run_path, key_file, chunk_size=100000, exclude=["Thumbs"])
+    assert archive.exists()
+    assert len(index["chunks"]) == sum(c["size"] for c in index["chunks"]) // 100000 + 1
+    assert all(
+        os.path.exists(archive.chunk_file(n)) for n in range(len(index["chunks"]))
+    )
+    assert f"{run_name}/Thumbs" not in [f["name"] for f in index["files"]]
+    assert archive.verify(key_file)
+
+    # The whole run is restored, but for the excluded files
+    archive.extract(key_file, os.path.join(tmp, "restored"))
+    expected = read_tree(run_path)
+    expected.pop(os.path.join("Thumbs", "thumb.jpg"))
+    assert read_tree(os.path.join(tmp, "restored", run_name)) == expected
+
+    # Single files only need the chunks holding them
+    names = [f"{run_name}/SampleSheet.csv", f"{run_name}/Data/Lane1"]
+    entries, chunk_numbers = archive.select(index, names)
+    assert [e["name"] for e in entries] == [
+        f"{run_name}/Data/Lane1",
+        f"{run_name}/Data/Lane1/InterOp.bin",
+        f"{run_name}/SampleSheet.csv",
+    ]
+    assert len(chunk_numbers) < len(index["chunks"])
+    for n in set(range(len(index["chunks"]))) - set(chunk_numbers):
+        os.remove(archive.chunk_file(n))
+    archive.extract(key_file, os.path.join(tmp, "partial"), names)
+    assert read_tree(os.path.join(tmp, "partial", run_name)) == {
+        "SampleSheet.csv": expected["SampleSheet.csv"],
+        os.path.join("Data", "Lane1", "InterOp.bin"): expected[
+            os.path.join("Data", "Lane1", "InterOp.bin")
+        ],
+    }
+
+
+def test_tampering_is_detected(run_archive):
+    tmp, run_path, key_file = run_archive
+    archive = to_test.ChunkedArchive(tmp, os.path.basename(run_path))
+    archive.create(run_path, key_file, chunk_size=100000)
+
+    # A chunk swapped with another one
+    os.replace(archive.chunk_file(1), archive.chunk_file(0))
+    assert not archive.verify(key_file)
+
+    # An index changed without the key
+    with open(archive.index_file) as f:
+        signed_index = json.load(f)
+    signed_index["index"]["files"][0]["offset"] += 512
+    with open(archive.index_file, "w") as f:
+        json.dump(signed_index, f)
+    with pytest.raises(ValueError):
+        archive.load_index(key_file)
+
+
+def test_upload_and_retrieve(run_archive):
+    tmp, run_path, key_file = run_archive
+    archive = to_test.ChunkedArchive(tmp, os.path.basename(run_path))
+    index = archive.create(run_path, key_file, chunk_size=100000)
+
+    with mock.patch.object(to_test.sp, "run") as mock_run:
+        mock_run.return_value.returncode = 0
+        assert archive.upload(max_workers=4)
+        archived = sorted(c.args[0][2] for c in mock_run.call_args_list)
+        assert archived == sorted(
+            [archive.chunk_file(n) for n in range(len(index["chunks"]))]
+            + [archive.index_file]
+        )
+
+        mock_run.reset_mock()
+        restored = to_test.ChunkedArchive(os.path.join(tmp, "restore"), archive.name)
+        assert restored.retrieve(tmp, [0, 2])
+        assert [c.args[0] for c in mock_run.call_args_list] == [
+            ["dsmc", "retrieve", src, f"{restored.path}/"]
+            for src in [
+                archive.index_file,
+                archive.chunk_file(0),
+                archive.chunk_file(2),
+            ]
+        ]
+
+        mock_run.return_value.returncode = 8
+        assert not archive.upload()
@@ -0,0 +1,194 @@
+import os
+import tempfile
+from unittest import mock
+
+from taca.cleanup import cleanup as to_test
+
+
+def create_project_tree(root: str):
+    """Create a nested analysis tree and return the number of directories in it."""
+    n_dirs = 1
+    for sample in ["P1_101", "P1_102"]:
+        dir_path = root
+        for level in [sample, "qc", "alignment"]:
+            dir_path = os.path.join(dir_path, level)
+            os.mkdir(dir_path)
+            n_dirs += 1
+            for file_name in [
+                "reads.fastq.gz",
+                "reads.bam",
+                "notes.txt",
+                ".hidden.bam",
+            ]:
+                with open(os.path.join(dir_path, file_name), "w") as stream:
+                    stream.write(file_name)
+    return n_dirs
+
+
+def test_scan_files_by_ext():
+    tmp = tempfile.TemporaryDirectory()
+    n_dirs = create_project_tree(tmp.name)
+
+    with mock.patch.object(to_test.os, "scandir", wraps=os.scandir) as mock_scandir:
+        files = to_test.scan_files_by_ext(tmp.name, ["*.fastq.gz", "*.bam"])
+    # Each directory is read once
+    assert mock_scandir.call_count == n_dirs
+
+    # Hidden files are skipped, like with glob
+    assert len(files) == 12
+    assert all(os.path.basename(f) in ["reads.fastq.gz", "reads.bam"] for f in files)
+    assert all(size == len(os.path.basename(f)) for f, size in files.items())
+
+    # Patterns with several parts match the end of the paths
+    files = to_test.scan_files_by_ext(tmp.name, "alignment/*.bam")
+    assert sorted(files) == [
+        f"{tmp.name}/P1_101/qc/alignment/reads.bam",
+        f"{tmp.name}/P1_102/qc/alignment/reads.bam",
+    ]
+    assert to_test.collect_files_by_ext(tmp.name, ".hidden.bam") != []
+
+    tmp.cleanup()
+
+
+def test_collect_data_miarka_sizes():
+    """Sizes are taken from the traversal, without stat-ing the files again."""
+    tmp = tempfile.TemporaryDirectory()
+    os.makedirs(f"{tmp.name}/analysis/P1")
+    create_project_tree(f"{tmp.name}/analysis/P1")
+    os.makedirs(f"{tmp.name}/FC/Demultiplexing")
+    create_project_tree(f"{tmp.name}/FC/Demultiplexing")
+
+    with mock.patch.object(to_test.os.path, "getsize") as mock_getsize:
+        analysis_data, analysis_size = to_test.collect_analysis_data_miarka(
+            "P1", f"{tmp.name}/analysis", {"P1_101": ["*.bam"], "P1_102": "*.txt"}
+        )
+        fastq_data, fastq_size = to_test.collect_fastq_data_miarka(
+            f"{tmp.name}/FC", "Demultiplexing"
+        )
+        mock_getsize.assert_not_called()
+
+    assert len(analysis_data["analysis_files"]["P1_101"]) == 3
+    assert len(analysis_data["analysis_files"]["P1_102"]) == 3
+    assert analysis_size == 3 * len("reads.bam") + 3 * len("notes.txt")
+    assert len(fastq_data["flowcells"]["FC"]["fq_files"]) == 6
+    assert fastq_size == 6 * len("reads.fastq.gz")
+
+    tmp.cleanup()
+
+
+def test_cleanup_miarka_project_lookup(capsys):
+    """Project documents are fetched with one query for all flowcells."""
+    tmp = tempfile.TemporaryDirectory()
+    for fc in ["210101_A00001_0001_AHXXXXXXX", "210102_A00001_0002_BHXXXXXXX"]:
+        for proj in ["AB_Test_21_01", "CD_Other_21_02"]:
+            os.makedirs(f"{tmp.name}/flowcells/{fc}/Demultiplexing/{proj}/Sample_1")
+            with open(
+                f"{tmp.name}/flowcells/{fc}/Demultiplexing/{proj}/Sample_1/S1.fastq.gz",
+                "w",
+            ) as stream:
+                stream.write("reads")
+    os.makedirs(f"{tmp.name}/analysis")
+    config = {
+        "cleanup": {
+            "miarka": {
+                "flowcell": {
+                    "root": [f"{tmp.name}/flowcells"],
+                    "relative_project_source": "Demultiplexing",
+                    "undet_file_pattern": "Undetermined_*.fastq.gz",
+                },
+                "data_dir": f"{tmp.name}/data",
+                "analysis": {"root": f"{tmp.name}/analysis", "files_to_remove": {}},
+            }
+        }
+    }
+    pdocs = {
+        "AB.Test_21_01": {
+            "project_name": "AB.Test_21_01",
+            "project_id": "P1",
+            "close_date": "2021-01-01",
+        },
+        "CD.Other_21_02": None,
+    }
+
+    with (
+        mock.patch.dict(to_test.CONFIG, config),
+        mock.patch.object(to_test, "load_config", return_value={}),
+        mock.patch.object(to_test.statusdb, "ProjectSummaryConnection") as mock_pcon,
+    ):
+        mock_pcon.return_value.get_entries.return_value = pdocs
+        try:
+            to_test.cleanup_miarka(
+                days_fastq=30,
+                days_analysis=30,
+                only_fastq=True,
+                only_analysis=False,
+                clean_undetermined=False,
+                status_db_config="statusdb.yaml",
+                exclude_projects=None,
+                list_only=True,
+                date="2022-01-01",
+            )
+        except SystemExit:
+            pass
+
+    mock_pcon.return_value.get_entries.assert_called_once()
+    assert sorted(mock_pcon.return_value.get_entries.call_args.args[0]) == sorted(
+        ["AB.Test_21_01", "CD.Other_21_02"] * 2
+    )
+    mock_pcon.return_value.get_entry.assert_not_called()
+    # Both flowcells of the closed project are listed
+    assert "AB.Test_21_01\tP1\t\t365\t2021-01-01\t~10b\t0" in capsys.readouterr().out
+
+    tmp.cleanup()
+
+
+def test_cleanup_processing():
+    tmp = tempfile.TemporaryDirectory()
+    runs = {
+        "nosync/200101_A00001_0001_AHXXXXXXX": (True, True, True),
+        "nosync/archived/20240926_AV242106_A2349523513": (True, True, True),
+        "nosync/20240101_1200_1A_PAM12345_a1b2c3d4": (True, False, True),
+        "nosync/200102_A00001_0002_BHXXXXXXX": (False, True, True),
+        "nosync/200103_A00001_0003_AHXXXXXXX": (True, True, False),
+    }
+    os.makedirs(f"{tmp.name}/nosync/archived")
+    with (
+        open(f"{tmp.name}/transfer.tsv", "w") as transfer_log,
+        open(f"{tmp.name}/archived.tsv", "w") as archive_log,
+    ):
+        for run, (transferred, archived, old) in runs.items():
+            run_name = os.path.basename(run)
+            os.makedirs(f"{tmp.name}/{run}/Data")
+            if old:
+                os.utime(f"{tmp.name}/{run}", (0, 0))
+            if transferred:
+                transfer_log.write(f"{run_name}\t2020-01-01 00:00:00\n")
+            if archived:
+                archive_log.write(
+                    f"{tmp.name}/archive/{run_name}.tar.gpg\t2020-01-01 00:00:00\n"
+                )
+    config = {
+        "cleanup": {
+            "processing": {
+                "dirs": [f"{tmp.name}/nosync", f"{tmp.name}/nosync/archived"],
+                "transfer_logs": [f"{tmp.name}/transfer.tsv"],
+                "archive_log": f"{tmp.name}/archived.tsv",
+            }
+        }
+    }
+
+    with mock.patch.dict(to_test.CONFIG, config):
+        to_test.cleanup_processing(86400, dry_run=True)
+        assert all(os.path.exists(f"{tmp.name}/{run}") for run in runs)
+
+        to_test.cleanup_processing(86400)
+    # Only the old runs that are both transferred and archived are removed
+    assert [os.path.exists(f"{tmp.name}/{run}") for run in runs] == [
+        False,
+        False,
+        True,
+        True,
+        True,
+    ]
+
+    tmp.cleanup()
@@ -0,0 +1,177 @@
+import os
+import sqlite3
+import tempfile
+from datetime import datetime
+from unittest import mock
+
+import pytest
+
+from taca.cleanup import cleanup
+from taca.cleanup.inventory import CleanupInventory, open_inventory
+from tests.cleanup.test_cleanup import create_project_tree
+
+
+def test_scan_with_inventory():
+    tmp = tempfile.TemporaryDirectory()
+    n_dirs = create_project_tree(tmp.name)
+    db = tempfile.NamedTemporaryFile(suffix=".sqlite")
+    inventory = CleanupInventory(db.name)
+    patterns = ["*.fastq.gz", "*.bam"]
+
+    with mock.patch.object(cleanup.os, "scandir", wraps=os.scandir) as mock_scandir:
+        files = cleanup.scan_files_by_ext(tmp.name, patterns, inventory=inventory)
+    assert mock_scandir.call_count == n_dirs
+    assert len(files) == 12
+
+    # Unchanged directories are not read again
+    with mock.patch.object(cleanup.os, "scandir", wraps=os.scandir) as mock_scandir:
+        assert (
+            cleanup.scan_files_by_ext(tmp.name, patterns, inventory=inventory) == files
+        )
+    mock_scandir.assert_not_called()
+
+    # Only the changed directory is read again
+    changed_dir = os.path.join(tmp.name, "P1_101", "qc")
+    with open(os.path.join(changed_dir, "new.bam"), "w") as stream:
+        stream.write("new.bam")
+    os.utime(changed_dir, ns=(0, 0))
+    with mock.patch.object(cleanup.os, "scandir", wraps=os.scandir) as mock_scandir:
+        new_files = cleanup.scan_files_by_ext(tmp.name, patterns, inventory=inventory)
+    mock_scandir.assert_called_once_with(changed_dir)
+    assert new_files == {**files, os.path.join(changed_dir, "new.bam"): 7}
+
+    # Scans with other patterns are recorded separately
+    assert len(cleanup.scan_files_by_ext(tmp.name, "*.txt", inventory=inventory)) == 6
+
+    inventory.close()
+    db.close()
+    tmp.cleanup()
+
+
+def test_sweep_records_closed_projects(capsys):
+    """Every closed project seen by a sweep is recorded with the size of all its
+    data, so the report can use other thresholds."""
+    tmp = tempfile.TemporaryDirectory()
+    for fc in ["210101_A00001_0001_AHXXXXXXX", "210102_A00001_0002_BHXXXXXXX"]:
+        for proj in ["AB_Test_21_01", "CD_Young_21_02"]:
+            os.makedirs(f"{tmp.name}/flowcells/{fc}/Demultiplexing/{proj}/Sample_1")
+            with open(
+                f"{tmp.name}/flowcells/{fc}/Demultiplexing/{proj}/Sample_1/S1.fastq.gz",
+                "w",
+            ) as stream:
+                stream.write("reads")
+    for pid in ["P1", "P2"]:
+        os.makedirs(f"{tmp.name}/analysis/{pid}/qc")
+        with open(f"{tmp.name}/analysis/{pid}/qc/{pid}.bam", "w") as stream:
+            stream.write("alignments")
+    config = {
+        "cleanup": {
+            "miarka": {
+                "flowcell": {
+                    "root": [f"{tmp.name}/flowcells"],
+                    "relative_project_source": "Demultiplexing",
+                    "undet_file_pattern": "Undetermined_*.fastq.gz",
+                },
+                "data_dir": f"{tmp.name}/data",
+                "analysis": {
+                    "root": f"{tmp.name}/analysis",
+                    "files_to_remove": {"qc": ["*.bam"]},
+                },
+                "inventory": f"{tmp.name}/inventory.sqlite",
+            }
+        }
+    }
+    pdocs = {
+        "P1": {
+            "project_name": "AB.Test_21_01",
+            "project_id": "P1",
+            "close_date": "2021-01-01",
+        },
+        "P2": {
+            "project_name": "CD.Young_21_02",
+            "project_id": "P2",
+            "close_date": "2021-12-20",
+        },
+    }
+    opened = []
+
+    def sweep(only_analysis=False):
+        with (
+            mock.patch.dict(cleanup.CONFIG, config),
+            mock.patch.object(cleanup, "load_config", return_value={}),
+            mock.patch.object(cleanup.statusdb, "ProjectSummaryConnection") as pcon,
+            mock.patch.object(
+                cleanup,
+                "open_inventory",
+                side_effect=lambda c: opened.append(open_inventory(c)) or opened[-1],
+            ),
+        ):
+            pcon.return_value.get_entries.side_effect = lambda names, **_: {
+                name: pdocs.get(name)
+                or next(d for d in pdocs.values() if d["project_name"] == name)
+                for name in names
+            }
+            try:
+                cleanup.cleanup_miarka(
+                    days_fastq=30,
+                    days_analysis=30,
+                    only_fastq=False,
+                    only_analysis=only_analysis,
+                    clean_undetermined=False,
+                    status_db_config="statusdb.yaml",
+                    exclude_projects=None,
+                    list_only=True,
+                    date="2022-01-01",
+                )
+            except SystemExit:
+                pass
+        # The inventory is closed when listing only
+        with pytest.raises(sqlite3.ProgrammingError):
+            opened[-1].connection.execute("SELECT 1")
+
+    sweep()
+    # Only the project past the thresholds is listed by the sweep
+    out = capsys.readouterr().out
+    assert "AB.Test_21_01\tP1\t\t365\t2021-01-01\t~10b\t~10b" in out
+    assert "CD.Young_21_02" not in out
+
+    inventory = CleanupInventory(config["cleanup"]["miarka"]["inventory"])
+    assert inventory.get_freeable(30, 30, datetime(2022, 1, 1)) == [
+        {
+            "name": "AB.Test_21_01",
+            "pid": "P1",
+            "closed_date": "2021-01-01",
+            "closed_days": 365,
+            "bioinfo_responsible": "",
+            "fastq_size": 10,
+            "analysis_size": 10,
+        }
+    ]
+    # Young projects are recorded with all their data too
+    freeable = inventory.get_freeable(10, None, datetime(2022, 1, 1))
+    assert [(p["name"], p["fastq_size"], p["analysis_size"]) for p in freeable] == [
+        ("AB.Test_21_01", 10, 0),
+        ("CD.Young_21_02", 10, 0),
+    ]
+
+    # A sweep of analysis data only keeps the recorded fastq sizes
+    with open(f"{tmp.name}/analysis/P2/qc/more.bam", "w") as stream:
+        stream.write("more")
+    os.utime(f"{tmp.name}/analysis/P2/qc", ns=(0, 0))
+    sweep(only_analysis=True)
+    capsys.readouterr()
+    freeable = inventory.get_freeable(10, 10, datetime(2022, 1, 1))
+    assert [(p["name"], p["fastq_size"], p["analysis_size"]) for p in freeable] == [
+        ("AB.Test_21_01", 10, 10),
+        ("CD.Young_21_02", 10, 14),
+    ]
+    inventory.close()
+
+    with mock.patch.dict(cleanup.CONFIG, config):
+        cleanup.cleanup_inventory_report(10, 10, "2022-01-01")
+    out = capsys.readouterr().out
+    assert "CD.Young_21_02\tP2\t\t12\t2021-12-20\t~10b\t~14b" in out
+    assert out.splitlines()[-1].startswith("Total")
+    assert "24b analysis data" in out.splitlines()[-1]
+
+    tmp.cleanup()
@@ -0,0 +1,53 @@
+import os
+import tempfile
+import time
+
+from taca.cleanup.removal import FileRemover, open_file_remover
+
+
+def create_files(root: str, n_files: int):
+    files = []
+    for i in range(n_files):
+        file_path = os.path.join(root, f"file_{i}.fastq.gz")
+        with open(file_path, "w") as stream:
+            stream.write("x" * i)
+        files.append(file_path)
+    return files
+
+
+def test_remove_files_with_journal():
+    tmp = tempfile.TemporaryDirectory()
+    files = create_files(tmp.name, 20)
+    journal_path = os.path.join(tmp.name, "journal", "removal.journal")
+    remover = open_file_remover({"removal": {"journal": journal_path}})
+
+    assert remover.remove_files(files[:10])
+    assert not any(os.path.exists(f) for f in files[:10])
+    with open(journal_path) as journal:
+        assert len(journal.readlines()) == 10
+
+    # An interrupted cleanup resumes with the bytes already freed
+    remover._journal.close()
+    remover = FileRemover(journal_path=journal_path, max_workers=4)
+    assert (remover.removed_files, remover.freed_bytes) == (10, sum(range(10)))
+
+    # Files that cannot be removed are reported
+    assert not remover.remove_files(files[10:] + [files[0]])
+    assert remover.finish() == (20, sum(range(20)))
+    assert not os.path.exists(journal_path)
+
+    tmp.cleanup()
+
+
+def test_remove_files_rate():
+    tmp = tempfile.TemporaryDirectory()
+    files = create_files(tmp.name, 11)
+    remover = FileRemover(max_workers=8, max_rate=100)
+
+    start = time.monotonic()
+    assert remover.remove_files(files)
+    # The first removal starts right away, the next ones every 10 ms
+    assert time.monotonic() - start >= 0.1
+    assert remover.finish() == (11, sum(range(11)))
+
+    tmp.cleanup()
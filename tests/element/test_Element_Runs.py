@@ -1,4 +1,9 @@
+import csv
+import glob
+import gzip
+import json
 import os
+import random
 import tempfile
 import zipfile
 from unittest import mock
@@ -560,9 +565,161 @@ class TestRun:
         ):
             mock_command.return_value = "test command"
             run = to_test.Run(create_element_run_dir(create_dirs), get_config(tmp))
-            run.start_demux("mock_run_manifest", "mock_demux_dir")
-            mock_command.assert_called_once_with("mock_run_manifest", "mock_demux_dir")
+            demux_dir = os.path.join(run.run_dir, "Demultiplexing_0")
+            os.mkdir(demux_dir)
+            run.start_demux("mock_run_manifest", demux_dir)
+            mock_command.assert_called_once_with("mock_run_manifest", demux_dir, 8)
             mock_Popen.assert_called_once()
+            # The PID and exit code of the job are tracked in its demux dir
+            assert "test command" in mock_Popen.call_args.args[0]
+            assert f"> {demux_dir}/.bases2fastq_exit" in mock_Popen.call_args.args[0]
+            assert os.path.exists(f"{demux_dir}/bases2fastq_stderr.txt")
+
+    def test_start_demux_failure(self, mock_db, create_dirs):
+        """A job that fails to start releases its threads and stays queued."""
+        tmp: tempfile.TemporaryDirectory = create_dirs
+        config = get_config(tmp)
+        config["element_analysis"]["data_dirs"] = [
+            f"{tmp.name}/ngi_data/sequencing/AV242106"
+        ]
+        config["element_analysis"]["bases2fastq_cores"] = 16
+        run = to_test.Run(create_element_run_dir(tmp), config)
+        demux_dir = os.path.join(run.run_dir, "Demultiplexing_0")
+        os.mkdir(demux_dir)
+        run.queue_demux("manifest_0.csv", demux_dir)
+
+        with (
+            mock.patch("subprocess.Popen", side_effect=OSError("fork failed")),
+            mock.patch(
+                "taca.element.Element_Runs.Run.generate_demux_command",
+                return_value="test command",
+            ),
+        ):
+            assert run.start_demux("manifest_0.csv", demux_dir) is False
+            run.start_queued_demux()
+
+        assert os.path.exists(f"{demux_dir}/.bases2fastq_queued")
+        assert not os.path.exists(f"{demux_dir}/.bases2fastq_threads")
+        assert run.get_bases2fastq_threads_in_use() == 0
+
+        # The job is started on the next sweep
+        with (
+            mock.patch("subprocess.Popen") as mock_Popen,
+            mock.patch(
+                "taca.element.Element_Runs.Run.generate_demux_command",
+                return_value="test command",
+            ),
+        ):
+            run.start_queued_demux()
+        mock_Popen.assert_called_once()
+        assert not os.path.exists(f"{demux_dir}/.bases2fastq_queued")
+
+    @pytest.mark.parametrize(
+        "p",
+        [
+            {"cores": None, "in_use": 0, "expected": [8, 8, 8]},
+            {"cores": 24, "in_use": 0, "expected": [8, 8, 8]},
+            {"cores": 32, "in_use": 16, "expected": [5, 5, 6]},
+            {"cores": 16, "in_use": 0, "expected": [5, 5, 6]},
+            {"cores": 16, "in_use": 8, "expected": [4, 4]},
+            {"cores": 16, "in_use": 14, "expected": []},
+        ],
+        ids=[
+            "no budget",
+            "fits",
+            "shared with other run",
+            "shared",
+            "partly queued",
+            "all queued",
+        ],
+    )
+    def test_start_queued_demux(self, mock_db, p, create_dirs):
+        tmp: tempfile.TemporaryDirectory = create_dirs
+        config = get_config(tmp)
+        config["element_analysis"]["data_dirs"] = [
+            f"{tmp.name}/ngi_data/sequencing/AV242106"
+        ]
+        if p["cores"] is not None:
+            config["element_analysis"]["bases2fastq_cores"] = p["cores"]
+            config["element_analysis"]["bases2fastq_max_threads"] = 8
+
+        # Another run already demultiplexing
+        other_run_dir = create_element_run_dir(
+            tmp, run_name="20240926_AV242106_B2349523513"
+        )
+        os.mkdir(f"{other_run_dir}/Demultiplexing_0")
+        open(f"{other_run_dir}/Demultiplexing_0/.bases2fastq_ongoing", "w").close()
+        with open(f"{other_run_dir}/Demultiplexing_0/.bases2fastq_threads", "w") as f:
+            f.write(str(p["in_use"]))
+
+        run = to_test.Run(create_element_run_dir(tmp), config)
+        for i in range(3):
+            os.mkdir(f"{run.run_dir}/Demultiplexing_{i}")
+            run.queue_demux(f"manifest_{i}.csv", f"{run.run_dir}/Demultiplexing_{i}")
+
+        with mock.patch.object(run, "start_demux") as mock_start_demux:
+            run.start_queued_demux()
+
+        assert [call.args[2] for call in mock_start_demux.call_args_list] == p[
+            "expected"
+        ]
+        assert [call.args[0] for call in mock_start_demux.call_args_list] == [
+            f"manifest_{i}.csv" for i in range(len(p["expected"]))
+        ]
+        # Jobs not started stay queued
+        assert len(
+            glob.glob(f"{run.run_dir}/Demultiplexing_*/.bases2fastq_queued")
+        ) == 3 - len(p["expected"])
+
+    def test_bases2fastq_threads_across_runs(self, mock_db, create_dirs):
+        """Jobs started earlier in the same sweep hold their threads, even
+        before their shell has written the ongoing marker."""
+        tmp: tempfile.TemporaryDirectory = create_dirs
+        config = get_config(tmp)
+        config["element_analysis"]["data_dirs"] = [
+            f"{tmp.name}/ngi_data/sequencing/AV242106"
+        ]
+        config["element_analysis"]["bases2fastq_cores"] = 12
+        config["element_analysis"]["bases2fastq_max_threads"] = 8
+
+        # A finished job does not hold its threads anymore
+        finished_run_dir = create_element_run_dir(
+            tmp, run_name="20240925_AV242106_B2349523512"
+        )
+        os.mkdir(f"{finished_run_dir}/Demultiplexing_0")
+        with open(
+            f"{finished_run_dir}/Demultiplexing_0/.bases2fastq_threads", "w"
+        ) as f:
+            f.write("8")
+        with open(f"{finished_run_dir}/Demultiplexing_0/.bases2fastq_exit", "w") as f:
+            f.write("0")
+
+        runs = [
+            to_test.Run(create_element_run_dir(tmp, run_name=run_name), config)
+            for run_name in [
+                "20240926_AV242106_A2349523513",
+                "20240926_AV242106_B2349523513",
+            ]
+        ]
+        for run in runs:
+            os.mkdir(f"{run.run_dir}/Demultiplexing_0")
+            run.queue_demux("manifest_0.csv", f"{run.run_dir}/Demultiplexing_0")
+
+        with (
+            mock.patch("subprocess.Popen") as mock_Popen,
+            mock.patch(
+                "taca.element.Element_Runs.Run.generate_demux_command",
+                return_value="test command",
+            ),
+        ):
+            for run in runs:
+                run.start_queued_demux()
+
+        assert mock_Popen.call_count == 2
+        assert runs[1].get_bases2fastq_threads_in_use() == 12
+        # The second run only got the threads left by the first one
+        with open(f"{runs[1].run_dir}/Demultiplexing_0/.bases2fastq_threads") as f:
+            assert f.read() == "4"
 
     @pytest.mark.parametrize(
         "p",
@@ -668,3 +825,405 @@ class TestRun:
 
         run.parse_run_parameters()
         assert run.in_transfer_log() is p["expected"]
+
+
+def create_element_demux_results(
+    run_path: str,
+    sub_demux_index_lens: list[tuple[int, int]] = [(8, 8), (8, 0)],
+    lanes: list[str] = ["1", "2"],
+    n_samples: int = 4,
+    n_unassigned: int = 20,
+    seed: int = 0,
+    fastq_files: bool = False,
+):
+    """Write the output of sub-demultiplexings as produced by bases2fastq, with
+    random indexes of the given lengths for each sub-demultiplexing.
+
+        {run_path}
+        ├── Demultiplexing_0
+        |   ├── IndexAssignment.csv
+        |   ├── RunManifest.csv
+        |   ├── UnassignedSequences.csv
+        |   └── Samples
+        |       ├── {project}
+        |       |   ├── {project}_RunStats.json
+        |       |   └── {sample}
+        |       |       └── {sample}_L00{lane}_R1_001.fastq.gz
+        |       └── Undetermined
+        |           └── Undetermined_L00{lane}_R1_001.fastq.gz
+        └── ...
+    """
+    rng = random.Random(seed)
+
+    def random_seq(length):
+        return "".join(rng.choice("ACGT") for _ in range(length))
+
+    max_idx1_len = max(idx1_len for idx1_len, _ in sub_demux_index_lens)
+    max_idx2_len = max(idx2_len for _, idx2_len in sub_demux_index_lens)
+    phix_indexes = [
+        (random_seq(max_idx1_len), random_seq(max_idx2_len)) for _ in range(2)
+    ]
+
+    # Samples of each sub-demultiplexing, as (sample name, index 1, index 2, lane)
+    sub_demux_samples = []
+    for idx1_len, idx2_len in sub_demux_index_lens:
+        samples = []
+        for lane in lanes:
+            samples += [
+                (
+                    f"P{len(sub_demux_samples)}_{i}",
+                    random_seq(idx1_len),
+                    random_seq(idx2_len),
+                    lane,
+                )
+                for i in range(n_samples)
+            ]
+            samples += [
+                ("PhiX", idx1[:idx1_len], idx2[:idx2_len], lane)
+                for idx1, idx2 in phix_indexes
+            ]
+        sub_demux_samples.append(samples)
+
+    for sub_demux, (idx1_len, idx2_len) in enumerate(sub_demux_index_lens):
+        sub_demux_dir = os.path.join(run_path, f"Demultiplexing_{sub_demux}")
+        os.makedirs(sub_demux_dir, exist_ok=True)
+        project = f"Project_{sub_demux}"
+
+        manifest_rows = []
+        assigned_rows = []
+        sample_stats = {}
+        for sample_name, idx1, idx2, lane in sub_demux_samples[sub_demux]:
+            sample_project = "Control" if sample_name == "PhiX" else project
+            manifest_rows.append(f"{sample_name},{idx1},{idx2},{lane},{sample_project}")
+            assigned_rows.append(
+                f"0,{sample_name},{idx1},{idx2},{lane},{rng.randint(1, 10**6)}"
+            )
+            sample_stats.setdefault(sample_project, {}).setdefault(
+                sample_name, []
+            ).append(
+                {
+                    "Lane": int(lane),
+                    "ExpectedSequence": idx1 + idx2,
+                    "PercentMismatch": rng.random(),
+                    "PercentQ30": rng.random() * 100,
+                    "PercentQ40": rng.random() * 100,
+                    "QualityScoreMean": rng.random() * 40,
+                }
+            )
+
+        with open(os.path.join(sub_demux_dir, "RunManifest.csv"), "w") as stream:
+            stream.write("[SETTINGS]\nSettingName,Value\n\n[SAMPLES]\n")
+            stream.write("SampleName,Index1,Index2,Lane,Project\n")
+            stream.write("\n".join(manifest_rows) + "\n")
+
+        with open(os.path.join(sub_demux_dir, "IndexAssignment.csv"), "w") as stream:
+            stream.write("SampleNumber,SampleName,I1,I2,Lane,NumPoloniesAssigned\n")
+            stream.write("\n".join(assigned_rows) + "\n")
+
+        with open(
+            os.path.join(sub_demux_dir, "UnassignedSequences.csv"), "w"
+        ) as stream:
+            stream.write("I1,I2,Count,% Polonies,Lane\n")
+            for lane in lanes:
+                lane_samples = [
+                    sample
+                    for samples in sub_demux_samples
+                    for sample in samples
+                    if sample[3] == lane
+                ]
+                for _ in range(n_unassigned):
+                    # Let some unassigned indexes overlap with assigned ones
+                    if rng.random() < 0.2:
+                        _, idx1, idx2, _ = rng.choice(lane_samples)
+                        idx1 = (idx1 + random_seq(idx1_len))[:idx1_len]
+                        idx2 = (idx2 + random_seq(idx2_len))[:idx2_len]
+                    else:
+                        idx1, idx2 = random_seq(idx1_len), random_seq(idx2_len)
+                    stream.write(
+                        f"{idx1},{idx2},{rng.randint(1, 10**5)},{rng.random()},{lane}\n"
+                    )
+
+        if fastq_files:
+            for sample_name, _, _, lane in sub_demux_samples[sub_demux]:
+                if sample_name == "PhiX":
+                    continue
+                sample_dir = os.path.join(
+                    sub_demux_dir, "Samples", project, sample_name
+                )
+                os.makedirs(sample_dir, exist_ok=True)
+                for read in ["R1", "R2"]:
+                    open(
+                        os.path.join(
+                            sample_dir, f"{sample_name}_L00{lane}_{read}_001.fastq.gz"
+                        ),
+                        "w",
+                    ).close()
+            undet_dir = os.path.join(sub_demux_dir, "Samples", "Undetermined")
+            os.makedirs(undet_dir, exist_ok=True)
+            for lane in lanes:
+                for read in ["R1", "R2"]:
+                    open(
+                        os.path.join(
+                            undet_dir, f"Undetermined_L00{lane}_{read}_001.fastq.gz"
+                        ),
+                        "w",
+                    ).close()
+
+        for sample_project, project_stats in sample_stats.items():
+            project_dir = os.path.join(sub_demux_dir, "Samples", sample_project)
+            os.makedirs(project_dir, exist_ok=True)
+            with open(
+                os.path.join(project_dir, f"{sample_project}_RunStats.json"), "w"
+            ) as stream:
+                json.dump(
+                    {
+                        "SampleStats": [
+                            {"SampleName": sample_name, "Occurrences": occurrences}
+                            for sample_name, occurrences in project_stats.items()
+                        ]
+                    },
+                    stream,
+                )
+
+
+@mock.patch("taca.element.Element_Runs.ElementRunsConnection")
+def test_aggregate_stats_assigned(mock_db, create_dirs: pytest.fixture):
+    tmp: tempfile.TemporaryDirectory = create_dirs
+    run_dir = create_element_run_dir(tmp)
+    create_element_demux_results(run_dir)
+
+    run = to_test.Run(run_dir, get_config(tmp))
+    os.mkdir(run.demux_dir)
+    demux_runmanifest = run.collect_demux_runmanifest(
+        [f"{run_dir}/Demultiplexing_0", f"{run_dir}/Demultiplexing_1"]
+    )
+    assigned = run.aggregate_stats_assigned(demux_runmanifest)
+
+    # 4 samples in 2 lanes for 2 sub-demuxes, PhiX is only kept for the longest indexes
+    samples = [sample for sample in assigned if sample["SampleName"] != "PhiX"]
+    phix = [sample for sample in assigned if sample["SampleName"] == "PhiX"]
+    assert len(samples) == 16
+    assert len(phix) == 4
+    assert all(len(sample["I1"] + sample["I2"]) == 16 for sample in phix)
+    assert set(sample["sub_demux_count"] for sample in phix) == {"0"}
+
+    # Stats and projects are joined onto the samples
+    for sample in samples:
+        assert sample["Project"] == f"Project_{sample['sub_demux_count']}"
+        assert sample["PercentQ30"] is not None
+    assert {sample["Project"] for sample in phix} == {"Control"}
+
+    # Samples are numbered by sample name and lane
+    assert sorted(set(sample["SampleNumber"] for sample in assigned)) == list(
+        range(1, 19)
+    )
+
+    with open(f"{run.demux_dir}/IndexAssignment.csv") as stream:
+        assert len(list(csv.DictReader(stream))) == 20
+
+
+@mock.patch("taca.element.Element_Runs.ElementRunsConnection")
+def test_aggregate_stats_unassigned(mock_db, create_dirs: pytest.fixture):
+    """Unassigned sequences overlapping with indexes assigned in sub-demuxes with
+    shorter indexes are removed. The output is compared with that of a previous
+    implementation for the same input."""
+    tmp: tempfile.TemporaryDirectory = create_dirs
+    run_dir = create_element_run_dir(tmp)
+    create_element_demux_results(
+        run_dir,
+        sub_demux_index_lens=[(10, 10), (8, 8), (8, 0)],
+        n_unassigned=50,
+    )
+
+    run = to_test.Run(run_dir, get_config(tmp))
+    os.mkdir(run.demux_dir)
+    demux_runmanifest = run.collect_demux_runmanifest(
+        [f"{run_dir}/Demultiplexing_{i}" for i in range(3)]
+    )
+    assigned = run.aggregate_stats_assigned(demux_runmanifest)
+    run.aggregate_stats_unassigned(demux_runmanifest, assigned)
+
+    with (
+        open(f"{run.demux_dir}/UnassignedSequences.csv", "rb") as output,
+        open("tests/data/element_UnassignedSequences.csv", "rb") as expected,
+    ):
+        assert output.read() == expected.read()
+
+
+@mock.patch("taca.element.Element_Runs.ElementRunsConnection")
+def test_aggregate_demux_results(mock_db, create_dirs: pytest.fixture):
+    """Aggregation only applies the differences to what is already in place and
+    resumes after the last finished step."""
+    tmp: tempfile.TemporaryDirectory = create_dirs
+    run_dir = create_element_run_dir(tmp)
+    create_element_demux_results(
+        run_dir, sub_demux_index_lens=[(8, 8), (8, 0)], fastq_files=True
+    )
+    demux_results_dirs = [f"{run_dir}/Demultiplexing_0", f"{run_dir}/Demultiplexing_1"]
+
+    run = to_test.Run(run_dir, get_config(tmp))
+    os.mkdir(run.demux_dir)
+    open(f"{run.demux_dir}/manifest.csv", "w").close()
+    run.aggregate_demux_results(demux_results_dirs)
+
+    sample_link = f"{run.demux_dir}/Project_1/Sample_P1_0/P1_0_S5_L001_R1_001.fastq.gz"
+    assert os.readlink(sample_link) == (
+        f"{run_dir}/Demultiplexing_1/Samples/Project_1/P1_0/P1_0_L001_R1_001.fastq.gz"
+    )
+    # 4 samples with 2 reads in 2 sub-demuxes and 2 lanes
+    assert len(glob.glob(f"{run.demux_dir}/Project_*/Sample_*/*.fastq.gz")) == 32
+    # Undetermined is only linked for lanes with a single sub-demux
+    assert not os.path.exists(f"{run.demux_dir}/Undetermined")
+    # Other content of the demux dir is kept
+    assert os.path.exists(f"{run.demux_dir}/manifest.csv")
+    with open(run.aggregation_progress_file) as stream:
+        assert json.load(stream)["steps_done"] == ["fastq", "assigned", "unassigned"]
+
+    # Nothing is redone for an unchanged demux output
+    with (
+        mock.patch.object(run, "apply_fastq_plan") as mock_apply,
+        mock.patch.object(run, "aggregate_stats_assigned") as mock_assigned,
+    ):
+        run.aggregate_demux_results(demux_results_dirs)
+        mock_apply.assert_not_called()
+        mock_assigned.assert_not_called()
+
+    # Changed links are replaced, links no longer planned are removed
+    os.unlink(sample_link)
+    os.symlink("/wrong/target", sample_link)
+    open(f"{run.demux_dir}/Project_1/stale.fastq.gz", "w").close()
+    os.symlink("/stale", f"{run.demux_dir}/Project_1/stale_link.fastq.gz")
+    os.makedirs(f"{run.demux_dir}/Project_old/Sample_old")
+    os.symlink("/stale", f"{run.demux_dir}/Project_old/Sample_old/old.fastq.gz")
+    os.remove(run.aggregation_progress_file)
+    with mock.patch.object(run, "aggregate_stats_unassigned", side_effect=RuntimeError):
+        with pytest.raises(RuntimeError):
+            run.aggregate_demux_results(demux_results_dirs)
+    assert os.readlink(sample_link).startswith(run_dir)
+    assert not os.path.lexists(f"{run.demux_dir}/Project_1/stale_link.fastq.gz")
+    assert os.path.exists(f"{run.demux_dir}/Project_1/stale.fastq.gz")
+    # Directories left empty by the removed links are removed too
+    assert not os.path.exists(f"{run.demux_dir}/Project_old")
+
+    # A crashed aggregation resumes after the last finished step
+    with (
+        mock.patch.object(run, "apply_fastq_plan") as mock_apply,
+        mock.patch.object(run, "aggregate_stats_assigned") as mock_assigned,
+    ):
+        run.aggregate_demux_results(demux_results_dirs)
+        mock_apply.assert_not_called()
+        mock_assigned.assert_not_called()
+    with open(run.aggregation_progress_file) as stream:
+        assert json.load(stream)["steps_done"] == ["fastq", "assigned", "unassigned"]
+
+    # Finished steps are redone when their output was removed
+    os.unlink(sample_link)
+    os.remove(f"{run.demux_dir}/IndexAssignment.csv")
+    run.aggregate_demux_results(demux_results_dirs)
+    assert os.readlink(sample_link).startswith(run_dir)
+    assert os.path.exists(f"{run.demux_dir}/IndexAssignment.csv")
+
+
+@mock.patch("taca.element.Element_Runs.ElementRunsConnection")
+def test_update_statusdb(mock_db, create_dirs: pytest.fixture):
+    """The aggregated demux stats tables are attached to the document instead of
+    being part of it."""
+    tmp: tempfile.TemporaryDirectory = create_dirs
+    run_dir = create_element_run_dir(tmp, metadata_files=True)
+    create_element_demux_results(run_dir, sub_demux_index_lens=[(8, 8), (8, 0)])
+
+    run = to_test.Run(run_dir, get_config(tmp))
+    run.parse_run_parameters()
+    os.mkdir(run.demux_dir)
+    run.aggregate_demux_results(
+        [f"{run_dir}/Demultiplexing_0", f"{run_dir}/Demultiplexing_1"]
+    )
+    run.update_statusdb()
+
+    doc_obj, attachments = (
+        mock_db.return_value.upload_to_statusdb.call_args.args[0],
+        mock_db.return_value.upload_to_statusdb.call_args.kwargs["attachments"],
+    )
+    assert doc_obj["Element"]["Demultiplex_Stats"] == {
+        "Index_Assignment": {"attachment": "IndexAssignment.csv.gz"},
+        "Unassigned_Sequences": {"attachment": "UnassignedSequences.csv.gz"},
+    }
+    for file_name in ["IndexAssignment.csv", "UnassignedSequences.csv"]:
+        with open(f"{run.demux_dir}/{file_name}", "rb") as table:
+            assert gzip.decompress(attachments[f"{file_name}.gz"]) == table.read()
+
+    # Missing tables are neither referenced nor attached
+    os.remove(f"{run.demux_dir}/UnassignedSequences.csv")
+    assert (
+        run.to_doc_obj()["Element"]["Demultiplex_Stats"]["Unassigned_Sequences"] is None
+    )
+    assert list(run.get_doc_attachments()) == ["IndexAssignment.csv.gz"]
+
+
+@mock.patch("taca.element.Element_Runs.ElementRunsConnection")
+def test_copy_manifests(mock_db, create_dirs: pytest.fixture):
+    """Manifests are only extracted again when the contents of the zip file change."""
+    tmp: tempfile.TemporaryDirectory = create_dirs
+    run_dir = create_element_run_dir(tmp, lims_manifest=True, metadata_files=True)
+
+    run = to_test.Run(run_dir, get_config(tmp))
+    run.parse_run_parameters()
+    zip_path = run.find_lims_zip()
+    run.copy_manifests(zip_path)
+    with zipfile.ZipFile(zip_path) as zip_file:
+        for member in zip_file.namelist():
+            with open(f"{run_dir}/{os.path.basename(member)}", "rb") as extracted:
+                assert extracted.read() == zip_file.read(member)
+    assert run.lims_manifest.endswith("_untrimmed.csv")
+
+    # An unchanged zip file is neither hashed nor extracted again
+    with (
+        mock.patch.object(to_test, "hashfile") as mock_hashfile,
+        mock.patch.object(to_test.zipfile, "ZipFile") as mock_zipfile,
+    ):
+        run.copy_manifests(zip_path)
+        mock_hashfile.assert_not_called()
+        mock_zipfile.assert_not_called()
+
+    # A touched zip file with the same contents is hashed, but not extracted
+    os.utime(zip_path, ns=(0, 0))
+    with mock.patch.object(to_test.zipfile, "ZipFile") as mock_zipfile:
+        run.copy_manifests(zip_path)
+        mock_zipfile.assert_not_called()
+
+    # A zip file with new contents is extracted
+    with zipfile.ZipFile(zip_path, "a") as zip_file:
+        zip_file.writestr("extra_manifest.csv", "[SAMPLES]\n")
+    run.copy_manifests(zip_path)
+    assert os.path.exists(f"{run_dir}/extra_manifest.csv")
+
+
+@mock.patch("taca.element.Element_Runs.ElementRunsConnection")
+def test_make_demux_manifests(mock_db, create_dirs: pytest.fixture):
+    """The demux manifests split from the LIMS manifest are compared with those
+    of a previous implementation for the same input."""
+    tmp: tempfile.TemporaryDirectory = create_dirs
+    run_dir = create_element_run_dir(tmp, lims_manifest=True, metadata_files=True)
+
+    run = to_test.Run(run_dir, get_config(tmp))
+    run.parse_run_parameters()
+    run.copy_manifests(run.find_lims_zip())
+    manifests = run.make_demux_manifests(run.lims_manifest)
+
+    expected_dir = "tests/data/element_demux_manifests"
+    assert sorted(os.path.basename(manifest) for manifest in manifests) == sorted(
+        os.listdir(expected_dir)
+    )
+    for manifest in manifests:
+        with (
+            open(manifest) as output,
+            open(f"{expected_dir}/{os.path.basename(manifest)}") as expected,
+        ):
+            assert output.read() == expected.read().replace(
+                "{manifest_path}", run.lims_manifest
+            )
+
+    # Masks are only computed once per index pattern, also across calls
+    misses = to_test.get_mask.cache_info().misses
+    run.make_demux_manifests(run.lims_manifest)
+    assert to_test.get_mask.cache_info().misses == misses
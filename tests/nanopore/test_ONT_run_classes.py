@@ -1,3 +1,4 @@
+import glob
 import importlib
 import os
 import re
@@ -97,6 +98,7 @@ def create_ONT_run_dir(
     anglerfish_samplesheets: bool = False,
     anglerfish_ongoing: bool = False,
     anglerfish_exit: int | None = None,
+    toulligqc_exit: int | None = None,
 ) -> str:
     """Create a run directory according to specifications.
 
@@ -195,6 +197,12 @@ def create_ONT_run_dir(
         with open(f"{run_path}/.anglerfish_done", "w") as f:
             f.write(str(anglerfish_exit))
 
+    if toulligqc_exit is not None:
+        os.mkdir(f"{run_path}/toulligqc_report")
+        open(f"{run_path}/toulligqc_report/report.html", "w").close()
+        with open(f"{run_path}/.toulligqc_done", "w") as f:
+            f.write(str(toulligqc_exit))
+
     if fastq_dirs:
         os.mkdir(f"{run_path}/fastq_pass")
 
@@ -241,3 +249,363 @@ def test_ONT_user_run(create_dirs: pytest.fixture):
     # Assert methods can run
     db_update: dict = {}
     run.parse_pore_activity(db_update)
+
+
+def test_ONT_run_dir_listing(create_dirs: pytest.fixture):
+    """This test checks that file lookups are served from a single snapshot of the
+    run dir, which is only refreshed upon invalidation."""
+
+    # Create dir tree
+    tmp: tempfile.TemporaryDirectory = create_dirs
+
+    # Mock db
+    mock_db = patch("taca.utils.statusdb.NanoporeRunsConnection")
+    mock_db.start()
+
+    # Mock CONFIG
+    test_config_yaml = make_ONT_test_config(tmp)
+    mock_config = patch("taca.utils.config.CONFIG", new=test_config_yaml)
+    mock_config.start()
+
+    # Create run dir
+    run_path = create_ONT_run_dir(
+        tmp,
+        script_files=True,
+        run_finished=True,
+        fastq_dirs=True,
+        barcode_dirs=True,
+    )
+
+    # Reload module to add mocks
+    importlib.reload(ONT_run_classes)
+
+    with patch(
+        "taca.nanopore.ONT_run_classes.os.scandir", wraps=os.scandir
+    ) as mock_scandir:
+        run = ONT_run_classes.ONT_user_run(run_path)
+
+        # Top-level lookups
+        assert run.get_file("/report*.json").endswith(".json")
+        assert run.has_file("/pore_activity*.csv")
+        assert not run.has_file("/.sync_finished")
+        assert not run.has_file("/sample_sheet*.csv")
+
+        # Lookups in subdirs
+        assert run.has_file("/fastq_pass/barcode*")
+        assert not run.has_file("/toulligqc_report/report.html")
+
+        # Hidden files are not matched by wildcards, like with glob
+        open(f"{run_path}/.report_hidden.json", "w").close()
+        run.invalidate_run_dir_listing()
+        assert len(run.query_run_dir("/*report*.json")) == 1
+
+        # Files added after the snapshot are not seen until invalidation
+        open(f"{run_path}/.sync_finished", "w").close()
+        assert not run.is_synced()
+        run.invalidate_run_dir_listing()
+        assert run.is_synced()
+
+        # The run dir was only read upon instantiation and after each invalidation
+        assert [call.args[0] for call in mock_scandir.call_args_list].count(
+            run_path
+        ) == 3
+
+    patch.stopall()
+
+
+def test_ONT_run_toulligqc_report(create_dirs: pytest.fixture):
+    """This test checks that ToulligQC is started in the background, waited for
+    while ongoing and published once finished, and that the number of concurrent
+    ToulligQC processes is limited."""
+
+    # Create dir tree
+    tmp: tempfile.TemporaryDirectory = create_dirs
+
+    # Mock db
+    mock_db = patch("taca.utils.statusdb.NanoporeRunsConnection")
+    mock_db.start()
+
+    # Mock CONFIG
+    test_config_yaml = make_ONT_test_config(tmp)
+    test_config_yaml["nanopore_analysis"]["toulligqc_max_concurrent"] = 1
+    mock_config = patch("taca.utils.config.CONFIG", new=test_config_yaml)
+    mock_config.start()
+
+    # Create run dirs
+    run_path = create_ONT_run_dir(
+        tmp,
+        script_files=True,
+        run_finished=True,
+        sync_finished=True,
+    )
+    other_run_path = create_ONT_run_dir(
+        tmp,
+        instrument_position="2A",
+        script_files=True,
+        run_finished=True,
+        sync_finished=True,
+    )
+
+    # Reload module to add mocks
+    importlib.reload(ONT_run_classes)
+
+    mock_popen = patch("taca.nanopore.ONT_run_classes.subprocess.Popen").start()
+    mock_rsync = patch("taca.nanopore.ONT_run_classes.RsyncAgent").start()
+
+    # ToulligQC is started in the background
+    run = ONT_run_classes.ONT_user_run(run_path)
+    assert run.toulligqc_report() is False
+    mock_popen.assert_called_once()
+    assert "toulligqc" in mock_popen.call_args.args[0]
+    taca_toulligqc_run_dirs = [
+        d for d in os.listdir(run_path) if d.startswith("taca_toulligqc_run_")
+    ]
+    assert len(taca_toulligqc_run_dirs) == 1
+    with open(f"{run_path}/{taca_toulligqc_run_dirs[0]}/command.sh") as f:
+        command = f.read()
+    assert "--sequencing-summary-source" in command
+    assert f"> {run_path}/.toulligqc_done" in command
+
+    # ToulligQC is ongoing
+    with open(f"{run_path}/.toulligqc_ongoing", "w") as f:
+        f.write("1337")
+    run = ONT_run_classes.ONT_user_run(run_path)
+    assert run.toulligqc_report() is False
+    assert run.count_ongoing_toulligqc() == 1
+
+    # Other run has to wait until a slot is free
+    other_run = ONT_run_classes.ONT_user_run(other_run_path)
+    assert other_run.toulligqc_report() is False
+    mock_popen.assert_called_once()
+
+    # ToulligQC has finished and the report is published
+    os.remove(f"{run_path}/.toulligqc_ongoing")
+    os.mkdir(f"{run_path}/toulligqc_report")
+    open(f"{run_path}/toulligqc_report/report.html", "w").close()
+    with open(f"{run_path}/.toulligqc_done", "w") as f:
+        f.write("0")
+    run = ONT_run_classes.ONT_user_run(run_path)
+    assert run.toulligqc_report() is True
+    mock_rsync.return_value.transfer.assert_called_once()
+
+    # The report is only published once
+    run = ONT_run_classes.ONT_user_run(run_path)
+    assert run.toulligqc_report() is True
+    mock_rsync.return_value.transfer.assert_called_once()
+
+    # Other run can now start
+    other_run = ONT_run_classes.ONT_user_run(other_run_path)
+    assert other_run.toulligqc_report() is False
+    assert mock_popen.call_count == 2
+
+    # ToulligQC has failed
+    with open(f"{other_run_path}/.toulligqc_done", "w") as f:
+        f.write("1")
+    other_run = ONT_run_classes.ONT_user_run(other_run_path)
+    with pytest.raises(AssertionError):
+        other_run.toulligqc_report()
+
+    patch.stopall()
+
+
+def test_ONT_run_toulligqc_limit_within_sweep(create_dirs: pytest.fixture):
+    """This test checks that runs handled back-to-back in one sweep count the
+    ToulligQC processes started before them, even before these have started."""
+
+    # Create dir tree
+    tmp: tempfile.TemporaryDirectory = create_dirs
+
+    # Mock db
+    mock_db = patch("taca.utils.statusdb.NanoporeRunsConnection")
+    mock_db.start()
+
+    # Mock CONFIG
+    test_config_yaml = make_ONT_test_config(tmp)
+    test_config_yaml["nanopore_analysis"]["toulligqc_max_concurrent"] = 1
+    mock_config = patch("taca.utils.config.CONFIG", new=test_config_yaml)
+    mock_config.start()
+
+    # Create run dirs
+    run_paths = [
+        create_ONT_run_dir(
+            tmp,
+            instrument_position=position,
+            script_files=True,
+            run_finished=True,
+            sync_finished=True,
+        )
+        for position in ["1A", "2A"]
+    ]
+
+    # Reload module to add mocks
+    importlib.reload(ONT_run_classes)
+
+    # The subprocess never gets to write its PID during the sweep
+    mock_popen = patch("taca.nanopore.ONT_run_classes.subprocess.Popen").start()
+
+    runs = [ONT_run_classes.ONT_user_run(run_path) for run_path in run_paths]
+    assert [run.toulligqc_report() for run in runs] == [False, False]
+    mock_popen.assert_called_once()
+    assert os.path.exists(f"{run_paths[0]}/.toulligqc_ongoing")
+    assert not os.path.exists(f"{run_paths[1]}/.toulligqc_ongoing")
+
+    patch.stopall()
+
+
+def test_ONT_run_parse_sequencing_summary(create_dirs: pytest.fixture):
+    """This test checks that read counts, yields and N50s are summarized per
+    barcode from the sequencing summary, regardless of chunk size."""
+
+    # Create dir tree
+    tmp: tempfile.TemporaryDirectory = create_dirs
+
+    # Mock db
+    mock_db = patch("taca.utils.statusdb.NanoporeRunsConnection")
+    mock_db.start()
+
+    # Mock CONFIG
+    test_config_yaml = make_ONT_test_config(tmp)
+    test_config_yaml["nanopore_analysis"]["sequencing_summary_chunksize"] = 2
+    mock_config = patch("taca.utils.config.CONFIG", new=test_config_yaml)
+    mock_config.start()
+
+    # Create run dir
+    run_path = create_ONT_run_dir(
+        tmp,
+        script_files=True,
+        run_finished=True,
+        sync_finished=True,
+    )
+
+    # Reload module to add mocks
+    importlib.reload(ONT_run_classes)
+
+    # Empty summary is skipped
+    run = ONT_run_classes.ONT_user_run(run_path)
+    db_update = {}
+    run.parse_sequencing_summary(db_update)
+    assert "read_summary" not in db_update
+
+    # Write summary
+    summary_path = run.get_file("/sequencing_summary*.txt")
+    rows = [
+        ("barcode01", "TRUE", 100),
+        ("barcode01", "TRUE", 200),
+        ("barcode01", "FALSE", 50),
+        ("barcode02", "TRUE", 1000),
+        ("barcode02", "FALSE", 10),
+        ("unclassified", "FALSE", 300),
+    ]
+    with open(summary_path, "w") as f:
+        f.write(
+            "filename\tread_id\tpasses_filtering\tsequence_length_template\tbarcode_arrangement\n"
+        )
+        for i, (barcode, passes, length) in enumerate(rows):
+            f.write(f"file.pod5\tread{i}\t{passes}\t{length}\t{barcode}\n")
+
+    run = ONT_run_classes.ONT_user_run(run_path)
+    db_update = {}
+    run.parse_sequencing_summary(db_update)
+    read_summary = db_update["read_summary"]
+
+    assert read_summary["barcode01"] == {
+        "read_count": 3,
+        "pass_read_count": 2,
+        "pass_reads_pc": 66.67,
+        "yield_bases": 350,
+        "pass_yield_bases": 300,
+        "read_length_n50": 200,
+        "pass_read_length_n50": 200,
+    }
+    assert read_summary["unclassified"]["pass_read_count"] == 0
+    assert read_summary["unclassified"]["pass_read_length_n50"] is None
+    assert read_summary["all"]["read_count"] == 6
+    assert read_summary["all"]["pass_yield_bases"] == 1300
+    assert read_summary["all"]["read_length_n50"] == 1000
+
+    patch.stopall()
+
+
+def test_allocate_threads():
+    # Job running alone gets what it can use
+    assert ONT_run_classes.allocate_threads(16, 0, 1, 2, 8) == 8
+    assert ONT_run_classes.allocate_threads(16, 0, 1, 2, 32) == 16
+    # Free threads are shared between queued jobs
+    assert ONT_run_classes.allocate_threads(16, 0, 4, 2, 32) == 4
+    assert ONT_run_classes.allocate_threads(16, 10, 4, 2, 32) == 2
+    # Not enough free threads
+    assert ONT_run_classes.allocate_threads(16, 15, 1, 2, 32) is None
+
+
+def test_ONT_qc_run_anglerfish_threads(create_dirs: pytest.fixture):
+    """This test checks that Anglerfish runs are sized from the host-wide
+    thread budget and queued once the budget is used up."""
+
+    # Create dir tree
+    tmp: tempfile.TemporaryDirectory = create_dirs
+
+    # Mock db
+    mock_db = patch("taca.utils.statusdb.NanoporeRunsConnection")
+    mock_db.start()
+
+    # Mock CONFIG
+    test_config_yaml = make_ONT_test_config(tmp)
+    test_config_yaml["nanopore_analysis"]["run_types"]["qc_run"]["anglerfish"].update(
+        {"threads_budget": 8, "min_threads": 2, "threads_per_barcode": 2}
+    )
+    mock_config = patch("taca.utils.config.CONFIG", new=test_config_yaml)
+    mock_config.start()
+
+    # Create run dirs
+    run_paths = [
+        create_ONT_run_dir(
+            tmp,
+            qc=True,
+            flowcell_id=f"TEST0000{i}",
+            script_files=True,
+            run_finished=True,
+            sync_finished=True,
+            fastq_dirs=True,
+            barcode_dirs=True,
+        )
+        for i in range(3)
+    ]
+
+    # Reload module to add mocks
+    importlib.reload(ONT_run_classes)
+
+    mock_popen = patch("taca.nanopore.ONT_run_classes.subprocess.Popen").start()
+
+    run = ONT_run_classes.ONT_qc_run(run_paths[0])
+    run.anglerfish_samplesheet = f"{run_paths[0]}/run_path.txt"
+    n_barcodes = run.count_barcode_dirs()
+    assert n_barcodes > 0
+
+    # Run alone gets threads for all barcodes, capped by budget
+    n_threads = run.allocate_anglerfish_threads()
+    assert n_threads == min(8, 2 * n_barcodes)
+    assert os.path.exists(f"{run_paths[0]}/.anglerfish_queued")
+
+    # Starting claims the threads and leaves the queue
+    run.run_anglerfish(n_threads)
+    mock_popen.assert_called_once()
+    command_path = glob.glob(f"{run_paths[0]}/taca_anglerfish_run_*/command.sh")[0]
+    assert f"--threads {n_threads}" in open(command_path).read()
+    assert not os.path.exists(f"{run_paths[0]}/.anglerfish_queued")
+    # The run is counted as ongoing before its subprocess has started
+    assert os.path.exists(f"{run_paths[0]}/.anglerfish_ongoing")
+
+    # Remaining threads are shared between queued runs
+    free = 8 - n_threads
+    other_runs = [ONT_run_classes.ONT_qc_run(path) for path in run_paths[1:]]
+    for other_run in other_runs:
+        open(other_run.anglerfish_queued_abspath, "w").close()
+    for other_run in other_runs:
+        if free < 2:
+            assert other_run.allocate_anglerfish_threads() is None
+        else:
+            assert other_run.allocate_anglerfish_threads() == max(
+                2, min(free // 2, 2 * n_barcodes)
+            )
+
+    patch.stopall()
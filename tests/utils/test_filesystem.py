@@ -0,0 +1,47 @@
+import os
+import tempfile
+
+from taca.utils import filesystem as to_test
+
+
+def test_drop_folder_index():
+    tmp = tempfile.TemporaryDirectory()
+    for subdir in ["2024", "2025"]:
+        os.mkdir(f"{tmp.name}/{subdir}")
+    for file in [
+        "2024/20240903_1404_3A_PAW55312_a1b2c3d4_samplesheet.csv",
+        "2025/20250101_1000_3A_PAW55312_a1b2c3d4_samplesheet.csv",
+        "2025/20250101_1000_3A_PAW00000_e5f6a7b8_samplesheet.csv",
+        "2025/notes.txt",
+        "orphan_PAW55312.csv",
+    ]:
+        open(f"{tmp.name}/{file}", "w").close()
+
+    index = to_test.DropFolderIndex(tmp.name, ".csv", depth=1)
+    assert index.find("PAW55312") == [
+        f"{tmp.name}/2024/20240903_1404_3A_PAW55312_a1b2c3d4_samplesheet.csv",
+        f"{tmp.name}/2025/20250101_1000_3A_PAW55312_a1b2c3d4_samplesheet.csv",
+    ]
+    assert index.find("20250101_1000_3A_PAW00000_e5f6a7b8") == [
+        f"{tmp.name}/2025/20250101_1000_3A_PAW00000_e5f6a7b8_samplesheet.csv"
+    ]
+    # Keys are matched anywhere in the names, like the globs "*<key>*.csv"
+    assert len(index.find("PAW5531")) == 2
+    open(f"{tmp.name}/2025/20250103_1000_3A_PAW55312-rerun.csv", "w").close()
+    assert len(index.find("PAW55312")) == 3
+    os.remove(f"{tmp.name}/2025/20250103_1000_3A_PAW55312-rerun.csv")
+    assert index.find("PAW99999") == []
+
+    # Only modified directories are listed again
+    open(f"{tmp.name}/2025/20250102_1000_3A_PAW99999_c9d0e1f2.csv", "w").close()
+    listing_2024 = index._listings[f"{tmp.name}/2024"]
+    assert index.find("PAW99999") == [
+        f"{tmp.name}/2025/20250102_1000_3A_PAW99999_c9d0e1f2.csv"
+    ]
+    assert index._listings[f"{tmp.name}/2024"] is listing_2024
+
+    # Removed files are dropped from the index
+    os.remove(f"{tmp.name}/2024/20240903_1404_3A_PAW55312_a1b2c3d4_samplesheet.csv")
+    assert len(index.find("PAW55312")) == 1
+
+    tmp.cleanup()
@@ -0,0 +1,149 @@
+import base64
+import gzip
+import hashlib
+from unittest import mock
+
+from taca.utils import statusdb as to_test
+
+
+def make_db(remote_doc: dict | None) -> mock.Mock:
+    db = mock.MagicMock()
+    rows = [mock.Mock(value=dict(remote_doc))] if remote_doc else []
+    db.view.return_value = {"run": mock.Mock(rows=rows)}
+    db.save.return_value = ("doc_id", "1-rev")
+    db.__getitem__.return_value = dict(remote_doc or {}, _id="doc_id")
+    return db
+
+
+def test_update_doc_attachments():
+    table = gzip.compress(b"SampleName,Lane\nP1_1,1\n", mtime=0)
+    digest = "md5-" + base64.b64encode(hashlib.md5(table).digest()).decode()
+
+    # New documents are saved, then attached to
+    db = make_db(None)
+    to_test.update_doc(db, {"name": "run"}, attachments={"table.csv.gz": table})
+    db.save.assert_called_once_with({"name": "run"})
+    db.put_attachment.assert_called_once()
+    assert db.put_attachment.call_args.kwargs["filename"] == "table.csv.gz"
+
+    # Unchanged documents and attachments are not written again
+    remote_doc = {
+        "_id": "doc_id",
+        "_rev": "2-rev",
+        "name": "run",
+        "_attachments": {"table.csv.gz": {"stub": True, "digest": digest}},
+    }
+    db = make_db(remote_doc)
+    to_test.update_doc(db, {"name": "run"}, attachments={"table.csv.gz": table})
+    db.__setitem__.assert_not_called()
+    db.put_attachment.assert_not_called()
+
+    # Updated documents keep the stubs of their attachments
+    db = make_db(remote_doc)
+    to_test.update_doc(
+        db,
+        {"name": "run", "run_status": "transferred"},
+        attachments={"table.csv.gz": gzip.compress(b"SampleName\n", mtime=0)},
+    )
+    saved_doc = db.__setitem__.call_args.args[1]
+    assert saved_doc["run_status"] == "transferred"
+    assert saved_doc["_attachments"] == remote_doc["_attachments"]
+    db.put_attachment.assert_called_once()
+
+
+@mock.patch.dict(to_test.ElementRunsConnection.run_statuses, clear=True)
+@mock.patch("taca.utils.statusdb.couchdb.Server")
+def test_element_run_statuses(mock_server):
+    connection = to_test.ElementRunsConnection({})
+    connection.db = mock.MagicMock()
+    connection.db.view.return_value = [mock.Mock(key="run_1", value="demultiplexing")]
+
+    connection.prefetch_run_statuses(["run_1", "run_2"])
+    connection.db.view.assert_called_once_with("info/status", keys=["run_1", "run_2"])
+
+    # Prefetched statuses and TACA's own updates are read locally, also by
+    # other connections of the sweep
+    other_connection = to_test.ElementRunsConnection({})
+    other_connection.db = mock.MagicMock()
+    assert other_connection.check_db_run_status("run_1") == "demultiplexing"
+    assert other_connection.check_db_run_status("run_2") == "Unknown"
+    with mock.patch.object(to_test, "update_doc"):
+        other_connection.upload_to_statusdb(
+            {"name": "run_2", "run_status": "sequencing"}
+        )
+    assert connection.check_db_run_status("run_2") == "sequencing"
+    other_connection.db.view.assert_not_called()
+
+
+@mock.patch.dict(to_test.NanoporeRunsConnection.run_entries, clear=True)
+@mock.patch("taca.utils.statusdb.couchdb.Server")
+def test_nanopore_run_entries(mock_server):
+    connection = to_test.NanoporeRunsConnection({})
+    connection.db = mock.MagicMock()
+    connection.db.view.return_value = [
+        mock.Mock(key="run_1", id="doc_1", doc={"run_status": "ongoing"})
+    ]
+    connection.db.__getitem__.return_value = mock.MagicMock(id="doc_1")
+    run_1, run_2 = mock.Mock(run_name="run_1"), mock.Mock(run_name="run_2")
+
+    connection.prefetch_run_statuses(["run_1", "run_2"])
+    assert connection.check_run_exists(run_1)
+    assert connection.check_run_status(run_1) == "ongoing"
+    assert not connection.check_run_exists(run_2)
+
+    connection.finish_ongoing_run(run_1, {})
+    assert connection.check_run_status(run_1) == "finished"
+    connection.db.view.assert_called_once()
+
+
+@mock.patch("taca.utils.statusdb.couchdb.Server")
+def test_project_summary_get_entries(mock_server):
+    connection = to_test.ProjectSummaryConnection({})
+    connection.db = mock.MagicMock()
+    connection.db.view.return_value = [mock.Mock(key="P1", doc={"project_id": "P1"})]
+
+    assert connection.get_entries(["P1", "P2", "P1"], use_id_view=True) == {
+        "P1": {"project_id": "P1"},
+        "P2": None,
+    }
+    connection.db.view.assert_called_once_with(
+        "project/project_id", keys=["P1", "P2"], reduce=False, include_docs=True
+    )
+
+
+@mock.patch.dict(to_test.FlowcellNamesConnection.flowcell_entries, clear=True)
+@mock.patch("taca.utils.statusdb.couchdb.Server")
+def test_flowcell_entries(mock_server):
+    connection = to_test.FlowcellNamesConnection({}, dbname="x_flowcells")
+    connection.db = mock.MagicMock()
+    connection.db.view.return_value = [
+        mock.Mock(key="200201_BHHFCFDSXX", id="doc_1", doc={"illumina": {}}),
+        mock.Mock(key="200201_BHHFCFDSXX", id="doc_2", doc={"illumina": {}}),
+    ]
+
+    connection.prefetch_flowcells(
+        ["200201_BHHFCFDSXX", "200202_AHHFCFDSXX"], include_docs=True
+    )
+    connection.db.view.assert_called_once_with(
+        "names/name",
+        keys=["200201_BHHFCFDSXX", "200202_AHHFCFDSXX"],
+        reduce=False,
+        include_docs=True,
+    )
+
+    # Prefetched flowcells are read locally, also by other connections of the sweep
+    other_connection = to_test.FlowcellNamesConnection({}, dbname="x_flowcells")
+    other_connection.db = mock.MagicMock()
+    assert other_connection.get_flowcell_entry("200201_BHHFCFDSXX") == (
+        "doc_2",
+        {"illumina": {}},
+    )
+    assert other_connection.get_flowcell_entry("200202_AHHFCFDSXX") is None
+    other_connection.db.view.assert_not_called()
+
+    # Other flowcells are looked up with a keyed query
+    other_connection.db.view.return_value = []
+    assert other_connection.get_flowcell_entry("200203_AHHFCFDSXX") is None
+    other_connection.db.view.assert_called_once_with(
+        "names/name", keys=["200203_AHHFCFDSXX"], reduce=False, include_docs=False
+    )
@@ -0,0 +1,52 @@
+import os
+import tempfile
+from unittest import mock
+
+from taca.utils import transfer as to_test
+
+
+def test_metadata_sync_agent():
+    tmp = tempfile.TemporaryDirectory()
+    src, dest = f"{tmp.name}/run", f"{tmp.name}/metadata/run"
+    for file, content in {
+        "report.json": "{}",
+        "other_reports/pore_scan.csv": "a,b\n1,2\n",
+        "fastq_pass/barcode01/reads.fastq.gz": "reads",
+        "sample.pod5": "signal",
+    }.items():
+        os.makedirs(os.path.dirname(f"{src}/{file}"), exist_ok=True)
+        with open(f"{src}/{file}", "w") as stream:
+            stream.write(content)
+
+    agent = to_test.MetadataSyncAgent(
+        src, dest, exclude_dirs=["fastq*"], exclude_files=["*.pod5*"]
+    )
+    assert agent.transfer() == 10
+    assert sorted(
+        os.path.relpath(os.path.join(root, file), dest)
+        for root, _, files in os.walk(dest)
+        for file in files
+    ) == ["other_reports/pore_scan.csv", "report.json"]
+
+    # Nothing is copied or hashed again for unchanged files
+    with mock.patch.object(to_test, "hashfile") as mock_hashfile:
+        assert agent.transfer() == 0
+        mock_hashfile.assert_not_called()
+
+    # Touched files are hashed, but only copied if their contents changed
+    os.utime(f"{src}/report.json", ns=(0, 0))
+    assert agent.transfer() == 0
+    with open(f"{src}/report.json", "w") as stream:
+        stream.write("[]")
+    assert agent.transfer() == 2
+
+    # Files can be copied to other relative paths
+    agent = to_test.MetadataSyncAgent(
+        src,
+        f"{tmp.name}/flat",
+        files={"other_reports/pore_scan.csv": "pore_scan.csv", "missing.txt": "x"},
+    )
+    assert agent.transfer() == 8
+    assert os.listdir(f"{tmp.name}/flat") == ["pore_scan.csv"]
+
+    tmp.cleanup()